@@ -1,16 +1,31 @@
+import atexit
+import base64
+import csv
+import hashlib
+import multiprocessing
 import os
+import queue
 import re
+import sqlite3
 import unicodedata
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
-from flask import Flask, request, jsonify, render_template, redirect, url_for, Response, session, send_file
+from flask import Flask, request, jsonify, render_template, redirect, url_for, Response, session, send_file, stream_with_context, has_request_context, make_response
 from functools import wraps
+from google.api_core import exceptions as gexc
 from google.cloud import firestore, storage
 from google.cloud.firestore_v1.base_query import And
+from google.cloud.firestore_v1.field_path import FieldPath
 import firebase_admin
 from firebase_admin import credentials, storage as firebase_storage
 from dotenv import load_dotenv
-from collections import Counter
+from collections import Counter, OrderedDict
 import io
 import bcrypt
 from io import BytesIO
@@ -34,16 +49,18 @@ def normalize_plate(plate: str) -> str:
     cleaned = re.sub(r'[^0-9A-Za-z]', '', plate)
     return cleaned.upper()
 
+
+def normalize_name(name: str) -> str:
+    """Remove acentos, ignora maiúsculas/minúsculas e espaços repetidos (ex: 'José  Silva' -> 'jose silva')."""
+    if not name:
+        return name
+    decomposed = unicodedata.normalize('NFKD', name)
+    sem_acento = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(sem_acento.casefold().split())
+
 # Define o fuso horário local
 LOCAL_TZ = ZoneInfo("America/Sao_Paulo")
 
-# Função para invalidar cache do histórico (chamada em saídas/chegadas/cancelamentos)
-def invalidate_historico_cache():
-    """Limpa todo o cache do histórico quando há mudanças"""
-    global historico_cache
-    historico_cache.clear()
-    print('[DELETE] Cache do histórico invalidado (saída/chegada/cancelamento)')
-
 # Carrega as variáveis de ambiente do arquivo .env
 load_dotenv()
 
@@ -215,9 +232,6 @@ def maintenance_status():
         "message": "Sistema em manutenção" if is_maintenance_mode() else "Sistema operacional"
     }), 200
 
-# Flag global para indicar que o Firestore está indisponível (por ex. quota excedida)
-FIRESTORE_AVAILABLE = True
-
 # ==========================================
 # [SAVE] SISTEMA DE BACKUP DE ARQUIVOS
 # ==========================================
@@ -280,10 +294,196 @@ def backup_storage_file(blob_path, reason='delete'):
 # - Quando (timestamp)
 # - Onde (coleção e documento)
 # - Dados antes e depois (para rollback)
+#
+# A gravação é assíncrona: log_audit só monta o documento e o coloca numa
+# fila limitada; uma thread grava em WriteBatch de até 500 documentos.
+# Se o Firestore falhar (queda, quota) ou a fila encher, os registros vão
+# para um arquivo JSONL local (spool) e são reenviados depois. No
+# encerramento do processo a fila é descarregada (atexit). Cada registro
+# recebe o ID do documento ao entrar na fila, então reenviar o mesmo
+# registro (spool relido após uma falha parcial) sobrescreve em vez de duplicar.
+
+AUDIT_COLLECTION = 'audit_log'
+AUDIT_FILA_MAX = int(os.getenv('AUDIT_FILA_MAX', '5000'))
+AUDIT_LOTE_MAX = 500  # limite de escritas de um WriteBatch
+AUDIT_FLUSH_INTERVALO = float(os.getenv('AUDIT_FLUSH_INTERVALO', '2'))
+AUDIT_SPOOL_RETRY = int(os.getenv('AUDIT_SPOOL_RETRY', '60'))
+AUDIT_SPOOL_PATH = os.getenv('AUDIT_SPOOL_PATH', os.path.join(tempfile.gettempdir(), 'frota_sanemar_audit_spool.jsonl'))
+AUDIT_ID_CAMPO = '_audit_id'  # ID do documento, guardado no registro (não vai para o Firestore)
+
+
+class AuditWriter:
+    """Fila + thread que grava os registros de auditoria em lotes."""
+
+    def __init__(self, spool_path=AUDIT_SPOOL_PATH, fila_max=AUDIT_FILA_MAX):
+        self.spool_path = spool_path
+        self._fila = queue.Queue(maxsize=fila_max)
+        self._lock = threading.Lock()
+        self._spool_lock = threading.Lock()
+        self._thread = None
+        self._ultima_tentativa_spool = 0
+
+    def enfileirar(self, registro):
+        """Nunca bloqueia: com a fila cheia o registro vai direto para o spool."""
+        registro.setdefault(AUDIT_ID_CAMPO, uuid.uuid4().hex)
+        self._iniciar()
+        try:
+            self._fila.put_nowait(registro)
+        except queue.Full:
+            self._gravar_spool([registro])
+
+    def _iniciar(self):
+        # Inicia a thread no primeiro uso (no processo que realmente atende requisições)
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._loop, name='audit-writer', daemon=True)
+            self._thread.start()
+
+    def _proximo_lote(self, espera):
+        lote = []
+        try:
+            lote.append(self._fila.get(timeout=espera))
+        except queue.Empty:
+            return lote
+        while len(lote) < AUDIT_LOTE_MAX:
+            try:
+                lote.append(self._fila.get_nowait())
+            except queue.Empty:
+                break
+        return lote
+
+    def _loop(self):
+        while True:
+            try:
+                lote = self._proximo_lote(AUDIT_FLUSH_INTERVALO)
+                if lote:
+                    self._gravar(lote)
+                if time.time() - self._ultima_tentativa_spool >= AUDIT_SPOOL_RETRY:
+                    self._reenviar_spool()
+            except Exception as e:
+                print(f" Erro na thread de auditoria: {e}")
+
+    def _commit(self, lote):
+        batch = db.batch()
+        colecao = db.collection(AUDIT_COLLECTION)
+        for registro in lote:
+            dados = {k: v for k, v in registro.items() if k != AUDIT_ID_CAMPO}
+            batch.set(colecao.document(registro[AUDIT_ID_CAMPO]), dados)
+        batch.commit()
+
+    def _gravar(self, lote):
+        """Grava um lote no Firestore; em caso de falha, guarda no spool."""
+        if not firestore_disponivel():
+            self._gravar_spool(lote)
+            return
+        try:
+            self._commit(lote)
+            print(f"[OK] Auditoria: {len(lote)} registro(s) gravado(s)")
+        except Exception as e:
+            print(f" Erro ao gravar auditoria ({e}) - {len(lote)} registro(s) no spool")
+            self._gravar_spool(lote)
+
+    @staticmethod
+    def _para_json(valor):
+        if isinstance(valor, datetime):
+            return {'__datetime__': valor.isoformat()}
+        # SERVER_TIMESTAMP precisa voltar como sentinela ao reenviar o spool,
+        # senão o Firestore grava a string "Sentinel: ..." no lugar da data
+        if valor is firestore.SERVER_TIMESTAMP:
+            return {'__server_timestamp__': True}
+        return str(valor)
+
+    @staticmethod
+    def _de_json(obj):
+        if len(obj) == 1:
+            if '__datetime__' in obj:
+                return datetime.fromisoformat(obj['__datetime__'])
+            if obj.get('__server_timestamp__') is True:
+                return firestore.SERVER_TIMESTAMP
+        return obj
+
+    def _gravar_spool(self, lote):
+        try:
+            with self._spool_lock, open(self.spool_path, 'a', encoding='utf-8') as f:
+                for registro in lote:
+                    f.write(json.dumps(registro, default=self._para_json, ensure_ascii=False) + '\n')
+        except Exception as e:
+            print(f" Erro ao gravar spool de auditoria: {e}")
+
+    def _reenviar_spool(self):
+        """Reenvia o spool em lotes; o que não for enviado continua no arquivo."""
+        self._ultima_tentativa_spool = time.time()
+        if not firestore_disponivel():
+            return
+        with self._spool_lock:
+            if not os.path.exists(self.spool_path):
+                return
+            try:
+                with open(self.spool_path, 'r', encoding='utf-8') as f:
+                    registros = []
+                    for linha in f:
+                        linha = linha.strip()
+                        if not linha:
+                            continue
+                        try:
+                            registro = json.loads(linha, object_hook=self._de_json)
+                            # Spool anterior ao ID no registro: ID derivado da própria linha
+                            registro.setdefault(AUDIT_ID_CAMPO, hashlib.sha1(linha.encode('utf-8')).hexdigest())
+                            registros.append(registro)
+                        except ValueError:
+                            print(" Linha inválida no spool de auditoria descartada")
+            except Exception as e:
+                print(f" Erro ao ler spool de auditoria: {e}")
+                return
+
+            enviados = 0
+            try:
+                for inicio in range(0, len(registros), AUDIT_LOTE_MAX):
+                    self._commit(registros[inicio:inicio + AUDIT_LOTE_MAX])
+                    enviados = inicio + len(registros[inicio:inicio + AUDIT_LOTE_MAX])
+            except Exception as e:
+                print(f" Erro ao reenviar spool de auditoria: {e}")
+
+            restantes = registros[enviados:]
+            try:
+                if restantes:
+                    tmp_path = self.spool_path + '.tmp'
+                    with open(tmp_path, 'w', encoding='utf-8') as f:
+                        for registro in restantes:
+                            f.write(json.dumps(registro, default=self._para_json, ensure_ascii=False) + '\n')
+                    os.replace(tmp_path, self.spool_path)
+                else:
+                    os.remove(self.spool_path)
+            except Exception as e:
+                print(f" Erro ao atualizar spool de auditoria: {e}")
+        if enviados:
+            print(f"[OK] Auditoria: {enviados} registro(s) do spool reenviado(s)")
+
+    def flush(self):
+        """Grava tudo o que está na fila (chamado no encerramento do processo)."""
+        lote = []
+        while True:
+            try:
+                lote.append(self._fila.get_nowait())
+            except queue.Empty:
+                break
+        for inicio in range(0, len(lote), AUDIT_LOTE_MAX):
+            self._gravar(lote[inicio:inicio + AUDIT_LOTE_MAX])
+
+    def pendentes(self):
+        return self._fila.qsize()
+
+
+audit_writer = AuditWriter()
+atexit.register(audit_writer.flush)
+
 
 def log_audit(action, collection_name, doc_id, old_data=None, new_data=None, user=None):
     """
-    Registra uma ação de auditoria no Firestore.
+    Registra uma ação de auditoria (gravação assíncrona em lote).
     
     Args:
         action (str): 'create', 'update', 'delete'
@@ -293,10 +493,6 @@ def log_audit(action, collection_name, doc_id, old_data=None, new_data=None, use
         new_data (dict): Dados depois da modificação (para create/update)
         user (str): Usuário que executou a ação (pega da sessão se None)
     """
-    if not db:
-        print(f" Auditoria: Firestore indisponível, log não registrado")
-        return
-    
     try:
         # Pega usuário da sessão se não fornecido
         if user is None:
@@ -324,16 +520,12 @@ def log_audit(action, collection_name, doc_id, old_data=None, new_data=None, use
         if new_data:
             audit_doc['new_data'] = serialize_doc(new_data)
         
-        # Salva no Firestore
-        db.collection('audit_log').add(audit_doc)
-        
-        print(f"[OK] Auditoria: {action.upper()} em {collection_name}/{doc_id} por {user}")
+        # Entra na fila; a thread de auditoria grava no Firestore
+        audit_writer.enfileirar(audit_doc)
     
     except Exception as e:
         # Não deve interromper a operação principal
         print(f" Erro ao registrar auditoria: {e}")
-        import traceback
-        traceback.print_exc()
 
 # ==========================================
 #  SISTEMA DE GERENCIAMENTO DE USUÁRIOS
@@ -376,22 +568,1206 @@ def get_user_by_username(username):
         print(f"Erro ao buscar usuário: {e}")
         return None
 
-# Flag global para indicar que o Firestore está indisponível (por ex. quota excedida)
-FIRESTORE_AVAILABLE = True
+# ==========================================
+# [CACHE] ÍNDICES EM MEMÓRIA (VEÍCULOS / MOTORISTAS)
+# ==========================================
+# Coleções pequenas e muito consultadas são carregadas UMA vez e mantidas
+# atualizadas pelas próprias rotas que as modificam. Evita uma query por
+# placa (N+1) em histórico, veículos em curso, métricas etc.
+# O TTL garante que alterações feitas por outro processo/instância
+# apareçam depois de alguns minutos. Se a recarga falhar (Firestore fora do
+# ar), a última versão carregada continua valendo.
+
+INDEX_TTL = int(os.getenv('INDEX_TTL', '600'))  # 10 minutos
+
+
+def _resolver_valor_local(atual, valor):
+    """Aplica localmente sentinelas do Firestore (Increment, Maximum, Minimum, SERVER_TIMESTAMP)."""
+    if isinstance(valor, firestore.Increment):
+        try:
+            return (atual or 0) + valor.value
+        except TypeError:
+            return valor.value
+    if isinstance(valor, (firestore.Maximum, firestore.Minimum)):
+        if atual is None:
+            return valor.value
+        escolher = max if isinstance(valor, firestore.Maximum) else min
+        try:
+            return escolher(atual, valor.value)
+        except TypeError:
+            return valor.value
+    if valor is firestore.SERVER_TIMESTAMP:
+        return datetime.now(timezone.utc)
+    return valor
+
+
+class CollectionIndex:
+    """Índice em memória de uma coleção, por ID do documento e por um campo-chave.
+
+    A chave é procurada primeiro pelo valor exato e depois pelo valor
+    normalizado (ex: placa sem traço, nome sem acento).
+    """
+
+    def __init__(self, collection_name, key_field, normalize_key, ttl=INDEX_TTL):
+        self.collection_name = collection_name
+        self.key_field = key_field
+        self.normalize_key = normalize_key
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._recarga_lock = threading.Lock()  # uma recarga por vez (single-flight)
+        self._by_id = {}
+        self._by_key = {}
+        self._by_key_exact = {}
+        self._loaded_at = 0
+        self._carregado = False
+        self._tocados = None  # IDs escritos localmente durante a recarga em andamento
+
+    def _reindex_locked(self):
+        self._by_key = {}
+        self._by_key_exact = {}
+        for doc_id, data in self._by_id.items():
+            valor = data.get(self.key_field)
+            if not valor:
+                continue
+            # Em caso de duplicados, mantém o primeiro (mesmo comportamento do .limit(1))
+            self._by_key_exact.setdefault(valor, doc_id)
+            self._by_key.setdefault(self.normalize_key(valor), doc_id)
+
+    def _vencido(self):
+        return not self._loaded_at or time.time() - self._loaded_at >= self.ttl
+
+    def _ensure_loaded(self):
+        if not db or not self._vencido():
+            return
+        # Só uma thread relê a coleção; com o índice já carregado as outras
+        # seguem com a versão atual em vez de esperar
+        if not self._recarga_lock.acquire(blocking=not self._carregado):
+            return
+        try:
+            if not self._vencido():
+                return
+            with self._lock:
+                self._tocados = set()
+            try:
+                docs = list(db.collection(self.collection_name).stream())
+            except Exception as e:
+                with self._lock:
+                    self._tocados = None
+                if not self._carregado:
+                    raise
+                print(f' Erro ao recarregar índice de {self.collection_name} ({e}), usando a última versão')
+                return
+            with self._lock:
+                novo = {doc.id: (doc.to_dict() or {}) for doc in docs}
+                # Escritas locais feitas durante a leitura valem mais que a foto lida
+                for doc_id in self._tocados:
+                    if doc_id in self._by_id:
+                        novo[doc_id] = self._by_id[doc_id]
+                    else:
+                        novo.pop(doc_id, None)
+                self._tocados = None
+                self._by_id = novo
+                self._reindex_locked()
+                self._loaded_at = time.time()
+                self._carregado = True
+        finally:
+            self._recarga_lock.release()
+        print(f'[CACHE] Índice de {self.collection_name} carregado ({len(docs)} documentos)')
+
+    @staticmethod
+    def _copy(doc_id, data):
+        item = dict(data)
+        item['id'] = doc_id
+        return item
+
+    def get(self, key):
+        """Retorna uma cópia do documento (com 'id') ou None."""
+        if not key:
+            return None
+        self._ensure_loaded()
+        with self._lock:
+            doc_id = self._by_key_exact.get(key) or self._by_key.get(self.normalize_key(key))
+            if doc_id is None or doc_id not in self._by_id:
+                return None
+            return self._copy(doc_id, self._by_id[doc_id])
+
+    def get_by_id(self, doc_id):
+        if not doc_id:
+            return None
+        self._ensure_loaded()
+        with self._lock:
+            data = self._by_id.get(doc_id)
+            return self._copy(doc_id, data) if data is not None else None
+
+    def all(self):
+        """Lista cópias de todos os documentos indexados."""
+        self._ensure_loaded()
+        with self._lock:
+            return [self._copy(doc_id, data) for doc_id, data in self._by_id.items()]
+
+    def reference(self, doc_id):
+        return db.collection(self.collection_name).document(doc_id)
+
+    def add(self, data):
+        """Cria o documento no Firestore e já o registra no índice. Retorna o ID."""
+        _, doc_ref = db.collection(self.collection_name).add(data)
+        self.upsert(doc_ref.id, data, replace=True)
+        return doc_ref.id
+
+    def update(self, doc_id, fields):
+        """Atualiza o documento no Firestore e mantém o índice coerente."""
+        self.reference(doc_id).update(fields)
+        self.upsert(doc_id, fields)
+
+    def upsert(self, doc_id, fields, replace=False):
+        """Atualiza o índice após uma escrita (set/update/add) no Firestore."""
+        with self._lock:
+            atual = {} if replace else dict(self._by_id.get(doc_id, {}))
+            for campo, valor in fields.items():
+                atual[campo] = _resolver_valor_local(atual.get(campo), valor)
+            self._by_id[doc_id] = atual
+            if self._tocados is not None:
+                self._tocados.add(doc_id)
+            self._reindex_locked()
+
+    def remove(self, doc_id):
+        with self._lock:
+            if self._tocados is not None:
+                self._tocados.add(doc_id)
+            if self._by_id.pop(doc_id, None) is not None:
+                self._reindex_locked()
+
+    def invalidate(self):
+        """Força recarga completa na próxima consulta."""
+        with self._lock:
+            self._loaded_at = 0
+
+
+# Índice de veículos por placa normalizada e por ID do documento
+veiculos_index = CollectionIndex('veiculos', 'placa', normalize_plate)
+
+# Cadastro de motoristas por nome exato / sem acento e por ID do documento
+# (secao, visibilidade e viagens_totais ficam disponíveis sem ler a coleção)
+motoristas_index = CollectionIndex('motoristas', 'nome', normalize_name)
+
+
+# ==========================================
+# [CACHE] CAMADA DE CACHE (LRU EM MEMÓRIA / SQLITE COMPARTILHADO)
+# ==========================================
+# CACHE_BACKEND=memory  -> LRU por processo (padrão, desenvolvimento)
+# CACHE_BACKEND=sqlite  -> arquivo SQLite compartilhado por todos os workers
+#                          da mesma máquina: uma invalidação feita por um worker
+#                          vale imediatamente para todos os outros.
+# Cada entrada tem TTL próprio e o número de entradas é limitado (LRU).
+# Entradas vencidas ficam guardadas por mais CACHE_RESERVA segundos e só são
+# servidas com get(..., expirado=True) (modo economia ou Firestore fora do ar).
+
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'memory').lower()
+CACHE_SQLITE_PATH = os.getenv('CACHE_SQLITE_PATH', os.path.join(tempfile.gettempdir(), 'frota_sanemar_cache.sqlite3'))
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '512'))
+CACHE_RESERVA = int(os.getenv('CACHE_RESERVA', '86400'))  # 24 horas
+
+
+class MemoryCacheBackend:
+    """LRU em memória com TTL por chave (vale só para o processo atual)."""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # key -> (expires, value)
+
+    def get(self, key, expirado=False):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            now = time.time()
+            if expires <= now - CACHE_RESERVA:
+                del self._data[key]
+                return None
+            if expires <= now and not expirado:
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.time() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._data if k.startswith(prefix)]:
+                del self._data[key]
+
+    def keys(self, prefix):
+        now = time.time()
+        with self._lock:
+            return [k for k, (expires, _) in self._data.items() if k.startswith(prefix) and expires > now]
+
+
+class SQLiteCacheBackend:
+    """Cache em arquivo SQLite compartilhado entre processos (valores em JSON)."""
+
+    def __init__(self, path=CACHE_SQLITE_PATH, max_entries=CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache(accessed)')
+
+    def _conn(self):
+        # Uma conexão por thread (sqlite3 não compartilha conexões entre threads)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key, expirado=False):
+        conn = self._conn()
+        now = time.time()
+        row = conn.execute('SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] <= now - CACHE_RESERVA:
+            conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+            return None
+        if row[1] <= now and not expirado:
+            return None
+        conn.execute('UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl):
+        conn = self._conn()
+        now = time.time()
+        conn.execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?)',
+            (key, json.dumps(value, default=str), now + ttl, now)
+        )
+        # Remove os vencidos há mais de CACHE_RESERVA e, se passar do limite, os menos usados
+        conn.execute('DELETE FROM cache WHERE expires <= ?', (now - CACHE_RESERVA,))
+        conn.execute(
+            'DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,)
+        )
+
+    def delete(self, key):
+        self._conn().execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def delete_prefix(self, prefix):
+        self._conn().execute("DELETE FROM cache WHERE key LIKE ? ESCAPE '\\'", (self._like(prefix),))
+
+    def keys(self, prefix):
+        rows = self._conn().execute(
+            "SELECT key FROM cache WHERE key LIKE ? ESCAPE '\\' AND expires > ?", (self._like(prefix), time.time())
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    @staticmethod
+    def _like(prefix):
+        escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return escaped + '%'
+
+
+def _criar_cache_backend():
+    if CACHE_BACKEND == 'sqlite':
+        try:
+            backend = SQLiteCacheBackend()
+            print(f'[CACHE] Backend SQLite compartilhado: {CACHE_SQLITE_PATH}')
+            return backend
+        except Exception as e:
+            print(f' Erro ao abrir cache SQLite ({e}), usando cache em memória')
+    return MemoryCacheBackend()
+
+
+cache_backend = _criar_cache_backend()
+
+
+class CacheStore:
+    """Namespace de cache ('dashboard', 'historico') sobre o backend configurado."""
+
+    def __init__(self, namespace, default_ttl, backend=None):
+        self.namespace = namespace
+        self.default_ttl = default_ttl
+        self.backend = backend or cache_backend
+
+    def _key(self, key):
+        return f'{self.namespace}:{key}'
+
+    def get(self, key, expirado=False):
+        """Valor em cache; com expirado=True aceita entradas vencidas (ainda na reserva)."""
+        try:
+            return self.backend.get(self._key(key), expirado)
+        except Exception as e:
+            print(f' Erro ao ler cache {self.namespace}: {e}')
+            return None
+
+    def set(self, key, value, ttl=None):
+        try:
+            self.backend.set(self._key(key), value, ttl if ttl is not None else self.default_ttl)
+        except Exception as e:
+            print(f' Erro ao gravar cache {self.namespace}: {e}')
+
+    def delete(self, key):
+        try:
+            self.backend.delete(self._key(key))
+        except Exception as e:
+            print(f' Erro ao invalidar cache {self.namespace}: {e}')
+
+    def delete_prefix(self, prefix):
+        try:
+            self.backend.delete_prefix(self._key(prefix))
+        except Exception as e:
+            print(f' Erro ao invalidar cache {self.namespace}: {e}')
+
+    def keys(self, prefix=''):
+        """Chaves válidas do namespace que começam com `prefix` (sem o namespace)."""
+        try:
+            inicio = len(self._key(''))
+            return [k[inicio:] for k in self.backend.keys(self._key(prefix))]
+        except Exception as e:
+            print(f' Erro ao listar cache {self.namespace}: {e}')
+            return []
+
+    def clear(self):
+        self.delete_prefix('')
+
+
+# Caches das rotas mais consultadas (5 minutos)
+dashboard_cache = CacheStore('dashboard', default_ttl=300)
+historico_cache = CacheStore('historico', default_ttl=300)
+
+
+# ==========================================
+# [STATS] CONTABILIDADE DE LEITURAS/ESCRITAS DO FIRESTORE E ORÇAMENTO DIÁRIO
+# ==========================================
+# O cliente `db` é envolvido por ClienteContabilizado: cada leitura, escrita e
+# exclusão de documento é contada por requisição, por rota e por dia. O dia é
+# o da quota do Firestore, que vira à meia-noite do horário do Pacífico.
+# A contagem segue a tabela de cobrança do Firestore:
+#   - get de documento / get_all: 1 leitura por documento (mesmo inexistente)
+#   - consulta: 1 leitura por documento retornado (mínimo 1 por consulta)
+#   - count(): 1 leitura a cada 1000 documentos contados (mínimo 1)
+#   - listener: 1 leitura por documento alterado em cada snapshot
+#   - set/update/create/add: 1 escrita; delete: 1 exclusão (lotes e transações
+#     contam no commit)
+#
+# Os totais do dia são somados (Increment) em uso_firestore/{YYYY-MM-DD} por
+# uma thread a cada USO_FIRESTORE_INTERVALO segundos e relidos ao reiniciar o
+# processo. GET /api/admin/firestore/uso mostra os números.
+#
+# Orçamento: ao passar de FIRESTORE_ORCAMENTO_LEITURAS (ou de escritas/
+# exclusões) no dia, o app entra em MODO ECONOMIA até a virada do dia:
+# - caches vencidos (histórico, dashboard) continuam sendo servidos
+#   por até CACHE_RESERVA segundos em vez de recalculados;
+# - as rotas pesadas (PDFs, exportação de auditoria, reconstruções de
+#   agregados) respondem 503.
+# Os padrões ficam em 80% do plano gratuito (50k leituras, 20k escritas e 20k
+# exclusões por dia), para sobrar quota às saídas/chegadas do quiosque.
+
+USO_FIRESTORE_COLLECTION = 'uso_firestore'
+USO_FIRESTORE_TZ = ZoneInfo('America/Los_Angeles')
+USO_FIRESTORE_INTERVALO = float(os.getenv('USO_FIRESTORE_INTERVALO', '300'))
+USO_FIRESTORE_DIAS = int(os.getenv('USO_FIRESTORE_DIAS', '7'))
+FIRESTORE_ORCAMENTO = {
+    'leituras': int(os.getenv('FIRESTORE_ORCAMENTO_LEITURAS', '40000')),
+    'escritas': int(os.getenv('FIRESTORE_ORCAMENTO_ESCRITAS', '16000')),
+    'exclusoes': int(os.getenv('FIRESTORE_ORCAMENTO_EXCLUSOES', '16000')),
+}
+
+# Rotas bloqueadas no modo economia (endpoint do Flask)
+ORCAMENTO_ENDPOINTS_PESADOS = {
+    'pdf_motoristas', 'pdf_veiculos', 'pdf_abastecimentos', 'pdf_saidas',
+    'pdf_multas', 'pdf_revisoes', 'gerar_pdf_km_mensal', 'criar_relatorio',
+    'export_audit_logs', 'reconstruir_agregados_refuel_route', 'recalcular_metricas_veiculo_route',
+    'reconstruir_resumo_refuels_route', 'reconstruir_travas_saidas', 'reconstruir_resumo_dashboard',
+}
+
+
+def _uso_vazio():
+    return {'leituras': 0, 'escritas': 0, 'exclusoes': 0}
+
+
+def _rota_vazia():
+    return {'requisicoes': 0, 'leituras': 0, 'escritas': 0, 'exclusoes': 0, 'leituras_max': 0}
+
+
+class UsoFirestore:
+    """Contadores de leituras/escritas/exclusões por requisição, rota e dia."""
+
+    def __init__(self, dias=USO_FIRESTORE_DIAS):
+        self.max_dias = dias
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._dias = OrderedDict()   # dia -> {'base': {...}, 'totais': {...}, 'rotas': {rota: {...}}}
+        self._pendente = {}          # dia -> {'totais': {...}, 'rotas': {rota: {...}}} (ainda não gravado)
+        self._economia_dia = None
+        self._thread = None
+        # Nos processos do pool de PDF o consumo é devolvido ao processo principal
+        self.persistir = multiprocessing.parent_process() is None
+
+    @staticmethod
+    def dia_atual():
+        return datetime.now(USO_FIRESTORE_TZ).strftime('%Y-%m-%d')
+
+    def _dia(self, dia):
+        estado = self._dias.get(dia)
+        if estado is None:
+            estado = self._dias[dia] = {'base': _uso_vazio(), 'carregado': False, 'totais': _uso_vazio(), 'rotas': {}}
+            while len(self._dias) > self.max_dias:
+                self._dias.popitem(last=False)
+        return estado
+
+    def _somar(self, dia, rota, uso, requisicoes=0, leituras_max=0):
+        with self._lock:
+            estado = self._dia(dia)
+            pendente = self._pendente.setdefault(dia, {'totais': _uso_vazio(), 'rotas': {}})
+            for destino in (estado, pendente):
+                por_rota = destino['rotas'].setdefault(rota, _rota_vazia())
+                for campo, valor in uso.items():
+                    destino['totais'][campo] += valor
+                    por_rota[campo] += valor
+                por_rota['requisicoes'] += requisicoes
+                por_rota['leituras_max'] = max(por_rota['leituras_max'], leituras_max)
+
+    # ---- contexto (requisição / rotina de segundo plano) ----
+
+    def _contexto(self):
+        return getattr(self._local, 'contexto', None)
+
+    def iniciar(self, rota):
+        self._local.contexto = {'rota': rota, **_uso_vazio()}
+
+    def finalizar(self):
+        """Fecha a requisição atual da thread e devolve o que ela consumiu."""
+        contexto = self._contexto()
+        if contexto is None:
+            return None
+        self._local.contexto = None
+        uso = {campo: contexto[campo] for campo in _uso_vazio()}
+        self._somar(self.dia_atual(), contexto['rota'], {}, requisicoes=1, leituras_max=uso['leituras'])
+        self._local.ultima = uso
+        return uso
+
+    def ultima(self):
+        """Consumo da última requisição finalizada nesta thread."""
+        return getattr(self._local, 'ultima', None)
+
+    @contextmanager
+    def rotina(self, rota):
+        """Atribui as operações do bloco a `rota` (threads, listeners, jobs)."""
+        anterior = self._contexto()
+        self.iniciar(rota)
+        try:
+            yield self._local.contexto
+        finally:
+            self.finalizar()
+            self._local.contexto = anterior
+
+    def registrar(self, leituras=0, escritas=0, exclusoes=0):
+        uso = {'leituras': leituras, 'escritas': escritas, 'exclusoes': exclusoes}
+        contexto = self._contexto()
+        if contexto is not None:
+            for campo, valor in uso.items():
+                contexto[campo] += valor
+            rota = contexto['rota']
+        else:
+            rota = f'segundo plano: {threading.current_thread().name}'
+        self._somar(self.dia_atual(), rota, uso)
+        self._iniciar_thread()
+
+    def mesclar(self, rota, uso):
+        """Soma o consumo medido em outro processo (jobs de PDF) como uma requisição."""
+        uso = {campo: int(uso.get(campo, 0)) for campo in _uso_vazio()}
+        self._somar(self.dia_atual(), rota, uso, requisicoes=1, leituras_max=uso['leituras'])
+
+    # ---- orçamento ----
+
+    def totais(self, dia=None):
+        """Totais do dia: o que já estava gravado ao iniciar + o medido neste processo."""
+        with self._lock:
+            estado = self._dias.get(dia or self.dia_atual())
+            if estado is None:
+                return _uso_vazio()
+            return {campo: estado['base'][campo] + estado['totais'][campo] for campo in estado['totais']}
+
+    def em_economia(self):
+        dia = self.dia_atual()
+        totais = self.totais(dia)
+        excedidos = [campo for campo, limite in FIRESTORE_ORCAMENTO.items() if limite and totais[campo] >= limite]
+        if excedidos and self._economia_dia != dia:
+            self._economia_dia = dia
+            print(f'[QUOTA] Orçamento diário do Firestore atingido ({", ".join(excedidos)}): modo economia até a virada do dia')
+        return bool(excedidos)
+
+    def resumo(self, dia=None):
+        dia = dia or self.dia_atual()
+        totais = self.totais(dia)
+        with self._lock:
+            estado = self._dias.get(dia)
+            rotas = {rota: dict(valores) for rota, valores in estado['rotas'].items()} if estado else {}
+            dias = list(self._dias)
+        for valores in rotas.values():
+            valores['leituras_media'] = (round(valores['leituras'] / valores['requisicoes'], 1)
+                                         if valores['requisicoes'] else None)
+        ordenadas = sorted(rotas.items(), key=lambda item: item[1]['leituras'], reverse=True)
+        return {
+            'dia': dia,
+            'totais': totais,
+            'orcamento': dict(FIRESTORE_ORCAMENTO),
+            'percentual': {campo: round(100.0 * totais[campo] / limite, 1) if limite else None
+                           for campo, limite in FIRESTORE_ORCAMENTO.items()},
+            'modo_economia': dia == self.dia_atual() and self.em_economia(),
+            'rotas': [{'rota': rota, **valores} for rota, valores in ordenadas],
+            'dias_disponiveis': dias,
+        }
+
+    # ---- persistência (uso_firestore/{dia}) ----
+
+    def _iniciar_thread(self):
+        if not self.persistir or (self._thread and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._loop, name='uso-firestore', daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            try:
+                self.carregar()
+                time.sleep(USO_FIRESTORE_INTERVALO)
+                self.gravar()
+            except Exception as e:
+                print(f' Erro na thread de uso do Firestore: {e}')
+                time.sleep(USO_FIRESTORE_INTERVALO)
+
+    def carregar(self):
+        """Lê o total já gravado hoje (reinício do processo no meio do dia)."""
+        dia = self.dia_atual()
+        with self._lock:
+            if self._dia(dia)['carregado']:
+                return
+        if not db:
+            return
+        with self.rotina('contabilidade do Firestore'):
+            doc = db.collection(USO_FIRESTORE_COLLECTION).document(dia).get()
+        gravado = (doc.to_dict() or {}).get('totais', {}) if doc.exists else {}
+        with self._lock:
+            estado = self._dia(dia)
+            pendente = self._pendente.get(dia, {'totais': _uso_vazio()})['totais']
+            # O documento já inclui o que este processo gravou; o pendente ainda não
+            estado['base'] = {campo: max(0, int(gravado.get(campo, 0)) - (estado['totais'][campo] - pendente[campo]))
+                              for campo in estado['base']}
+            estado['carregado'] = True
+
+    def gravar(self):
+        """Soma o consumo pendente nos documentos diários (1 escrita por dia pendente)."""
+        if not self.persistir:
+            return
+        with self._lock:
+            pendentes, self._pendente = self._pendente, {}
+        if not db:
+            return
+        for dia, pendente in pendentes.items():
+            dados = {
+                'dia': dia,
+                'totais': {campo: firestore.Increment(valor) for campo, valor in pendente['totais'].items()},
+                'rotas': {
+                    rota: {
+                        **{campo: firestore.Increment(valor) for campo, valor in valores.items() if campo != 'leituras_max'},
+                        'leituras_max': firestore.Maximum(valores['leituras_max']),
+                    }
+                    for rota, valores in pendente['rotas'].items()
+                },
+                'atualizado_em': firestore.SERVER_TIMESTAMP,
+            }
+            try:
+                with self.rotina('contabilidade do Firestore'):
+                    db.collection(USO_FIRESTORE_COLLECTION).document(dia).set(dados, merge=True)
+            except Exception as e:
+                print(f' Erro ao gravar uso do Firestore ({dia}): {e}')
+                with self._lock:
+                    # Devolve ao pendente para a próxima tentativa
+                    for rota, valores in pendente['rotas'].items():
+                        atual = self._pendente.setdefault(dia, {'totais': _uso_vazio(), 'rotas': {}})
+                        destino = atual['rotas'].setdefault(rota, _rota_vazia())
+                        for campo, valor in valores.items():
+                            destino[campo] = max(destino[campo], valor) if campo == 'leituras_max' else destino[campo] + valor
+                    for campo, valor in pendente['totais'].items():
+                        self._pendente[dia]['totais'][campo] += valor
+
+
+uso_firestore = UsoFirestore()
+atexit.register(uso_firestore.gravar)
 
-def mark_firestore_unavailable_if_quota(e):
-    """Marca FIRESTORE_AVAILABLE = False se detectarmos erro de quota/excesso de uso.
-    Retorna True se marcou como indisponível."""
-    global FIRESTORE_AVAILABLE
+
+def firestore_em_economia():
+    """True quando o orçamento diário do Firestore foi atingido (ver UsoFirestore)."""
+    return uso_firestore.em_economia()
+
+
+# ==========================================
+# [LOCK] CIRCUIT BREAKER DO FIRESTORE (QUEDA / QUOTA ESGOTADA)
+# ==========================================
+# Todas as chamadas do `db` passam pelo circuito (ver _Contabilizado._executar):
+# - FECHADO: chamadas normais. Erros de disponibilidade (UNAVAILABLE, timeout,
+#   conexão) contam; CIRCUITO_FALHAS seguidos abrem o circuito.
+# - ABERTO: as chamadas falham na hora com FirestoreIndisponivel (sem esperar
+#   timeout). A espera dobra a cada reabertura (CIRCUITO_ESPERA_BASE até
+#   CIRCUITO_ESPERA_MAX). Erro de quota (RESOURCE_EXHAUSTED / 429) abre na
+#   hora e a próxima tentativa é na virada da quota (meia-noite do Pacífico)
+#   ou em CIRCUITO_QUOTA_SONDA segundos, o que vier antes.
+# - MEIO-ABERTO: passada a espera, UMA chamada de sonda vai ao Firestore; se
+#   der certo o circuito fecha, senão reabre.
+#
+# Com o circuito aberto, histórico/dashboard servem o último cache
+# (mesmo vencido), os índices de veículos/motoristas continuam valendo e as
+# rotas que falharem respondem 503 com Retry-After. A auditoria continua indo
+# para o spool local. O estado aparece em /health.
+
+CIRCUITO_FALHAS = int(os.getenv('CIRCUITO_FALHAS', '3'))
+CIRCUITO_ESPERA_BASE = float(os.getenv('CIRCUITO_ESPERA_BASE', '5'))
+CIRCUITO_ESPERA_MAX = float(os.getenv('CIRCUITO_ESPERA_MAX', '300'))
+CIRCUITO_QUOTA_SONDA = float(os.getenv('CIRCUITO_QUOTA_SONDA', '900'))
+
+# Erros que indicam Firestore fora do ar (os demais mostram que ele respondeu)
+_ERROS_INDISPONIBILIDADE = (
+    gexc.ServiceUnavailable, gexc.DeadlineExceeded, gexc.InternalServerError,
+    gexc.RetryError, ConnectionError, TimeoutError,
+)
+
+
+class FirestoreIndisponivel(gexc.ServiceUnavailable):
+    """Chamada recusada pelo circuito aberto (sem ir ao Firestore)."""
+
+    def __init__(self, tentar_em):
+        self.tentar_em = tentar_em
+        super().__init__(f'Firestore indisponível (circuito aberto até {tentar_em.isoformat()})')
+
+
+def _proxima_virada_quota(agora=None):
+    """Próxima meia-noite do Pacífico (quando a quota diária do Firestore zera)."""
+    agora = (agora or datetime.now(timezone.utc)).astimezone(USO_FIRESTORE_TZ)
+    amanha = (agora + timedelta(days=1)).date()
+    virada = datetime(amanha.year, amanha.month, amanha.day, tzinfo=USO_FIRESTORE_TZ)
+    return virada.astimezone(timezone.utc)
+
+
+def _erro_de_quota(e):
+    """Só pelo tipo/código da exceção: o texto pode conter placas, caminhos ou IDs com '429'."""
+    if isinstance(e, gexc.ResourceExhausted):
+        return True
+    return isinstance(e, gexc.GoogleAPICallError) and e.code == 429
+
+
+def erro_firestore_indisponivel(e):
+    """True para falhas de disponibilidade/quota (inclui o circuito aberto)."""
+    return _erro_de_quota(e) or isinstance(e, _ERROS_INDISPONIBILIDADE)
+
+
+class CircuitoFirestore:
+    """Circuit breaker com sonda única no meio-aberto e espera exponencial."""
+
+    def __init__(self, falhas=CIRCUITO_FALHAS):
+        self.limite_falhas = falhas
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.estado = 'fechado'          # fechado | aberto | meio_aberto
+        self.motivo = None               # quota | indisponivel
+        self.falhas = 0                  # falhas seguidas
+        self.aberturas = 0               # reaberturas seguidas (espera exponencial)
+        self.aberto_desde = None
+        self.tentar_em = None
+        self.ultimo_erro = None
+        self.recusadas = 0
+        self._sonda = None               # thread que está fazendo a sonda
+        self._sonda_desde = 0.0
+
+    def antes(self):
+        """Chamado antes de cada operação; levanta FirestoreIndisponivel se aberto."""
+        if self.estado == 'fechado':
+            return
+        with self._lock:
+            if self.estado == 'fechado':
+                return
+            if self.estado == 'aberto' and datetime.now(timezone.utc) >= self.tentar_em:
+                self.estado = 'meio_aberto'
+                self._sonda = None
+            # Sonda sem resultado (consulta nunca iterada) não trava o circuito
+            if self.estado == 'meio_aberto' and (
+                    self._sonda in (None, threading.get_ident()) or time.time() - self._sonda_desde > 30):
+                if self._sonda != threading.get_ident():
+                    self._sonda = threading.get_ident()
+                    self._sonda_desde = time.time()
+                return
+            self.recusadas += 1
+            tentar_em = self.tentar_em
+        self._local.recusou = True
+        raise FirestoreIndisponivel(tentar_em)
+
+    def sucesso(self):
+        if self.estado == 'fechado' and not self.falhas:
+            return
+        with self._lock:
+            if self.estado != 'fechado':
+                print(f'[OK] Firestore respondeu: circuito fechado (estava aberto desde {self.aberto_desde.isoformat()})')
+            self.estado = 'fechado'
+            self.motivo = None
+            self.falhas = 0
+            self.aberturas = 0
+            self.aberto_desde = self.tentar_em = None
+            self._sonda = None
+
+    def falha(self, e):
+        """Registra o erro de uma operação; só erros de disponibilidade/quota contam."""
+        quota = _erro_de_quota(e)
+        if not erro_firestore_indisponivel(e):
+            self.sucesso()  # o Firestore respondeu (NotFound, índice ausente...)
+            return
+        with self._lock:
+            self.falhas += 1
+            self.ultimo_erro = str(e)[:300]
+            if not quota and self.estado == 'fechado' and self.falhas < self.limite_falhas:
+                return
+            agora = datetime.now(timezone.utc)
+            self.aberturas += 1
+            if quota:
+                espera = min((_proxima_virada_quota(agora) - agora).total_seconds(), CIRCUITO_QUOTA_SONDA)
+            else:
+                espera = min(CIRCUITO_ESPERA_BASE * 2 ** (self.aberturas - 1), CIRCUITO_ESPERA_MAX)
+            if self.estado == 'fechado':
+                self.aberto_desde = agora
+            self.estado = 'aberto'
+            self.motivo = 'quota' if quota else 'indisponivel'
+            self.tentar_em = agora + timedelta(seconds=espera)
+            self._sonda = None
+        print(f'[ERRO] Firestore {self.motivo}: circuito aberto, nova tentativa em {espera:.0f}s ({self.ultimo_erro})')
+
+    def disponivel(self):
+        """True se uma chamada agora iria ao Firestore (fechado ou hora da sonda)."""
+        return self.estado == 'fechado' or (
+            self.estado == 'aberto' and datetime.now(timezone.utc) >= self.tentar_em) or (
+            self.estado == 'meio_aberto' and self._sonda is None)
+
+    def recusar(self):
+        """Recusa na hora, sem ir ao Firestore (ex.: dado que depende dele nunca carregou)."""
+        self._local.recusou = True
+        raise FirestoreIndisponivel(self.tentar_em or datetime.now(timezone.utc) + timedelta(seconds=CIRCUITO_ESPERA_BASE))
+
+    def iniciar_requisicao(self):
+        self._local.recusou = False
+
+    def recusou_nesta_requisicao(self):
+        return getattr(self._local, 'recusou', False)
+
+    def situacao(self):
+        with self._lock:
+            return {
+                'estado': self.estado,
+                'motivo': self.motivo,
+                'falhas_seguidas': self.falhas,
+                'aberto_desde': self.aberto_desde.isoformat() if self.aberto_desde else None,
+                'proxima_tentativa': self.tentar_em.isoformat() if self.tentar_em else None,
+                'proxima_virada_quota': _proxima_virada_quota().isoformat(),
+                'chamadas_recusadas': self.recusadas,
+                'ultimo_erro': self.ultimo_erro,
+            }
+
+
+circuito_firestore = CircuitoFirestore()
+
+
+def firestore_disponivel():
+    """True se o circuito do Firestore deixa a chamada passar agora."""
+    return bool(db) and circuito_firestore.disponivel()
+
+
+def servir_cache_vencido():
+    """Cache vencido vale quando o Firestore está caro (economia) ou fora do ar."""
+    return firestore_em_economia() or not firestore_disponivel()
+
+
+def _real(obj):
+    return obj._alvo if isinstance(obj, _Contabilizado) else obj
+
+
+def _kwargs_reais(kwargs):
+    if kwargs.get('transaction') is not None:
+        kwargs['transaction'] = _real(kwargs['transaction'])
+    return kwargs
+
+
+def _cursor_real(valores):
+    """Valores de start_after/start_at/...: o SDK só aceita DocumentReference real em __name__."""
+    if isinstance(valores, dict):
+        return {campo: _real(valor) for campo, valor in valores.items()}
+    if isinstance(valores, (list, tuple)):
+        return [_real(valor) for valor in valores]
+    return _real(valores)
+
+
+class _Contabilizado:
+    """Base dos proxies: repassa ao objeto real tudo o que não é contado.
+
+    As operações que vão ao Firestore passam por _executar (circuit breaker).
+    """
+
+    __slots__ = ('_alvo', '_uso', '_circuito')
+
+    def __init__(self, alvo, uso, circuito=None):
+        object.__setattr__(self, '_alvo', alvo)
+        object.__setattr__(self, '_uso', uso)
+        object.__setattr__(self, '_circuito', circuito)
+
+    def __getattr__(self, nome):
+        return getattr(self._alvo, nome)
+
+    def __setattr__(self, nome, valor):
+        setattr(self._alvo, nome, valor)
+
+    def __eq__(self, outro):
+        return self._alvo == _real(outro)
+
+    def __hash__(self):
+        return hash(self._alvo)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self._alvo!r})'
+
+    def _filho(self, classe, alvo, **kwargs):
+        return classe(alvo, self._uso, self._circuito, **kwargs)
+
+    def _executar(self, funcao, *args, **kwargs):
+        circuito = self._circuito
+        if circuito is None:
+            return funcao(*args, **kwargs)
+        circuito.antes()
+        try:
+            resultado = funcao(*args, **kwargs)
+        except Exception as e:
+            circuito.falha(e)
+            raise
+        circuito.sucesso()
+        return resultado
+
+    def _contar_leituras(self, docs):
+        # Consultas em streaming: o erro (e o sucesso) só aparece ao iterar
+        circuito = self._circuito
+        lidos = 0
+        try:
+            for doc in docs:
+                lidos += 1
+                yield doc
+        except Exception as e:
+            if circuito:
+                circuito.falha(e)
+            raise
+        else:
+            if circuito:
+                circuito.sucesso()
+        finally:
+            self._uso.registrar(leituras=max(1, lidos))
+
+
+class ReferenciaContabilizada(_Contabilizado):
+    __slots__ = ()
+
+    def get(self, *args, **kwargs):
+        doc = self._executar(self._alvo.get, *args, **_kwargs_reais(kwargs))
+        self._uso.registrar(leituras=1)
+        return doc
+
+    def set(self, *args, **kwargs):
+        resultado = self._executar(self._alvo.set, *args, **kwargs)
+        self._uso.registrar(escritas=1)
+        return resultado
+
+    def update(self, *args, **kwargs):
+        resultado = self._executar(self._alvo.update, *args, **kwargs)
+        self._uso.registrar(escritas=1)
+        return resultado
+
+    def create(self, *args, **kwargs):
+        resultado = self._executar(self._alvo.create, *args, **kwargs)
+        self._uso.registrar(escritas=1)
+        return resultado
+
+    def delete(self, *args, **kwargs):
+        resultado = self._executar(self._alvo.delete, *args, **kwargs)
+        self._uso.registrar(exclusoes=1)
+        return resultado
+
+    def collection(self, *args, **kwargs):
+        return self._filho(ConsultaContabilizada, self._alvo.collection(*args, **kwargs))
+
+
+class ConsultaContabilizada(_Contabilizado):
+    """CollectionReference ou Query: os métodos encadeados devolvem outro proxy."""
+
+    __slots__ = ()
+
+    def _encadear(nome, cursor=False):
+        def metodo(self, *args, **kwargs):
+            if cursor:
+                args = tuple(_cursor_real(valor) for valor in args)
+            return self._filho(ConsultaContabilizada, getattr(self._alvo, nome)(*args, **kwargs))
+        metodo.__name__ = nome
+        return metodo
+
+    where = _encadear('where')
+    order_by = _encadear('order_by')
+    limit = _encadear('limit')
+    limit_to_last = _encadear('limit_to_last')
+    offset = _encadear('offset')
+    select = _encadear('select')
+    start_at = _encadear('start_at', cursor=True)
+    start_after = _encadear('start_after', cursor=True)
+    end_at = _encadear('end_at', cursor=True)
+    end_before = _encadear('end_before', cursor=True)
+    del _encadear
+
+    def document(self, *args, **kwargs):
+        return self._filho(ReferenciaContabilizada, self._alvo.document(*args, **kwargs))
+
+    def add(self, *args, **kwargs):
+        momento, ref = self._executar(self._alvo.add, *args, **kwargs)
+        self._uso.registrar(escritas=1)
+        return momento, self._filho(ReferenciaContabilizada, ref)
+
+    def stream(self, *args, **kwargs):
+        if self._circuito:
+            self._circuito.antes()
+        return self._contar_leituras(self._alvo.stream(*args, **_kwargs_reais(kwargs)))
+
+    def get(self, *args, **kwargs):
+        docs = self._executar(self._alvo.get, *args, **_kwargs_reais(kwargs))
+        self._uso.registrar(leituras=max(1, len(docs)))
+        return docs
+
+    def list_documents(self, *args, **kwargs):
+        if self._circuito:
+            self._circuito.antes()
+        for ref in self._contar_leituras(self._alvo.list_documents(*args, **kwargs)):
+            yield self._filho(ReferenciaContabilizada, ref)
+
+    def count(self, *args, **kwargs):
+        return self._filho(AgregacaoContabilizada, self._alvo.count(*args, **kwargs), contagem=True)
+
+    def sum(self, *args, **kwargs):
+        return self._filho(AgregacaoContabilizada, self._alvo.sum(*args, **kwargs))
+
+    def avg(self, *args, **kwargs):
+        return self._filho(AgregacaoContabilizada, self._alvo.avg(*args, **kwargs))
+
+    def on_snapshot(self, callback):
+        uso = self._uso
+        primeiro = [True]
+
+        def contar(docs, changes, read_time):
+            with uso.rotina(f'listener: {threading.current_thread().name}'):
+                uso.registrar(leituras=len(changes) or int(primeiro[0]))
+            primeiro[0] = False
+            return callback(docs, changes, read_time)
+
+        return self._alvo.on_snapshot(contar)
+
+
+class AgregacaoContabilizada(_Contabilizado):
+    """count()/sum()/avg(): 1 leitura a cada 1000 entradas de índice (mínimo 1).
+
+    Para sum/avg o número de entradas lidas não é conhecido; conta 1 leitura.
+    """
+
+    __slots__ = ('_contagem',)
+
+    def __init__(self, alvo, uso, circuito=None, contagem=False):
+        super().__init__(alvo, uso, circuito)
+        object.__setattr__(self, '_contagem', contagem)
+
+    def get(self, *args, **kwargs):
+        resultados = self._executar(self._alvo.get, *args, **_kwargs_reais(kwargs))
+        leituras = 1
+        if self._contagem:
+            contados = sum(int(r.value or 0) for linha in resultados for r in linha)
+            leituras = max(1, -(-contados // 1000))
+        self._uso.registrar(leituras=leituras)
+        return resultados
+
+
+class LoteContabilizado(_Contabilizado):
+    """WriteBatch/Transaction: as escritas só contam quando o commit acontece."""
+
+    __slots__ = ('_escritas', '_exclusoes')
+
+    def __init__(self, alvo, uso, circuito=None):
+        super().__init__(alvo, uso, circuito)
+        self._limpar()
+
+    def _limpar(self):
+        object.__setattr__(self, '_escritas', 0)
+        object.__setattr__(self, '_exclusoes', 0)
+
+    def _efetivar(self):
+        self._uso.registrar(escritas=self._escritas, exclusoes=self._exclusoes)
+        self._limpar()
+
+    def set(self, ref, *args, **kwargs):
+        self._alvo.set(_real(ref), *args, **kwargs)
+        object.__setattr__(self, '_escritas', self._escritas + 1)
+        return self
+
+    def update(self, ref, *args, **kwargs):
+        self._alvo.update(_real(ref), *args, **kwargs)
+        object.__setattr__(self, '_escritas', self._escritas + 1)
+        return self
+
+    def create(self, ref, *args, **kwargs):
+        self._alvo.create(_real(ref), *args, **kwargs)
+        object.__setattr__(self, '_escritas', self._escritas + 1)
+        return self
+
+    def delete(self, ref, *args, **kwargs):
+        self._alvo.delete(_real(ref), *args, **kwargs)
+        object.__setattr__(self, '_exclusoes', self._exclusoes + 1)
+        return self
+
+    def get(self, ref_ou_consulta, *args, **kwargs):
+        # Transaction.get: o proxy da consulta conta as leituras
+        return ref_ou_consulta.get(*args, transaction=self._alvo, **kwargs)
+
+    def commit(self, *args, **kwargs):
+        resultado = self._executar(self._alvo.commit, *args, **kwargs)
+        self._efetivar()
+        return resultado
+
+    # Usados por firestore.transactional (commit/novas tentativas da transação)
+    def _begin(self, *args, **kwargs):
+        return self._executar(self._alvo._begin, *args, **kwargs)
+
+    def _commit(self, *args, **kwargs):
+        resultado = self._executar(self._alvo._commit, *args, **kwargs)
+        self._efetivar()
+        return resultado
+
+    def _clean_up(self, *args, **kwargs):
+        self._limpar()
+        return self._alvo._clean_up(*args, **kwargs)
+
+    def _rollback(self, *args, **kwargs):
+        self._limpar()
+        return self._alvo._rollback(*args, **kwargs)
+
+
+class ClienteContabilizado(_Contabilizado):
+    """Cliente do Firestore que conta leituras/escritas em `uso` (UsoFirestore)
+    e passa as chamadas pelo `circuito` (CircuitoFirestore)."""
+
+    __slots__ = ()
+
+    def collection(self, *args, **kwargs):
+        return self._filho(ConsultaContabilizada, self._alvo.collection(*args, **kwargs))
+
+    def collection_group(self, *args, **kwargs):
+        return self._filho(ConsultaContabilizada, self._alvo.collection_group(*args, **kwargs))
+
+    def document(self, *args, **kwargs):
+        return self._filho(ReferenciaContabilizada, self._alvo.document(*args, **kwargs))
+
+    def batch(self, *args, **kwargs):
+        return self._filho(LoteContabilizado, self._alvo.batch(*args, **kwargs))
+
+    def transaction(self, *args, **kwargs):
+        return self._filho(LoteContabilizado, self._alvo.transaction(*args, **kwargs))
+
+    def get_all(self, references, *args, **kwargs):
+        refs = [_real(ref) for ref in references]
+        if self._circuito:
+            self._circuito.antes()
+        return self._contar_leituras(self._alvo.get_all(refs, *args, **_kwargs_reais(kwargs)))
+
+
+if db:
+    db = ClienteContabilizado(db, uso_firestore, circuito_firestore)
+
+
+@app.before_request
+def _iniciar_circuito_requisicao():
+    circuito_firestore.iniciar_requisicao()
+
+
+@app.after_request
+def _responder_circuito_aberto(response):
+    """Erro 500 causado pelo circuito aberto vira 503 com Retry-After."""
+    if response.status_code != 500 or not circuito_firestore.recusou_nesta_requisicao():
+        return response
+    tentar_em = circuito_firestore.tentar_em
+    espera = (tentar_em - datetime.now(timezone.utc)).total_seconds() if tentar_em else CIRCUITO_ESPERA_BASE
+    if request.path.startswith('/api/'):
+        response = jsonify({
+            "error": "Banco de dados temporariamente indisponível. Tente novamente em instantes.",
+            "firestore_indisponivel": True,
+            "tentar_em": tentar_em.isoformat() if tentar_em else None,
+        })
+    response.status_code = 503
+    response.headers['Retry-After'] = str(max(1, int(espera)))
+    return response
+
+@app.before_request
+def _iniciar_uso_firestore():
+    """Abre o contador da requisição e aplica o modo economia às rotas pesadas."""
+    regra = request.url_rule.rule if request.url_rule else '(sem rota)'
+    uso_firestore.iniciar(f'{request.method} {regra}')
+    if request.endpoint in ORCAMENTO_ENDPOINTS_PESADOS and firestore_em_economia():
+        mensagem = ("Orçamento diário de leituras/escritas do Firestore atingido. "
+                    "Relatórios e reconstruções voltam a funcionar na virada do dia da quota.")
+        if request.path.startswith('/api/'):
+            return jsonify({"error": mensagem, "modo_economia": True}), 503
+        return mensagem, 503
+    return None
+
+
+@app.teardown_request
+def _finalizar_uso_firestore(exc=None):
+    # teardown roda depois do streaming da resposta (PDFs em blocos)
+    uso_firestore.finalizar()
+
+
+@app.route('/api/admin/firestore/uso', methods=['GET'])
+@requires_auth
+def get_uso_firestore():
+    """Leituras/escritas/exclusões do dia (?dia=YYYY-MM-DD), por rota, e o orçamento."""
+    dia = request.args.get('dia')
+    if dia and not re.match(r'^\d{4}-\d{2}-\d{2}$', dia):
+        return jsonify({"error": "Use o dia no formato YYYY-MM-DD."}), 400
     try:
-        msg = str(e).lower()
-        if 'quota' in msg or 'quota exceeded' in msg or '429' in msg:
-            FIRESTORE_AVAILABLE = False
-            print('Firestore marcado como indisponível devido a erro de quota/excesso de uso.')
-            return True
-    except Exception:
-        pass
-    return False
+        return jsonify(uso_firestore.resumo(dia)), 200
+    except Exception as e:
+        print(f"Erro em get_uso_firestore: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+def get_veiculo_categoria(placa, default='Outros'):
+    """Categoria do veículo a partir do índice (sem ir ao Firestore)."""
+    veiculo = veiculos_index.get(placa) if placa else None
+    if not veiculo:
+        return default
+    return veiculo.get('categoria', default) or default
+
 
 @app.template_filter('formatar_data')
 def formatar_data_filter(iso_string):
@@ -417,10 +1793,8 @@ def formatar_data_filter(iso_string):
 # --- Rota Principal para servir a página do motorista ---
 @app.route('/')
 def index():
-    # Se o Firestore estiver indisponível (quota excedida), exibimos página de manutenção
-    if not FIRESTORE_AVAILABLE:
-        return render_template('maintenance.html'), 503
-
+    # Com o Firestore fora do ar a página continua funcionando a partir dos
+    # índices em memória; manutenção só se eles nunca foram carregados
     veiculos = []
     veiculos_completos = []  # Lista com objetos {placa, modelo}
     veiculos_agrupados = {
@@ -434,9 +1808,7 @@ def index():
     motoristas = []
     if db:
         try:
-            veiculos_ref = db.collection('veiculos').stream()
-            for doc in veiculos_ref:
-                data = doc.to_dict()
+            for data in veiculos_index.all():
                 placa = data.get('placa')
                 if not placa:
                     continue
@@ -473,10 +1845,8 @@ def index():
                 'Van': [],
                 'Outros': []
             }
-            motoristas_ref = db.collection('motoristas').stream()
             motoristas = []
-            for doc in motoristas_ref:
-                data = doc.to_dict()
+            for data in motoristas_index.all():
                 nome = data.get('nome')
                 if nome:
                     # Verifica visibilidade (padrão: True)
@@ -494,7 +1864,6 @@ def index():
                 motoristas_agrupados[secao].sort()
 
         except Exception as e:
-            mark_firestore_unavailable_if_quota(e)
             print(f"Erro ao buscar veículos ou motoristas: {e}")
             return render_template('maintenance.html'), 503
 
@@ -582,9 +1951,6 @@ def logout():
 @app.route('/dashboard')
 @requires_auth
 def dashboard():
-    if not FIRESTORE_AVAILABLE:
-        return render_template('maintenance.html'), 503
-    
     # Passa o tipo de usuário para o template
     user_type = session.get('user_type', 'operador')
     return render_template('dashboard.html', user_type=user_type)
@@ -592,23 +1958,21 @@ def dashboard():
 @app.route('/motorista/<nome>')
 @requires_auth
 def motorista_detalhes(nome):
-    if not FIRESTORE_AVAILABLE:
+    if db and not firestore_disponivel():
         return render_template('maintenance.html'), 503
     if not db:
         return "Erro: Conexão com o banco de dados não estabelecida.", 500
     try:
-        # Busca os detalhes do motorista
-        motoristas_ref = db.collection('motoristas')
-        motorista_query = motoristas_ref.where(filter=firestore.FieldFilter('nome', '==', nome)).limit(1).stream()
-        motorista = next(motorista_query, None)
+        # Busca os detalhes do motorista (cadastro em memória)
+        motorista = motoristas_index.get(nome)
         if not motorista:
             return "Motorista não encontrado.", 404
 
-        motorista_data = serialize_doc(motorista.to_dict())
+        motorista_data = serialize_doc(motorista)
 
-        # Busca o histórico de viagens do motorista
+        # Busca o histórico de viagens do motorista (pelo nome como está cadastrado)
         saidas_ref = db.collection('saidas')
-        viagens_query = saidas_ref.where(filter=firestore.FieldFilter('motorista', '==', nome)).order_by('timestampSaida', direction=firestore.Query.DESCENDING).stream()
+        viagens_query = saidas_ref.where(filter=firestore.FieldFilter('motorista', '==', motorista['nome'])).order_by('timestampSaida', direction=firestore.Query.DESCENDING).stream()
         viagens = [serialize_doc(doc.to_dict()) for doc in viagens_query]
 
         # Calcula estatísticas
@@ -642,29 +2006,33 @@ def api_cancelar():
         return jsonify({"error": "Campo 'veiculo' é obrigatório."}), 400
     veiculo = normalize_plate(veiculo)
     try:
-        saidas_ref = db.collection('saidas')
-        # Firestore may require a composite index for filtering by vehicle+status+order_by.
-        # To avoid forcing an index during dev, we fetch documents with status 'em_curso'
-        # (single-field indexed) and filter/sort in Python. This is acceptable since
-        # the number of in-progress trips is small in normal operation.
-        query = saidas_ref.where(filter=firestore.FieldFilter('status', '==', 'em_curso'))
-        viagens_cursor = list(query.stream())
-        # Filter by normalized vehicle and find the one with the latest timestampSaida
-        viagens_filtradas = []
-        for doc in viagens_cursor:
-            data_doc = doc.to_dict() or {}
-            if normalize_plate(data_doc.get('veiculo', '') or '') == veiculo:
-                viagens_filtradas.append((doc, data_doc))
-        if not viagens_filtradas:
+        # In-progress trips come from the in-memory replica (no reads); the newest
+        # one for this (normalized) plate is the one being cancelled.
+        try:
+            viagem = saidas_replica.em_curso_do_veiculo(veiculo)
+        except Exception as e:
+            print(f" Réplica de saídas indisponível ({e}), consultando a trava do veículo")
+            viagem = None
+        if not viagem:
+            # A trip started moments ago (or by another process) may not be in the
+            # replica yet: the saidas_ativas lock is authoritative (1 read).
+            trava = _trava_saida_ref(veiculo).get()
+            if trava.exists and (trava.to_dict() or {}).get('saida_id'):
+                viagem = (trava.get('saida_id'), trava.to_dict())
+        if not viagem:
+            return jsonify({"error": "Nenhum registro em curso encontrado para este veículo."}), 404
+        viagem_id, _ = viagem
+        # Delete the document as requested by the user (cancel should remove the viagem).
+        # Same transaction releases the vehicle lock and removes it from the monthly rollup.
+        viagem_data, _, erro = escrever_saida(
+            viagem_id, excluir=True,
+            validar=lambda atual: None if atual.get('status') == 'em_curso' else 'finalizada'
+        )
+        if viagem_data is None or erro:
             return jsonify({"error": "Nenhum registro em curso encontrado para este veículo."}), 404
-        # Sort by timestampSaida descending (newest first)
-        viagens_filtradas.sort(key=lambda pair: pair[1].get('timestampSaida') or '', reverse=True)
-        viagem_doc = viagens_filtradas[0][0]
-        # Delete the document as requested by the user (cancel should remove the viagem)
-        viagem_doc.reference.delete()
         
-        # Invalida cache do histórico após cancelamento
-        invalidate_historico_cache()
+        # Corrige só o cache do mês/veículo/motorista da viagem cancelada
+        invalidar_caches_saida(saida_antiga=viagem_data, saida_id=viagem_id)
         
         return jsonify({"message": "Viagem cancelada."}), 200
     except Exception as e:
@@ -675,7 +2043,7 @@ def api_cancelar():
 @app.route('/veiculos/<placa>')
 @requires_auth
 def veiculo_detalhes(placa):
-    if not FIRESTORE_AVAILABLE:
+    if db and not firestore_disponivel():
         return render_template('maintenance.html'), 503
     if not db:
         return "Erro: Conexão com o banco de dados não estabelecida.", 500
@@ -707,14 +2075,9 @@ def veiculo_detalhes(placa):
                 chegada = datetime.fromisoformat(viagem['timestampChegada'])
                 total_horas += (chegada - saida).total_seconds() / 3600
 
-        # Buscar timestamp do veículo
-        veiculos_ref = db.collection('veiculos')
-        veiculo_query = veiculos_ref.where(filter=firestore.FieldFilter('placa', '==', placa)).limit(1).stream()
-        veiculo = next(veiculo_query, None)
-        timestamp = None
-        if veiculo:
-            veiculo_data = veiculo.to_dict()
-            timestamp = veiculo_data.get('timestamp')
+        # Buscar timestamp do veículo (índice em memória)
+        veiculo = veiculos_index.get(placa)
+        timestamp = veiculo.get('timestamp') if veiculo else None
 
         return render_template('veiculo_detalhes.html', 
                              placa=placa,
@@ -728,9 +2091,152 @@ def veiculo_detalhes(placa):
         return "Ocorreu um erro ao buscar os detalhes do veículo.", 500
 
 
+# ==========================================
+# [LOCK] CHAVES DE IDEMPOTÊNCIA (REGISTROS DE SAÍDA / CHEGADA / ABASTECIMENTO)
+# ==========================================
+# O cliente manda o header Idempotency-Key em cada registro, e a mesma chave
+# em toques duplos e novas tentativas. A primeira requisição com a chave é
+# executada e a resposta fica guardada numa tabela SQLite local com validade
+# (IDEMPOTENCIA_TTL). As seguintes recebem a mesma resposta, com o header
+# Idempotent-Replayed: true, sem nenhuma leitura no Firestore.
+# - Se a chave ainda está em andamento, a repetição espera até
+#   IDEMPOTENCIA_ESPERA segundos pela resposta; depois disso responde 409.
+# - A mesma chave com outro corpo responde 422.
+# - Respostas 5xx não são guardadas: a nova tentativa executa de novo.
+# A chave também vira o ID dos documentos gravados (id_da_operacao). Assim,
+# nem um reinício no meio da requisição duplica a saída ou o abastecimento.
+
+IDEMPOTENCIA_PATH = os.getenv('IDEMPOTENCIA_PATH', os.path.join(tempfile.gettempdir(), 'frota_sanemar_idempotencia.sqlite3'))
+IDEMPOTENCIA_TTL = int(os.getenv('IDEMPOTENCIA_TTL', '86400'))
+IDEMPOTENCIA_ESPERA = float(os.getenv('IDEMPOTENCIA_ESPERA', '10'))
+IDEMPOTENCIA_ABANDONO = 120  # reserva sem resposta há mais que isso: processo caiu no meio
+
+
+class RespostasIdempotentes:
+    """Respostas das rotas de registro guardadas por chave (SQLite com validade)."""
+
+    def __init__(self, path=IDEMPOTENCIA_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS respostas ('
+                'chave TEXT PRIMARY KEY, impressao TEXT NOT NULL, status INTEGER, corpo TEXT, '
+                'criado_em REAL NOT NULL, expira_em REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_respostas_expira ON respostas(expira_em)')
+
+    def _conn(self):
+        # Uma conexão por thread (sqlite3 não compartilha conexões entre threads)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def _ler(self, chave):
+        row = self._conn().execute(
+            'SELECT impressao, status, corpo FROM respostas WHERE chave = ?', (chave,)
+        ).fetchone()
+        return {'impressao': row[0], 'status': row[1], 'corpo': row[2]} if row else None
+
+    def reservar(self, chave, impressao):
+        """Reserva a chave para esta requisição.
+
+        Retorna None se reservou (a rota deve executar) ou o registro existente
+        (impressao, status, corpo; status None = ainda em andamento).
+        """
+        conn = self._conn()
+        agora = time.time()
+        conn.execute('DELETE FROM respostas WHERE expira_em <= ?', (agora,))
+        cur = conn.execute(
+            'INSERT OR IGNORE INTO respostas (chave, impressao, criado_em, expira_em) VALUES (?, ?, ?, ?)',
+            (chave, impressao, agora, agora + IDEMPOTENCIA_TTL)
+        )
+        if cur.rowcount:
+            return None
+        # Reserva abandonada (processo reiniciado no meio da requisição)
+        cur = conn.execute(
+            'UPDATE respostas SET criado_em = ? WHERE chave = ? AND impressao = ? AND status IS NULL AND criado_em < ?',
+            (agora, chave, impressao, agora - IDEMPOTENCIA_ABANDONO)
+        )
+        if cur.rowcount:
+            return None
+        return self._ler(chave)
+
+    def esperar(self, chave, espera=IDEMPOTENCIA_ESPERA):
+        """Espera a resposta de uma chave em andamento (ou o fim da espera)."""
+        limite = time.time() + espera
+        registro = self._ler(chave)
+        while registro and registro['status'] is None and time.time() < limite:
+            time.sleep(0.1)
+            registro = self._ler(chave)
+        return registro
+
+    def gravar(self, chave, status, corpo):
+        self._conn().execute(
+            'UPDATE respostas SET status = ?, corpo = ?, expira_em = ? WHERE chave = ?',
+            (status, corpo, time.time() + IDEMPOTENCIA_TTL, chave)
+        )
+
+    def liberar(self, chave):
+        self._conn().execute('DELETE FROM respostas WHERE chave = ? AND status IS NULL', (chave,))
+
+
+respostas_idempotentes = RespostasIdempotentes()
+
+
+def idempotente(f):
+    """Executa a rota uma vez por Idempotency-Key e repete a resposta guardada."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        chave = (request.headers.get('Idempotency-Key') or '').strip()
+        if not chave:
+            return f(*args, **kwargs)
+        if len(chave) > 200:
+            return jsonify({"error": "Idempotency-Key muito longa (máximo de 200 caracteres)."}), 400
+
+        chave_rota = f'{request.endpoint}:{chave}'
+        impressao = hashlib.sha256(request.get_data()).hexdigest()
+        try:
+            registro = respostas_idempotentes.reservar(chave_rota, impressao)
+            if registro and registro['status'] is None and registro['impressao'] == impressao:
+                registro = respostas_idempotentes.esperar(chave_rota)
+        except Exception as e:
+            # Sem o SQLite a rota segue sem a proteção (os IDs derivados da chave continuam)
+            print(f" Chaves de idempotência indisponíveis ({e})")
+            return f(*args, **kwargs)
+
+        if registro:
+            if registro['impressao'] != impressao:
+                return jsonify({"error": "Idempotency-Key já usada com outro conteúdo."}), 422
+            if registro['status'] is None:
+                return jsonify({"error": "Registro com esta chave ainda em processamento. Tente novamente."}), 409
+            resposta = Response(registro['corpo'], status=registro['status'], mimetype='application/json')
+            resposta.headers['Idempotent-Replayed'] = 'true'
+            return resposta
+
+        try:
+            resposta = make_response(f(*args, **kwargs))
+        except Exception:
+            respostas_idempotentes.liberar(chave_rota)
+            raise
+        try:
+            if resposta.status_code < 500 and resposta.is_json:
+                respostas_idempotentes.gravar(chave_rota, resposta.status_code, resposta.get_data(as_text=True))
+            else:
+                respostas_idempotentes.liberar(chave_rota)
+        except Exception as e:
+            print(f" Erro ao guardar resposta idempotente ({e})")
+        return resposta
+    return decorated
+
+
 # --- API Endpoints ---
 
 @app.route('/api/saida', methods=['POST'])
+@idempotente
 def api_saida():
     if not db:
         return jsonify({"error": "Conexão com o banco de dados não foi estabelecida."}), 500
@@ -760,9 +2266,28 @@ def api_saida():
     if not all([veiculo, motorista, solicitante, trajeto]):
         return jsonify({"error": "Todos os campos de saída são obrigatórios."}), 400
 
-    response_message = handle_saida(veiculo, motorista, solicitante, trajeto, horario, veiculo_categoria, motorista_secao)
-
-    # Lógica de resposta baseada na mensagem de retorno
+    # Firestore fora do ar: a saída vai para a fila offline com a chave de idempotência
+    chave = chave_idempotencia()
+    agora = datetime.now(timezone.utc)
+    dados_fila = {
+        'motorista': motorista, 'solicitante': solicitante, 'trajeto': trajeto, 'horario': horario,
+        'veiculo_categoria': veiculo_categoria, 'motorista_secao': motorista_secao,
+        'registrado_em': agora.isoformat(),
+    }
+    try:
+        if fila_offline.deve_enfileirar():
+            if fila_offline.viagem_prevista(veiculo) not in (None, VIAGEM_DESCONHECIDA):
+                return jsonify({"error": f"O veículo {veiculo} já está em curso e não pode sair novamente."}), 409
+            return responder_fila_offline('saida', veiculo, dados_fila, chave)
+        response_message = handle_saida(veiculo, motorista, solicitante, trajeto, horario, veiculo_categoria,
+                                         motorista_secao, agora=agora, saida_id=id_da_operacao(chave))
+    except Exception as e:
+        if not erro_firestore_indisponivel(e):
+            raise
+        print(f" Firestore indisponível na saída ({e}), guardando na fila offline")
+        return responder_fila_offline('saida', veiculo, dados_fila, chave)
+
+    # Lógica de resposta baseada na mensagem de retorno
     if "sucesso" in response_message:
         return jsonify({"message": response_message}), 200
     elif "já está em curso" in response_message:
@@ -772,6 +2297,7 @@ def api_saida():
 
 
 @app.route('/api/chegada', methods=['POST'])
+@idempotente
 def api_chegada():
     if not db:
         return jsonify({"error": "Conexão com o banco de dados não foi estabelecida."}), 500
@@ -791,11 +2317,29 @@ def api_chegada():
     if not veiculo:
         return jsonify({"error": "O campo veículo é obrigatório."}), 400
 
-    response_message = handle_chegada(veiculo, horario, litros=litros, odometro=odometro)
-    
-    # Invalida cache do histórico se foi sucesso
-    if "sucesso" in response_message:
-        invalidate_historico_cache()
+    # Firestore fora do ar: a chegada vai para a fila offline, presa à viagem que ela fecha
+    chave = chave_idempotencia()
+    agora = datetime.now(timezone.utc)
+
+    def _enfileirar():
+        viagem_id = fila_offline.viagem_prevista(veiculo)
+        if viagem_id is None:
+            return jsonify({"error": f"Nenhum registro de saída 'em curso' encontrado para o veículo {veiculo}."}), 404
+        return responder_fila_offline('chegada', veiculo, {
+            'horario': horario, 'litros': litros, 'odometro': odometro,
+            'viagem_id': None if viagem_id is VIAGEM_DESCONHECIDA else viagem_id,
+            'registrado_em': agora.isoformat(),
+        }, chave)
+
+    try:
+        if fila_offline.deve_enfileirar():
+            return _enfileirar()
+        response_message = handle_chegada(veiculo, horario, litros=litros, odometro=odometro, agora=agora)
+    except Exception as e:
+        if not erro_firestore_indisponivel(e):
+            raise
+        print(f" Firestore indisponível na chegada ({e}), guardando na fila offline")
+        return _enfileirar()
 
     if "sucesso" in response_message:
         return jsonify({"message": response_message}), 200
@@ -805,6 +2349,7 @@ def api_chegada():
         return jsonify({"error": response_message}), 500
 
 @app.route('/api/abastecimento', methods=['POST'])
+@idempotente
 def api_abastecimento():
     """Rota para registrar abastecimento rápido"""
     if not db:
@@ -828,42 +2373,29 @@ def api_abastecimento():
 
     if not all([placa, motorista, litros]):
         return jsonify({"error": "Placa, motorista e litros são obrigatórios."}), 400
-
     try:
-        # Verifica/Cria veículo se não existir
-        veiculos_ref = db.collection('veiculos')
-        veiculo_query = veiculos_ref.where(filter=firestore.FieldFilter('placa', '==', placa)).limit(1).stream()
-        veiculo_docs = list(veiculo_query)
-        
-        if not veiculo_docs:
-            # Cria veículo automaticamente
-            veiculos_ref.add({
-                'placa': placa,
-                'tipo': 'Não especificado',
-                'modelo': 'Não especificado',
-                'categoria': veiculo_categoria,
-                'visivel_para_motoristas': True,
-                'status_ativo': True,
-                'dataCadastro': firestore.SERVER_TIMESTAMP,
-                'viagens_totais': 0
-            })
-            print(f" Veículo {placa} criado automaticamente na categoria {veiculo_categoria}")
-        
-        # Registra no Firestore na coleção 'refuels' (mesma coleção dos gráficos)
-        refuels_ref = db.collection('refuels')
-        now_utc = datetime.now(timezone.utc)
-        
-        refuels_ref.add({
-            'veiculo': placa,  # Campo 'veiculo', não 'placa'
-            'motorista': motorista,
-            'litros': float(litros),
-            'odometro': int(odometro) if odometro else None,
-            'timestamp': now_utc
-        })
-        
-        print(f"[OK] Abastecimento registrado: {placa} - {litros}L")
-        return jsonify({"message": f"Abastecimento de {litros}L registrado para {placa}"}), 200
+        litros = float(litros)
+        odometro = int(odometro) if odometro else None
+    except (TypeError, ValueError):
+        return jsonify({"error": "Litros e odômetro devem ser números."}), 400
+
+    # Registra na coleção 'refuels' (mesma coleção dos gráficos) com ID derivado
+    # da chave de idempotência; Firestore fora do ar: vai para a fila offline
+    chave = chave_idempotencia()
+    agora = datetime.now(timezone.utc)
+    item = {
+        'placa': placa, 'motorista': motorista, 'litros': litros, 'odometro': odometro,
+        'veiculo_categoria': veiculo_categoria,
+    }
+    try:
+        if fila_offline.deve_enfileirar():
+            return responder_fila_offline('abastecimento', placa, {**item, 'registrado_em': agora.isoformat()}, chave)
+        mensagem = registrar_abastecimentos_rapidos([{**item, 'timestamp': agora, 'refuel_id': id_da_operacao(chave)}])[0]
+        return jsonify({"message": mensagem}), 200
     except Exception as e:
+        if erro_firestore_indisponivel(e):
+            print(f" Firestore indisponível no abastecimento ({e}), guardando na fila offline")
+            return responder_fila_offline('abastecimento', placa, {**item, 'registrado_em': agora.isoformat()}, chave)
         print(f" Erro ao registrar abastecimento: {e}")
         return jsonify({"error": "Erro ao registrar abastecimento"}), 500
 
@@ -873,37 +2405,59 @@ def get_veiculos_em_curso():
         return jsonify({"error": "Conexão com o banco de dados não foi estabelecida."}), 500
     
     try:
-        saidas_ref = db.collection('saidas')
-        query = saidas_ref.where(filter=firestore.FieldFilter('status', '==', 'em_curso')).order_by('timestampSaida', direction=firestore.Query.ASCENDING)
-        viagens_em_curso = query.stream()
+        # Fila offline: saídas ainda não enviadas entram na lista (pendente) e
+        # chegadas ainda não enviadas tiram o veículo dela
+        try:
+            previsao = fila_offline.previsao_em_curso()
+        except Exception as e:
+            print(f" Fila offline indisponível ({e})")
+            previsao = {}
+
+        # Réplica em memória (listener/polling compartilhado) - sem leituras por requisição
+        viagens_em_curso = [(doc_id, data) for doc_id, data in saidas_replica.em_curso()
+                            if normalize_plate(data.get('veiculo') or '') not in previsao]
+        for placa, pendente in previsao.items():
+            if pendente:
+                registrado_em = datetime.fromisoformat(pendente['registrado_em'])
+                viagens_em_curso.append((pendente['id'], {
+                    'veiculo': placa,
+                    'motorista': pendente.get('motorista'),
+                    'solicitante': pendente.get('solicitante'),
+                    'trajeto': pendente.get('trajeto'),
+                    'horarioSaida': pendente.get('horario') or registrado_em.astimezone(LOCAL_TZ).strftime('%H:%M'),
+                    'timestampSaida': registrado_em,
+                    'pendente': True,
+                }))
+        viagens_em_curso.sort(
+            key=lambda par: _to_datetime(par[1].get('timestampSaida')) or datetime.min.replace(tzinfo=timezone.utc)
+        )
 
         veiculos = []
-        for doc in viagens_em_curso:
-            data = doc.to_dict()
+        for doc_id, data in viagens_em_curso:
             placa = data.get("veiculo")
             
-            # Buscar categoria do veículo
-            categoria = "Outros"  # valor padrão
-            if placa:
-                veiculo_docs = db.collection('veiculos').where(filter=firestore.FieldFilter('placa', '==', placa)).limit(1).get()
-                if veiculo_docs:
-                    veiculo_data = veiculo_docs[0].to_dict()
-                    categoria = veiculo_data.get('categoria', 'Outros')
+            # Categoria do veículo (índice em memória, sem query por viagem)
+            categoria = get_veiculo_categoria(placa)
             
             veiculos.append({
-                "id": doc.id,  # [OK] Adicionado ID do documento
+                "id": doc_id,  # [OK] Adicionado ID do documento
                 "veiculo": placa,
                 "motorista": data.get("motorista"),
                 "solicitante": data.get("solicitante"),
                 "trajeto": data.get("trajeto"),
                 "horarioSaida": data.get("horarioSaida"),
-                "categoria": categoria  # [OK] Categoria do veículo
+                "categoria": categoria,  # [OK] Categoria do veículo
+                "pendente": data.get("pendente", False)  # ainda na fila offline
             })
         
         return jsonify(veiculos), 200
 
     except Exception as e:
         print(f"Erro ao buscar veículos em curso: {e}")
+        # Circuito aberto: o 500 vira 503 com Retry-After (_responder_circuito_aberto)
+        if erro_firestore_indisponivel(e) and not circuito_firestore.recusou_nesta_requisicao():
+            return jsonify({"error": "Banco de dados temporariamente indisponível. Tente novamente em instantes.",
+                            "firestore_indisponivel": True}), 503
         return jsonify({"error": "Ocorreu um erro ao buscar os veículos em curso."}), 500
 
 # ==========================================
@@ -1079,11 +2633,93 @@ def delete_usuario(user_id):
 # ==========================================
 # [LIST] API DE LOGS DE AUDITORIA
 # ==========================================
+# Filtros por igualdade (user, action, collection, document_id) + intervalo
+# de datas (from/to) sempre ordenados por timestamp DESC e ID DESC, com
+# cursor keyset. Cada combinação de filtros de igualdade precisa de um índice
+# composto: ver firestore.indexes.json (gerado por scripts/gerar_indices_firestore.py).
+
+AUDIT_FILTROS_IGUALDADE = ('user', 'action', 'collection', 'document_id')
+AUDIT_LIMITE_PAGINA = 200
+AUDIT_LOTE_EXPORTACAO = 500
+AUDIT_EXPORTACAO_MAX = int(os.getenv('AUDIT_EXPORTACAO_MAX', '100000'))
+AUDIT_COLUNAS_CSV = ['timestamp', 'user', 'action', 'collection', 'document_id',
+                     'ip_address', 'user_agent', 'old_data', 'new_data', 'id']
+
+
+def _audit_data_param(valor, fim_do_dia=False):
+    """Converte YYYY-MM-DD (dia local) ou ISO 8601 para datetime UTC."""
+    if len(valor) == 10:
+        dia = datetime.strptime(valor, '%Y-%m-%d').replace(tzinfo=LOCAL_TZ)
+        if fim_do_dia:
+            dia += timedelta(days=1)
+        return dia.astimezone(timezone.utc)
+    dt = datetime.fromisoformat(valor.replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=LOCAL_TZ)
+    return dt.astimezone(timezone.utc)
+
+
+def _audit_filtros(args):
+    """Lê os filtros da query string. Levanta ValueError com a mensagem para o cliente."""
+    filtros = {campo: args.get(campo, '').strip() for campo in AUDIT_FILTROS_IGUALDADE}
+    filtros = {campo: valor for campo, valor in filtros.items() if valor}
+    try:
+        inicio = _audit_data_param(args['from'].strip()) if args.get('from', '').strip() else None
+        fim = _audit_data_param(args['to'].strip(), fim_do_dia=True) if args.get('to', '').strip() else None
+    except ValueError:
+        raise ValueError("Formato de 'from'/'to' inválido. Use YYYY-MM-DD ou ISO 8601.")
+    return filtros, inicio, fim
+
+
+def _audit_query(filtros, inicio, fim, cursor_pos=None):
+    """Monta a query indexada (igualdades + intervalo + ordem keyset)."""
+    query = db.collection(AUDIT_COLLECTION)
+    for campo, valor in filtros.items():
+        query = query.where(filter=firestore.FieldFilter(campo, '==', valor))
+    if inicio:
+        query = query.where(filter=firestore.FieldFilter('timestamp', '>=', inicio))
+    if fim:
+        # 'to' como dia (YYYY-MM-DD) é inclusivo: vai até o início do dia seguinte
+        query = query.where(filter=firestore.FieldFilter('timestamp', '<', fim))
+    query = query.order_by('timestamp', direction=firestore.Query.DESCENDING)
+    query = query.order_by(FieldPath.document_id(), direction=firestore.Query.DESCENDING)
+    if cursor_pos:
+        cursor_ts, cursor_id = cursor_pos
+        query = query.start_after({
+            'timestamp': cursor_ts,
+            FieldPath.document_id(): db.collection(AUDIT_COLLECTION).document(cursor_id)
+        })
+    return query
+
+
+def _audit_pagina(filtros, inicio, fim, limite, cursor_pos=None):
+    """Lê uma página: (logs serializados, cursor da próxima página ou None)."""
+    logs = []
+    ultimo = None
+    for doc in _audit_query(filtros, inicio, fim, cursor_pos).limit(limite).stream():
+        dados = doc.to_dict() or {}
+        ultimo = (dados.get('timestamp'), doc.id)
+        log_data = serialize_doc(dados)
+        log_data['id'] = doc.id
+        logs.append(log_data)
+    proximo = _encode_cursor(*ultimo) if ultimo and len(logs) == limite else None
+    return logs, proximo
+
+
+def _audit_cursor_param(cursor):
+    """Decodifica ?cursor=; levanta ValueError se inválido."""
+    if not cursor:
+        return None
+    cursor_ts, cursor_id = _decode_cursor(cursor)
+    if cursor_ts is None:
+        raise ValueError('cursor inválido')
+    return cursor_ts, cursor_id
+
 
 @app.route('/api/audit-logs', methods=['GET'])
 @requires_auth
 def get_audit_logs():
-    """Lista logs de auditoria (somente admin)"""
+    """Lista logs de auditoria (somente admin) com filtros e paginação por cursor"""
     if session.get('user_type') != 'admin':
         return jsonify({"error": "Acesso negado - somente administradores"}), 403
     
@@ -1091,47 +2727,145 @@ def get_audit_logs():
         return jsonify({"error": "Conexão com o banco de dados não foi estabelecida."}), 500
     
     try:
-        # Filtros opcionais
-        user_filter = request.args.get('user', '').strip()
-        action_filter = request.args.get('action', '').strip()
-        collection_filter = request.args.get('collection', '').strip()
-        limit_param = request.args.get('limit', '50')
-        
-        try:
-            limit_value = int(limit_param)
-            if limit_value > 50:  # Máximo de 50 para economizar quota
-                limit_value = 50
-        except:
-            limit_value = 50
-        
-        # Query base
-        query = db.collection('audit_log').order_by('timestamp', direction=firestore.Query.DESCENDING)
-        
-        # Aplica filtros
-        if user_filter:
-            query = query.where(filter=firestore.FieldFilter('user', '==', user_filter))
-        if action_filter:
-            query = query.where(filter=firestore.FieldFilter('action', '==', action_filter))
-        if collection_filter:
-            query = query.where(filter=firestore.FieldFilter('collection', '==', collection_filter))
-        
-        # Executa query
-        logs_docs = query.limit(limit_value).stream()
-        
-        logs = []
-        for doc in logs_docs:
-            log_data = serialize_doc(doc.to_dict())
-            log_data['id'] = doc.id
-            logs.append(log_data)
-        
-        return jsonify(logs), 200
+        filtros, inicio, fim = _audit_filtros(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        limit_value = max(1, min(int(request.args.get('limit', '50')), AUDIT_LIMITE_PAGINA))
+    except ValueError:
+        limit_value = 50
+
+    try:
+        cursor_pos = _audit_cursor_param(request.args.get('cursor', '').strip())
+    except Exception:
+        return jsonify({"error": "Parâmetro 'cursor' inválido."}), 400
+
+    try:
+        logs, next_cursor = _audit_pagina(filtros, inicio, fim, limit_value, cursor_pos)
+        return jsonify({"logs": logs, "next_cursor": next_cursor, "limit": limit_value}), 200
         
     except Exception as e:
         print(f"Erro ao buscar logs de auditoria: {e}")
         return jsonify({"error": str(e)}), 500
 
+
+@app.route('/api/audit-logs/export', methods=['GET'])
+@requires_auth
+def export_audit_logs():
+    """Exporta os logs filtrados (?format=ndjson|csv) em streaming, página a página"""
+    if session.get('user_type') != 'admin':
+        return jsonify({"error": "Acesso negado - somente administradores"}), 403
+
+    if not db:
+        return jsonify({"error": "Conexão com o banco de dados não foi estabelecida."}), 500
+
+    formato = request.args.get('format', 'ndjson').lower()
+    if formato not in ('ndjson', 'csv'):
+        return jsonify({"error": "Formato inválido. Use 'ndjson' ou 'csv'."}), 400
+    try:
+        filtros, inicio, fim = _audit_filtros(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def _linha_csv(valores):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(valores)
+        return buffer.getvalue()
+
+    def _gerar():
+        if formato == 'csv':
+            yield _linha_csv(AUDIT_COLUNAS_CSV)
+        cursor_pos = None
+        enviados = 0
+        while enviados < AUDIT_EXPORTACAO_MAX:
+            limite = min(AUDIT_LOTE_EXPORTACAO, AUDIT_EXPORTACAO_MAX - enviados)
+            logs, proximo = _audit_pagina(filtros, inicio, fim, limite, cursor_pos)
+            for log_data in logs:
+                if formato == 'csv':
+                    yield _linha_csv([
+                        json.dumps(log_data.get(coluna), ensure_ascii=False, default=str)
+                        if isinstance(log_data.get(coluna), (dict, list)) else log_data.get(coluna, '')
+                        for coluna in AUDIT_COLUNAS_CSV
+                    ])
+                else:
+                    yield json.dumps(log_data, ensure_ascii=False, default=str) + '\n'
+            enviados += len(logs)
+            if not proximo:
+                break
+            cursor_pos = _decode_cursor(proximo)
+        print(f"[OK] Exportação de auditoria ({formato}): {enviados} registro(s)")
+
+    nome = f"auditoria_{datetime.now(LOCAL_TZ).strftime('%Y%m%d_%H%M%S')}.{'csv' if formato == 'csv' else 'ndjson'}"
+    return Response(
+        stream_with_context(_gerar()),
+        mimetype='text/csv' if formato == 'csv' else 'application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename={nome}'}
+    )
+
+
 # Cache para histórico (5 minutos) - um cache para cada combinação de filtros
-historico_cache = {}  # Dicionário de caches por chave (mes_ano_placa_motorista_page)
+# (historico_cache é um CacheStore: memória ou SQLite compartilhado, ver CACHE_BACKEND)
+
+def _historico_timestamp(item):
+    """Timestamp (segundos) do timestampSaida ISO de um registro do histórico (0 se inválido)."""
+    ts = _to_datetime(item.get('timestampSaida') or '')
+    return ts.timestamp() if ts else 0
+
+
+def _historico_sort_key(item):
+    """Ordem do histórico: em_curso primeiro, depois timestamp mais recente primeiro."""
+    # Prioridade 1: em_curso = 0, finalizada = 1 (menor número vem primeiro)
+    status_priority = 0 if item.get('status') == 'em_curso' else 1
+    # Prioridade 2: timestamp mais recente (negativo para ordem decrescente)
+    return (status_priority, -_historico_timestamp(item))
+
+
+def _encode_cursor(timestamp, doc_id):
+    """Cursor opaco (base64url) com a posição de um documento: timestamp + ID.
+
+    Usado na paginação keyset (order_by timestamp DESC, __name__ DESC + start_after).
+    """
+    ts = _to_datetime(timestamp)
+    payload = json.dumps({'ts': ts.astimezone(timezone.utc).isoformat() if ts else None, 'id': doc_id},
+                         separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def _decode_cursor(cursor):
+    """Inverso de _encode_cursor: (datetime UTC ou None, doc_id). Levanta erro se inválido."""
+    dados = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    ts = _to_datetime(dados['ts']) if dados.get('ts') is not None else None
+    if (dados.get('ts') is not None and ts is None) or not dados.get('id'):
+        raise ValueError('cursor inválido')
+    return ts, str(dados['id'])
+
+
+def _historico_posicao(item):
+    """Posição de um registro na ordem das páginas (timestampSaida, id), decrescente."""
+    return (_historico_timestamp(item), item.get('id') or '')
+
+
+def _historico_cache_key(mes_filtro, ano_filtro, data_filtro, placa_filtro, motorista_filtro, limit, cursor):
+    """Chave de cache do /api/historico começando pelo mês (YYYY-MM|PLACA|motorista|data|limit|cursor)."""
+    mes_chave = 'outros'
+    try:
+        if mes_filtro and ano_filtro:
+            mes_chave = f"{int(ano_filtro):04d}-{int(mes_filtro):02d}"
+        elif data_filtro:
+            mes_chave = datetime.strptime(data_filtro, '%d/%m/%Y').strftime('%Y-%m')
+    except ValueError:
+        pass
+    campos = [
+        mes_chave,
+        normalize_plate(placa_filtro).upper() if placa_filtro else '',
+        motorista_filtro.lower(),
+        data_filtro or '',
+        str(limit),
+        cursor or '',
+    ]
+    return '|'.join(c.replace('|', ' ') for c in campos)
+
 
 @app.route('/api/historico', methods=['GET'])
 @requires_auth_historico
@@ -1146,9 +2880,19 @@ def get_historico():
         placa_filtro = request.args.get('placa', '').strip()
         motorista_filtro = request.args.get('motorista', '').strip()
         
-        # [OK] PAGINAÇÃO SERVER-SIDE para economizar quota
-        page = int(request.args.get('page', 1))
-        limit = int(request.args.get('limit', 500))  # [OK] AUMENTADO DE 50 PARA 500
+        # [OK] PAGINAÇÃO POR CURSOR (keyset): ?cursor=<next_cursor da página anterior>
+        # Cada página lê só `limit` documentos, qualquer que seja a profundidade
+        page = int(request.args.get('page', 1))  # apenas informativo (compatibilidade)
+        limit = max(1, min(int(request.args.get('limit', 500)), 500))
+        cursor = request.args.get('cursor') or None
+        cursor_pos = None
+        if cursor:
+            try:
+                cursor_pos = _decode_cursor(cursor)
+                if cursor_pos[0] is None:
+                    raise ValueError('cursor sem timestamp')
+            except Exception:
+                return jsonify({"error": "Cursor de paginação inválido."}), 400
 
         # [OK] SE NÃO TEM FILTROS, BUSCA DO MÊS ATUAL
         if not data_filtro and not mes_filtro and not ano_filtro:
@@ -1157,9 +2901,10 @@ def get_historico():
             ano_filtro = str(now_local.year)
             print(f'[DATE] Sem filtro de data: buscando mês atual {mes_filtro}/{ano_filtro}')
 
-        # [OK] CACHE de 5 minutos - invalidado automaticamente em saídas/chegadas/cancelamentos
+        # [OK] CACHE de 5 minutos - invalidado seletivamente em saídas/chegadas/cancelamentos
+        # Chave: YYYY-MM|PLACA|motorista|data|limit|cursor (ver invalidar_caches_saida)
         now = time.time()
-        cache_key = f"{mes_filtro}_{ano_filtro}_{placa_filtro}_{motorista_filtro}_{page}"
+        cache_key = _historico_cache_key(mes_filtro, ano_filtro, data_filtro, placa_filtro, motorista_filtro, limit, cursor)
         
         #  BYPASS DE CACHE para requisições real-time (com parâmetro _t recente)
         bypass_cache = False
@@ -1175,10 +2920,12 @@ def get_historico():
                 pass
         
         # Verifica se tem cache válido (só usa se não for bypass)
-        if not bypass_cache and cache_key in historico_cache and historico_cache[cache_key]['expires'] > now:
-            cached = historico_cache[cache_key]['data']
+        # Modo economia ou Firestore fora do ar: serve o cache mesmo vencido e ignora o bypass
+        vencido = servir_cache_vencido()
+        cached = None if bypass_cache and not vencido else historico_cache.get(cache_key, expirado=vencido)
+        if cached is not None:
             print(f'[FAST] Cache hit: {mes_filtro}/{ano_filtro} - economiza leituras Firestore')
-            return jsonify(cached), 200
+            return jsonify({k: v for k, v in cached.items() if k != 'gerado_em'}), 200
         
         print(f'[RELOAD] Cache miss: buscando {mes_filtro}/{ano_filtro} do Firestore')
 
@@ -1245,37 +2992,42 @@ def get_historico():
                 print(f' Data inválida: {data_filtro}')
                 pass
 
-        # [OK] 3. Aplica filtro de PLACA (se houver)
-        # Como já temos filtro de timestamp, precisamos fazer filtro local para placa
-        if placa_filtro:
-            needs_local_filter = True
+        # [OK] 3. Aplica filtro de PLACA na própria query (igualdade + faixa de timestamp
+        # usa o índice veiculo ASC, timestampSaida DESC) - paginação e total ficam exatos
+        placa_normalizada = normalize_plate(placa_filtro) if placa_filtro else ''
+        if placa_normalizada:
+            query = query.where(filter=firestore.FieldFilter('veiculo', '==', placa_normalizada))
 
         # [OK] 4. Motorista sempre filtrado localmente (mais flexível - case insensitive, partial match)
         if motorista_filtro:
             needs_local_filter = True
 
-        # [OK] 5. Ordena e Executa a query
+        # [OK] 5. Ordena (timestamp + ID como desempate estável) e Executa a query
         query = query.order_by('timestampSaida', direction=firestore.Query.DESCENDING)
-        
-        # [OK] REMOVE PAGINAÇÃO COM OFFSET (causa o bug de retornar poucos registros)
-        # Retorna TODOS os registros do mês (até o limite de 500)
-        historico_docs = query.limit(limit).stream() 
+        query = query.order_by(FieldPath.document_id(), direction=firestore.Query.DESCENDING)
+
+        # [OK] Continua logo depois do último documento da página anterior (sem offset)
+        if cursor_pos:
+            cursor_ts, cursor_id = cursor_pos
+            query = query.start_after({
+                'timestampSaida': cursor_ts,
+                FieldPath.document_id(): db.collection('saidas').document(cursor_id)
+            })
+
+        historico_docs = query.limit(limit).stream()
 
         historico = []
-        veiculos_cache_map = {}  # Cache de categorias dos veículos
+        lidos = 0
+        ultimo_doc = None
         
         for doc in historico_docs:
-            data = serialize_doc(doc.to_dict())
+            lidos += 1
+            raw = doc.to_dict()
+            ultimo_doc = (raw.get('timestampSaida'), doc.id)
+            data = serialize_doc(raw)
             data['id'] = doc.id  # [OK] ADICIONA O ID DO DOCUMENTO
             
-            # [OK] FILTROS LOCAIS (aplicados após buscar do Firestore)
-            # Filtro de placa
-            if placa_filtro:
-                placa_doc = data.get('veiculo', '')
-                placa_normalizada = normalize_plate(placa_filtro)
-                if placa_doc.upper() != placa_normalizada.upper():
-                    continue  # Pula este registro
-            
+            # [OK] FILTRO LOCAL (aplicado após buscar do Firestore)
             # Filtro de motorista (case insensitive, partial match)
             if motorista_filtro:
                 motorista_doc = data.get('motorista', '').lower()
@@ -1283,20 +3035,8 @@ def get_historico():
                 if motorista_busca not in motorista_doc:
                     continue  # Pula este registro
             
-            # Busca categoria do veículo (com cache para evitar queries repetidas)
-            placa = data.get('veiculo')
-            if placa and placa not in veiculos_cache_map:
-                try:
-                    veiculo_docs = db.collection('veiculos').where(filter=firestore.FieldFilter('placa', '==', placa)).limit(1).get()
-                    if veiculo_docs:
-                        veiculo_info = veiculo_docs[0].to_dict()
-                        veiculos_cache_map[placa] = veiculo_info.get('categoria', 'Outros')
-                    else:
-                        veiculos_cache_map[placa] = 'Outros'
-                except:
-                    veiculos_cache_map[placa] = 'Outros'
-            
-            data['categoria'] = veiculos_cache_map.get(placa, 'Outros')
+            # Categoria do veículo vem do índice em memória
+            data['categoria'] = get_veiculo_categoria(data.get('veiculo'))
             historico.append(data)
         
         # [OK] Busca TOTAL de registros (para paginação) - usa COUNT do Firestore (1 leitura!)
@@ -1332,10 +3072,13 @@ def get_historico():
                 count_query = count_query.where(filter=firestore.FieldFilter('timestampSaida', '<=', end_utc))
             except ValueError:
                 pass
+
+        # Mesmo filtro de placa da query principal
+        if placa_normalizada:
+            count_query = count_query.where(filter=firestore.FieldFilter('veiculo', '==', placa_normalizada))
         
-        #  Filtros locais (placa e motorista) não podem ser aplicados no count
-        # O count será aproximado se houver filtros locais
-        # Para ter count exato com filtros locais, usamos len(historico)
+        #  O filtro de motorista (local) não pode ser aplicado no count
+        # Para ter count exato com o filtro local, usamos len(historico)
         if needs_local_filter:
             total_count = len(historico)
             print(f"[STATS] COUNT com filtros locais: {total_count} registros")
@@ -1353,55 +3096,43 @@ def get_historico():
                 total_count = len(docs_count)
                 print(f"[STATS] Contagem manual: {total_count} registros totais")
         
+        # Página cheia: pode haver mais documentos depois do último lido
+        next_cursor = None
+        if lidos == limit and ultimo_doc and ultimo_doc[0]:
+            next_cursor = _encode_cursor(*ultimo_doc)
+
         # DEBUG: Verifica contagem
-        print(f"[Pagina] {page}: retornando {len(historico)} registros de {total_count} totais")
+        print(f"[Pagina] {page}: retornando {len(historico)} registros de {total_count} totais (mais: {next_cursor is not None})")
         if placa_filtro:
             print(f"[SEARCH] Filtro de placa aplicado: {placa_filtro}")
         if motorista_filtro:
             print(f"[SEARCH] Filtro de motorista aplicado: {motorista_filtro}")
 
         # Ordena localmente: primeiro por status (em_curso primeiro), depois por timestamp (mais recente primeiro)
-        def sort_key(item):
-            # Prioridade 1: em_curso = 0, finalizada = 1 (menor número vem primeiro)
-            status_priority = 0 if item.get('status') == 'em_curso' else 1
-            
-            # Prioridade 2: timestamp mais recente (negativo para ordem decrescente)
-            timestamp_str = item.get('timestampSaida', '')
-            try:
-                if timestamp_str:
-                    ts = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-                    timestamp_val = -ts.timestamp()  # Negativo para mais recente primeiro
-                else:
-                    timestamp_val = 0
-            except:
-                timestamp_val = 0
-            
-            return (status_priority, timestamp_val)
-        
-        historico_final = sorted(historico, key=sort_key)
+        historico_final = sorted(historico, key=_historico_sort_key)
 
-        # [OK] Salva no cache (5 minutos) - APENAS se não tem filtros E é página 1
         response_data = {
             'historico': historico_final,
             'total': total_count,
             'page': page,
-            'limit': limit
+            'limit': limit,
+            'cursor': cursor,
+            'next_cursor': next_cursor
         }
         
-        # Salva no cache somente quando é busca geral (sem filtros) da página 1
-        if not data_filtro and not placa_filtro and not motorista_filtro and page == 1:
-            historico_cache[cache_key] = {
-                'data': response_data,
-                'expires': time.time() + 300  # 5 minutos
-            }
-            print(f'[SAVE] Cache salvo: {mes_filtro}/{ano_filtro} por 5min ({len(historico_final)} registros)')
-        else:
-            print(f'[OK] Sem cache (tem filtros): {len(historico_final)} registros')
+        # [OK] Salva no cache (5 minutos) cada página (cursor) - com ou sem filtros, pois
+        # as escritas corrigem/removem apenas as páginas do mês/placa/motorista afetados
+        historico_cache.set(cache_key, {**response_data, 'gerado_em': now}, ttl=300)  # 5 minutos
+        print(f'[SAVE] Cache salvo: {cache_key} por 5min ({len(historico_final)} registros)')
 
         return jsonify(response_data), 200
 
     except Exception as e:
         print(f"Erro ao buscar histórico: {e}")
+        # Firestore fora do ar: última versão conhecida da página, mesmo vencida
+        cached = historico_cache.get(cache_key, expirado=True) if erro_firestore_indisponivel(e) else None
+        if cached is not None:
+            return jsonify({k: v for k, v in cached.items() if k != 'gerado_em'}), 200
         return jsonify({"error": "Ocorreu um erro ao buscar o histórico."}), 500
 
 
@@ -1412,12 +3143,8 @@ def get_motoristas():
         return jsonify({"error": "Conexão com o banco de dados não foi estabelecida."}), 500
     
     try:
-        motoristas_ref = db.collection('motoristas').stream()
-        motoristas = []
-        for doc in motoristas_ref:
-            motorista_data = doc.to_dict()
-            motorista_data['id'] = doc.id
-            motoristas.append(serialize_doc(motorista_data))
+        # Lista vem do cadastro em memória (ID do documento já incluído)
+        motoristas = [serialize_doc(m) for m in motoristas_index.all()]
         return jsonify(motoristas), 200
 
     except Exception as e:
@@ -1445,13 +3172,11 @@ def post_motorista():
         return jsonify({"error": "O campo 'nome' é obrigatório."}), 400
 
     try:
-        motoristas_ref = db.collection('motoristas')
-        # Evita duplicados por nome
-        existing = list(motoristas_ref.where(filter=firestore.FieldFilter('nome', '==', nome)).limit(1).stream())
-        if existing:
+        # Evita duplicados por nome (também ignora acentos/maiúsculas)
+        if motoristas_index.get(nome):
             return jsonify({"error": "Motorista já cadastrado."}), 409
 
-        motoristas_ref.add({
+        motoristas_index.add({
             'nome': nome,
             'funcao': funcao,
             'empresa': empresa,
@@ -1513,6 +3238,7 @@ def update_motorista(motorista_id):
         log_audit('update', 'motoristas', motorista_id, old_data=motorista_data, new_data=update_data)
         
         motorista_ref.update(update_data)
+        motoristas_index.upsert(motorista_id, update_data)
         return jsonify({"message": "Motorista atualizado com sucesso."}), 200
 
     except Exception as e:
@@ -1566,6 +3292,7 @@ def delete_motorista(motorista_id):
         log_audit('delete', 'motoristas', motorista_id, old_data=motorista_data)
         
         motorista_ref.delete()
+        motoristas_index.remove(motorista_id)
         return jsonify({
             "message": "Motorista excluído com sucesso.",
             "backups": backup_urls
@@ -1642,6 +3369,7 @@ def upload_cnh(motorista_id):
         motorista_ref.update({
             'cnh_url': cnh_url
         })
+        motoristas_index.upsert(motorista_id, {'cnh_url': cnh_url})
         
         # Mensagem diferente se foi atualização ou novo upload
         mensagem = "CNH atualizada com sucesso." if motorista_data.get('cnh_url') else "CNH enviada com sucesso."
@@ -1714,6 +3442,7 @@ def toggle_motorista_status(motorista_id):
         motorista_ref.update({
             'status_ativo': status_ativo
         })
+        motoristas_index.upsert(motorista_id, {'status_ativo': status_ativo})
         
         status_texto = "ativo" if status_ativo else "inativo"
         
@@ -1747,16 +3476,6 @@ def update_saida(saida_id):
             if campo not in dados:
                 return jsonify({"error": f"Campo obrigatório ausente: {campo}"}), 400
 
-        # Busca o documento
-        saida_ref = db.collection('saidas').document(saida_id)
-        saida_doc = saida_ref.get()
-
-        if not saida_doc.exists:
-            return jsonify({"error": "Saída não encontrada."}), 404
-        
-        # Salva dados antigos para auditoria
-        saida_data_old = saida_doc.to_dict()
-
         # Converte timestamps de string ISO para datetime
         try:
             # timestampSaida vem como string ISO do frontend (ex: "2025-09-23T16:42:00")
@@ -1798,16 +3517,19 @@ def update_saida(saida_id):
             except:
                 pass  # Ignora se der erro na chegada
         
+        # Atualiza no Firestore junto com a trava do veículo e o resumo mensal
+        # (pode mover a viagem de mês ou trocar o veículo em curso)
+        saida_data_old, _, conflito = escrever_saida(saida_id, campos=update_data)
+        if saida_data_old is None:
+            return jsonify({"error": "Saída não encontrada."}), 404
+        if conflito:
+            return jsonify({"error": f"O veículo {update_data['veiculo']} já tem outra viagem em curso."}), 409
+        
         # Auditoria: registra atualização da saída
         log_audit('update', 'saidas', saida_id, old_data=saida_data_old, new_data=update_data)
         
-        # Atualiza no Firestore
-        saida_ref.update(update_data)
-        
-        #  LIMPA CACHE após edição
-        dashboard_cache.clear()
-        historico_cache['expires'] = 0
-        print("[DELETE] Cache do dashboard e histórico invalidados após edição")
+        #  Corrige o cache dos meses/filtros da versão antiga e da nova
+        invalidar_caches_saida(saida_antiga=saida_data_old, saida_nova={**saida_data_old, **update_data}, saida_id=saida_id)
         
         print(f"[OK] Saída {saida_id} atualizada com sucesso")
         print(f"[DATE] Timestamp salvo (UTC): {update_data['timestampSaida']}")
@@ -1826,25 +3548,18 @@ def delete_saida(saida_id):
         return jsonify({"error": "Conexão com o banco de dados não foi estabelecida."}), 500
 
     try:
-        saida_ref = db.collection('saidas').document(saida_id)
-        saida_doc = saida_ref.get()
+        # Deleta o documento, libera a trava (se estava em curso) e remove a
+        # viagem do resumo mensal numa única transação
+        saida_data, _, _ = escrever_saida(saida_id, excluir=True)
 
-        if not saida_doc.exists:
+        if saida_data is None:
             return jsonify({"error": "Saída não encontrada."}), 404
         
-        # Salva dados antigos para auditoria
-        saida_data = saida_doc.to_dict()
-        
         # Auditoria: registra exclusão da saída
         log_audit('delete', 'saidas', saida_id, old_data=saida_data)
-
-        # Deleta o documento
-        saida_ref.delete()
         
-        #  LIMPA CACHE após exclusão
-        dashboard_cache.clear()
-        historico_cache['expires'] = 0
-        print("[DELETE] Cache do dashboard e histórico invalidados após exclusão")
+        #  Corrige o cache do mês/veículo/motorista da saída excluída
+        invalidar_caches_saida(saida_antiga=saida_data, saida_id=saida_id)
         
         print(f"[DELETE] Saída {saida_id} excluída com sucesso")
         return jsonify({"message": "Saída excluída com sucesso."}), 200
@@ -1867,30 +3582,23 @@ def atualizar_saida_rapido(saida_id):
         if 'solicitante' not in dados or 'trajeto' not in dados:
             return jsonify({"error": "Campos 'solicitante' e 'trajeto' são obrigatórios"}), 400
 
-        # Busca o documento
-        saida_ref = db.collection('saidas').document(saida_id)
-        saida_doc = saida_ref.get()
-
-        if not saida_doc.exists:
-            return jsonify({"error": "Saída não encontrada."}), 404
-
-        # Verifica se está em curso
-        saida_data = saida_doc.to_dict()
-        if saida_data.get('status') != 'em_curso':
-            return jsonify({"error": "Apenas saídas em curso podem ser editadas desta forma."}), 400
-
-        # Atualiza apenas solicitante e trajeto
+        # Atualiza apenas solicitante e trajeto (só se ainda estiver em curso)
         update_data = {
             'solicitante': dados['solicitante'].strip(),
             'trajeto': dados['trajeto'].strip()
         }
+        saida_data, _, erro = escrever_saida(
+            saida_id, campos=update_data,
+            validar=lambda atual: None if atual.get('status') == 'em_curso' else 'Apenas saídas em curso podem ser editadas desta forma.'
+        )
+
+        if saida_data is None:
+            return jsonify({"error": "Saída não encontrada."}), 404
+        if erro:
+            return jsonify({"error": erro}), 400
         
-        saida_ref.update(update_data)
-        
-        #  LIMPA CACHE após edição
-        dashboard_cache.clear()
-        historico_cache['expires'] = 0
-        print("[DELETE] Cache do dashboard e histórico invalidados após edição rápida")
+        #  Corrige o cache do mês/veículo/motorista da saída editada
+        invalidar_caches_saida(saida_antiga=saida_data, saida_nova={**saida_data, **update_data}, saida_id=saida_id)
         
         print(f"[OK] Saída {saida_id} atualizada rapidamente (solicitante/trajeto)")
         return jsonify({"message": "Saída atualizada com sucesso.", "id": saida_id}), 200
@@ -1908,8 +3616,6 @@ def atualizar_saida_rapido(saida_id):
 @app.route('/motoristas')
 @requires_auth
 def motoristas_page():
-    if not FIRESTORE_AVAILABLE:
-        return render_template('maintenance.html'), 503
     return render_template('motoristas.html')
 
 
@@ -1917,8 +3623,6 @@ def motoristas_page():
 @requires_auth_historico
 def historico_page():
     """Página de histórico somente leitura (COM autenticação separada)"""
-    if not FIRESTORE_AVAILABLE:
-        return render_template('maintenance.html'), 503
     return render_template('historico.html')
 
 # Página de Revisões Standalone (opcional - também acessível pelo dashboard)
@@ -1926,8 +3630,6 @@ def historico_page():
 @requires_auth
 def revisoes_page():
     """Página de gestão de revisões e chamados de manutenção"""
-    if not FIRESTORE_AVAILABLE:
-        return render_template('maintenance.html'), 503
     return render_template('revisoes.html')
 
 # Removido: /relatorios e /veiculos agora são abas do dashboard
@@ -1958,8 +3660,458 @@ def veiculos_page():
     return render_template('veiculos.html')
 
 
+# ==========================================
+# [STATS] AGREGADOS DE ABASTECIMENTO POR VEÍCULO
+# ==========================================
+# Mantidos no próprio documento do veículo, a cada escrita em 'refuels':
+# - total_refuels: quantidade de abastecimentos (Increment)
+# - total_litros: soma dos litros (Increment)
+# - odometro_inicial / odometro_final: menor e maior odômetro informado
+#   (Minimum / Maximum; ao remover o valor extremo o veículo é recalculado)
+# Relatórios leem os agregados pelo índice de veículos, sem varrer 'refuels'.
+#
+# `agregados_refuel: True` marca os veículos cujos totais estão completos:
+# criados já com total_refuels=0 / total_litros=0.0, ou recalculados. Veículo
+# anterior aos agregados não tem a marca (um Increment depois do deploy deixa
+# só um total parcial) e aparece como "sem total" em vez de 0. O backfill roda
+# uma vez, em segundo plano, na subida do servidor quando algum veículo não tem
+# a marca (iniciar_backfill_agregados_refuel); a rota administrativa
+# POST /api/veiculos/refuels_agregados/reconstruir refaz tudo manualmente.
+
+def _refuel_litros(refuel):
+    try:
+        return float(refuel.get('litros') or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _refuel_odometro(refuel):
+    try:
+        valor = refuel.get('odometro')
+        return int(valor) if valor not in (None, '', '-') else None
+    except (TypeError, ValueError):
+        return None
+
+
+def campos_agregado_refuel(refuel, novo_veiculo=False):
+    """Campos do veículo para somar um abastecimento (valores iniciais se o veículo é novo)."""
+    litros = _refuel_litros(refuel)
+    odometro = _refuel_odometro(refuel)
+    if novo_veiculo:
+        campos = {'total_refuels': 1, 'total_litros': litros, 'agregados_refuel': True}
+        if odometro is not None:
+            campos['odometro_inicial'] = odometro
+            campos['odometro_final'] = odometro
+        return campos
+    campos = {'total_refuels': firestore.Increment(1)}
+    if litros:
+        campos['total_litros'] = firestore.Increment(litros)
+    if odometro is not None:
+        campos['odometro_inicial'] = firestore.Minimum(odometro)
+        campos['odometro_final'] = firestore.Maximum(odometro)
+    return campos
+
+
+def atualizar_agregados_refuel(refuel_antigo=None, refuel_novo=None):
+    """Aplica nos veículos a diferença entre a versão antiga e a nova de um abastecimento.
+
+    - criação: refuel_antigo=None
+    - exclusão: refuel_novo=None
+    - edição: ambos (pode trocar litros, odômetro ou veículo)
+    Se a versão antiga tinha o menor/maior odômetro do veículo, ele é recalculado.
+    """
+    deltas = {}
+    recalcular = set()
+    for refuel, sinal in ((refuel_antigo, -1), (refuel_novo, 1)):
+        if not refuel or not refuel.get('veiculo'):
+            continue
+        placa = normalize_plate(refuel['veiculo'])
+        delta = deltas.setdefault(placa, {'total_refuels': 0, 'total_litros': 0.0, 'odometros': set()})
+        delta['total_refuels'] += sinal
+        delta['total_litros'] += sinal * _refuel_litros(refuel)
+        odometro = _refuel_odometro(refuel)
+        if odometro is None:
+            continue
+        if sinal > 0:
+            delta['odometros'].add(odometro)
+        else:
+            veiculo = veiculos_index.get(placa) or {}
+            if odometro in (veiculo.get('odometro_inicial'), veiculo.get('odometro_final')):
+                recalcular.add((placa, odometro))
+
+    for placa, delta in deltas.items():
+        veiculo = veiculos_index.get(placa)
+        if not veiculo:
+            continue
+        campos = {}
+        if delta['total_refuels']:
+            campos['total_refuels'] = firestore.Increment(delta['total_refuels'])
+        if abs(delta['total_litros']) > 1e-9:
+            campos['total_litros'] = firestore.Increment(round(delta['total_litros'], 3))
+        if delta['odometros']:
+            campos['odometro_inicial'] = firestore.Minimum(min(delta['odometros']))
+            campos['odometro_final'] = firestore.Maximum(max(delta['odometros']))
+        if campos:
+            veiculos_index.update(veiculo['id'], campos)
+
+    # Edição que manteve o mesmo odômetro no mesmo veículo não precisa recalcular
+    for placa, odometro in recalcular:
+        if odometro not in deltas.get(placa, {}).get('odometros', ()):
+            recalcular_agregados_refuel(placa)
+
+
+def _agregar_refuels(refuels):
+    """Agrega uma sequência de abastecimentos por placa normalizada."""
+    agregados = {}
+    for refuel in refuels:
+        if not refuel.get('veiculo'):
+            continue
+        placa = normalize_plate(refuel['veiculo'])
+        agregado = agregados.setdefault(placa, {'total_refuels': 0, 'total_litros': 0.0,
+                                                'odometro_inicial': None, 'odometro_final': None})
+        agregado['total_refuels'] += 1
+        agregado['total_litros'] += _refuel_litros(refuel)
+        odometro = _refuel_odometro(refuel)
+        if odometro is not None:
+            if agregado['odometro_inicial'] is None or odometro < agregado['odometro_inicial']:
+                agregado['odometro_inicial'] = odometro
+            if agregado['odometro_final'] is None or odometro > agregado['odometro_final']:
+                agregado['odometro_final'] = odometro
+    for agregado in agregados.values():
+        agregado['total_litros'] = round(agregado['total_litros'], 3)
+    return agregados
+
+
+def recalcular_agregados_refuel(placa):
+    """Recalcula os agregados de um veículo lendo os abastecimentos dele."""
+    veiculo = veiculos_index.get(placa)
+    if not veiculo:
+        return None
+    placa_norm = normalize_plate(placa)
+    docs = db.collection('refuels').where(filter=firestore.FieldFilter('veiculo', '==', placa_norm)).stream()
+    agregado = _agregar_refuels(doc.to_dict() or {} for doc in docs).get(placa_norm) or {
+        'total_refuels': 0, 'total_litros': 0.0, 'odometro_inicial': None, 'odometro_final': None}
+    veiculos_index.update(veiculo['id'], {**agregado, 'agregados_refuel': True})
+    return agregado
+
+
+def reconstruir_agregados_refuel():
+    """Recalcula os agregados de todos os veículos numa única leitura de 'refuels'."""
+    agregados = _agregar_refuels(doc.to_dict() or {} for doc in db.collection('refuels').stream())
+    vazio = {'total_refuels': 0, 'total_litros': 0.0, 'odometro_inicial': None, 'odometro_final': None}
+    veiculos = veiculos_index.all()
+    for inicio in range(0, len(veiculos), 400):
+        batch = db.batch()
+        lote = veiculos[inicio:inicio + 400]
+        campos = {}
+        for veiculo in lote:
+            agregado = agregados.get(normalize_plate(veiculo.get('placa') or ''), vazio)
+            campos[veiculo['id']] = {**agregado, 'agregados_refuel': True}
+            batch.update(veiculos_index.reference(veiculo['id']), campos[veiculo['id']])
+        batch.commit()
+        for veiculo_id, dados in campos.items():
+            veiculos_index.upsert(veiculo_id, dados)
+    print(f'[STATS] Agregados de abastecimento reconstruídos para {len(veiculos)} veículos')
+    return len(veiculos)
+
+
+def veiculos_sem_agregados_refuel():
+    """Placas cujos totais de abastecimento ainda não foram calculados (0 leituras)."""
+    return sorted(v['placa'] for v in veiculos_index.all() if v.get('placa') and not v.get('agregados_refuel'))
+
+
+def _backfill_agregados_refuel():
+    try:
+        pendentes = veiculos_sem_agregados_refuel()
+        if not pendentes:
+            return
+        if not firestore_disponivel() or firestore_em_economia():
+            print(f'[STATS] Backfill de agregados adiado: {len(pendentes)} veículo(s) sem totais (Firestore indisponível/economia)')
+            return
+        print(f'[STATS] Backfill de agregados: {len(pendentes)} veículo(s) sem totais de abastecimento')
+        reconstruir_agregados_refuel()
+    except Exception as e:
+        print(f'[STATS] Erro no backfill de agregados de abastecimento: {e}')
+
+
+def iniciar_backfill_agregados_refuel():
+    """Na subida: completa os agregados de veículos anteriores a eles (uma vez, em segundo plano)."""
+    if db:
+        threading.Thread(target=_backfill_agregados_refuel, name='backfill-agregados', daemon=True).start()
+
+
+@app.route('/api/veiculos/refuels_agregados/reconstruir', methods=['POST'])
+@requires_auth
+def reconstruir_agregados_refuel_route():
+    """Recalcula total_refuels, total_litros e odômetros de todos os veículos"""
+    if not db:
+        return jsonify({"error": "Conexão com o banco de dados não foi estabelecida."}), 500
+    try:
+        total = reconstruir_agregados_refuel()
+        return jsonify({"message": "Agregados de abastecimento reconstruídos.", "veiculos": total}), 200
+    except Exception as e:
+        print(f"Erro ao reconstruir agregados de abastecimento: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+# ==========================================
+# [STATS] MÉTRICAS DE CONSUMO INCREMENTAIS (metricas_veiculos/{PLACA})
+# ==========================================
+# Estado por veículo mantido a cada inserção/edição/exclusão de abastecimento:
+# - pares, soma_kmpl, soma_km, soma_km_kmpl: somas dos pares consecutivos
+#   (por timestamp) usadas na média simples e na ponderada de km/l
+# - ultimo: último abastecimento (atalho para o caso comum: novo no fim)
+# - ultimo_odometro (+ id/timestamp de quem o informou), total_litros
+# - por_mes {YYYY-MM: {min, max}}: faixa de odômetro do mês (km no mês)
+# Uma mudança só afeta os pares com os vizinhos imediatos, lidos na mesma
+# transação. A releitura completa (recalcular_metricas_veiculo) é só reparo:
+# estado ausente, ou remoção do único odômetro conhecido.
+
+METRICAS_COLLECTION = 'metricas_veiculos'
+_PAR_VAZIO = (0, 0.0, 0.0, 0.0)
+
+
+def _metricas_ref(placa):
+    return db.collection(METRICAS_COLLECTION).document(normalize_plate(placa))
+
+
+def _contribuicao_par(a, b):
+    """(pares, soma_kmpl, soma_km, soma_km_kmpl) do par consecutivo a -> b.
+
+    Mesma regra de sempre: odômetros crescentes e litros do registro seguinte.
+    """
+    if not a or not b:
+        return _PAR_VAZIO
+    od_a = _refuel_odometro(a)
+    od_b = _refuel_odometro(b)
+    if od_a is None or od_b is None or od_b <= od_a:
+        return _PAR_VAZIO
+    litros_b = _refuel_litros(b)
+    if not litros_b:
+        return _PAR_VAZIO
+    km = od_b - od_a
+    kmpl = km / litros_b
+    return (1, kmpl, km, km * kmpl)
+
+
+def _resumo_refuel(refuel_id, refuel):
+    """Campos de um abastecimento guardados no estado (ultimo)."""
+    return {
+        'id': refuel_id,
+        'timestamp': refuel.get('timestamp'),
+        'odometro': _refuel_odometro(refuel),
+        'litros': _refuel_litros(refuel),
+    }
+
+
+def _estado_metricas(itens):
+    """Estado completo a partir de [(id, refuel)] em ordem crescente de timestamp."""
+    estado = {
+        'pares': 0, 'soma_kmpl': 0.0, 'soma_km': 0.0, 'soma_km_kmpl': 0.0,
+        'total_litros': 0.0, 'ultimo': None,
+        'ultimo_odometro': None, 'ultimo_odometro_id': None, 'ultimo_odometro_ts': None,
+        'por_mes': {},
+    }
+    anterior = None
+    for refuel_id, refuel in itens:
+        par = _contribuicao_par(anterior, refuel)
+        for campo, valor in zip(('pares', 'soma_kmpl', 'soma_km', 'soma_km_kmpl'), par):
+            estado[campo] += valor
+        estado['total_litros'] += _refuel_litros(refuel)
+        estado['ultimo'] = _resumo_refuel(refuel_id, refuel)
+        odometro = _refuel_odometro(refuel)
+        if odometro is not None:
+            estado['ultimo_odometro'] = odometro
+            estado['ultimo_odometro_id'] = refuel_id
+            estado['ultimo_odometro_ts'] = refuel.get('timestamp')
+            mes = _mes_local(refuel.get('timestamp'))
+            if mes:
+                faixa = estado['por_mes'].setdefault(mes, {'min': odometro, 'max': odometro})
+                faixa['min'] = min(faixa['min'], odometro)
+                faixa['max'] = max(faixa['max'], odometro)
+        anterior = refuel
+    return estado
+
+
+def recalcular_metricas_veiculo(placa):
+    """Caminho de reparo: relê todos os abastecimentos do veículo e regrava o estado."""
+    placa_norm = normalize_plate(placa)
+    docs = db.collection('refuels').where(
+        filter=firestore.FieldFilter('veiculo', '==', placa_norm)
+    ).order_by('timestamp', direction=firestore.Query.ASCENDING).stream()
+    estado = _estado_metricas((doc.id, doc.to_dict() or {}) for doc in docs)
+    estado['atualizado_em'] = firestore.SERVER_TIMESTAMP
+    _metricas_ref(placa_norm).set(estado)
+    print(f'[STATS] Métricas de {placa_norm} recalculadas ({estado["pares"]} pares)')
+    return estado
+
+
+def obter_metricas_veiculo(placa):
+    """Lê o estado (1 leitura). Se ainda não existir, recalcula."""
+    doc = _metricas_ref(placa).get()
+    if doc.exists:
+        return doc.to_dict() or {}
+    return recalcular_metricas_veiculo(placa)
+
+
+def _vizinhos_refuel(transaction, placa, ts):
+    """Abastecimentos imediatamente antes e depois de `ts` (mesmo veículo)."""
+    base = db.collection('refuels').where(filter=firestore.FieldFilter('veiculo', '==', placa))
+    vizinhos = []
+    for operador, direcao in (('<', firestore.Query.DESCENDING), ('>', firestore.Query.ASCENDING)):
+        query = base.where(filter=firestore.FieldFilter('timestamp', operador, ts)).order_by('timestamp', direction=direcao).limit(1)
+        docs = list(query.stream(transaction=transaction))
+        vizinhos.append({**(docs[0].to_dict() or {}), 'id': docs[0].id} if docs else None)
+    return vizinhos
+
+
+def _faixa_mes_refuels(transaction, placa, mes):
+    """Menor/maior odômetro do mês relendo só os abastecimentos daquele mês."""
+    inicio, fim = _intervalo_mes_utc(mes)
+    query = db.collection('refuels').where(filter=And([
+        firestore.FieldFilter('veiculo', '==', placa),
+        firestore.FieldFilter('timestamp', '>=', inicio),
+        firestore.FieldFilter('timestamp', '<=', fim)
+    ]))
+    odometros = [o for o in (_refuel_odometro(doc.to_dict() or {}) for doc in query.stream(transaction=transaction)) if o is not None]
+    return {'min': min(odometros), 'max': max(odometros)} if odometros else None
+
+
+def atualizar_metricas_refuel(refuel_id, refuel_antigo=None, refuel_novo=None):
+    """Aplica no estado de métricas a inserção (antigo=None), exclusão (novo=None)
+    ou edição de um abastecimento JÁ gravado no Firestore.
+
+    Nunca levanta erro: se algo falhar o estado é descartado e será
+    recalculado na próxima leitura.
+    """
+    refuel = refuel_novo or refuel_antigo
+    if not refuel or not refuel.get('veiculo'):
+        return
+    placa = normalize_plate(refuel['veiculo'])
+    ref = _metricas_ref(placa)
+
+    @firestore.transactional
+    def _executar(transaction):
+        snap = ref.get(transaction=transaction)
+        if not snap.exists:
+            return True  # sem estado: a próxima leitura recalcula
+        estado = snap.to_dict() or {}
+        ts = _to_datetime(refuel.get('timestamp'))
+        if ts is None:
+            return False
+        ultimo = estado.get('ultimo') or None
+        ultimo_ts = _to_datetime(ultimo.get('timestamp')) if ultimo else None
+
+        # --- Leituras (todas antes das escritas) ---
+        if ultimo is None:
+            anterior, seguinte = None, None
+        elif refuel_antigo is None and ultimo_ts and ts >= ultimo_ts:
+            # Caso comum: abastecimento novo depois do último (sem consultas)
+            anterior, seguinte = ultimo, None
+        else:
+            anterior, seguinte = _vizinhos_refuel(transaction, placa, ts)
+
+        faixas_recalcular = {}
+        od_antigo = _refuel_odometro(refuel_antigo) if refuel_antigo else None
+        od_novo = _refuel_odometro(refuel_novo) if refuel_novo else None
+        mes = _mes_local(ts)
+        faixa = (estado.get('por_mes') or {}).get(mes) if mes else None
+        if od_antigo is not None and faixa and od_antigo in (faixa.get('min'), faixa.get('max')) and od_antigo != od_novo:
+            faixas_recalcular[mes] = _faixa_mes_refuels(transaction, placa, mes)
+
+        # --- Somas dos pares afetados ---
+        somas = [estado.get('pares', 0), estado.get('soma_kmpl', 0.0), estado.get('soma_km', 0.0), estado.get('soma_km_kmpl', 0.0)]
+
+        def _somar(par, sinal):
+            for i, valor in enumerate(par):
+                somas[i] += sinal * valor
+
+        if refuel_antigo:
+            _somar(_contribuicao_par(anterior, refuel_antigo), -1)
+            _somar(_contribuicao_par(refuel_antigo, seguinte), -1)
+        else:
+            _somar(_contribuicao_par(anterior, seguinte), -1)
+        if refuel_novo:
+            _somar(_contribuicao_par(anterior, refuel_novo), 1)
+            _somar(_contribuicao_par(refuel_novo, seguinte), 1)
+        else:
+            _somar(_contribuicao_par(anterior, seguinte), 1)
+
+        novo = dict(estado)
+        novo['pares'] = max(0, int(round(somas[0])))
+        novo['soma_kmpl'], novo['soma_km'], novo['soma_km_kmpl'] = somas[1:]
+        if novo['pares'] == 0:
+            novo['soma_kmpl'] = novo['soma_km'] = novo['soma_km_kmpl'] = 0.0
+        novo['total_litros'] = round(
+            (estado.get('total_litros') or 0.0)
+            - (_refuel_litros(refuel_antigo) if refuel_antigo else 0.0)
+            + (_refuel_litros(refuel_novo) if refuel_novo else 0.0), 3)
+
+        # --- Último abastecimento ---
+        if refuel_novo and (ultimo is None or (ultimo.get('id') == refuel_id) or (ultimo_ts and ts >= ultimo_ts)):
+            novo['ultimo'] = _resumo_refuel(refuel_id, refuel_novo)
+        elif not refuel_novo and ultimo and ultimo.get('id') == refuel_id:
+            novo['ultimo'] = _resumo_refuel(anterior['id'], anterior) if anterior else None
+
+        # --- Último odômetro ---
+        uo_ts = _to_datetime(estado.get('ultimo_odometro_ts'))
+        if estado.get('ultimo_odometro_id') == refuel_id and od_novo is None:
+            if anterior is not None and _refuel_odometro(anterior) is not None:
+                novo['ultimo_odometro'] = _refuel_odometro(anterior)
+                novo['ultimo_odometro_id'] = anterior.get('id')
+                novo['ultimo_odometro_ts'] = anterior.get('timestamp')
+            else:
+                return False  # odômetro anterior desconhecido: reparo completo
+        elif od_novo is not None and (uo_ts is None or ts >= uo_ts or estado.get('ultimo_odometro_id') == refuel_id):
+            novo['ultimo_odometro'] = od_novo
+            novo['ultimo_odometro_id'] = refuel_id
+            novo['ultimo_odometro_ts'] = refuel.get('timestamp')
+
+        # --- Faixa de odômetro do mês ---
+        por_mes = {k: dict(v) for k, v in (estado.get('por_mes') or {}).items()}
+        for mes_recalc, faixa_nova in faixas_recalcular.items():
+            if faixa_nova:
+                por_mes[mes_recalc] = faixa_nova
+            else:
+                por_mes.pop(mes_recalc, None)
+        if od_novo is not None and mes and mes not in faixas_recalcular:
+            faixa = por_mes.setdefault(mes, {'min': od_novo, 'max': od_novo})
+            faixa['min'] = min(faixa['min'], od_novo)
+            faixa['max'] = max(faixa['max'], od_novo)
+        novo['por_mes'] = por_mes
+
+        novo['atualizado_em'] = firestore.SERVER_TIMESTAMP
+        transaction.set(ref, novo)
+        return True
+
+    try:
+        if not _executar(db.transaction()):
+            recalcular_metricas_veiculo(placa)
+    except Exception as e:
+        print(f"Erro ao atualizar métricas de {placa}: {e} - estado será recalculado")
+        try:
+            ref.delete()
+        except Exception:
+            pass
+
+
+@app.route('/api/veiculos/<placa>/metrics/recalcular', methods=['POST'])
+@requires_auth
+def recalcular_metricas_veiculo_route(placa):
+    """Reparo: recalcula o estado de métricas de consumo de um veículo"""
+    if not db:
+        return jsonify({"error": "Conexão com o banco de dados não foi estabelecida."}), 500
+    try:
+        estado = recalcular_metricas_veiculo(placa)
+        return jsonify({"message": "Métricas recalculadas.", "pares": estado['pares']}), 200
+    except Exception as e:
+        print(f"Erro ao recalcular métricas: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route('/api/veiculos/refuel', methods=['POST'])
 @app.route('/api/veiculos/refuels', methods=['POST'])
+@idempotente
 def post_refuel():
     """Registra um abastecimento. Usa coleção top-level 'refuels' com campo 'veiculo'."""
     if not db:
@@ -1999,18 +4151,22 @@ def post_refuel():
             'timestamp': ts
         }
 
-        # Create a new document with an auto-id and set its data explicitly.
-        doc_ref = refuels_ref.document()
-        doc_ref.set(doc)
+        # Com Idempotency-Key o ID deriva da chave (create): um reenvio que
+        # escapou do @idempotente não cria outro abastecimento
+        chave = (request.headers.get('Idempotency-Key') or '').strip()
+        doc_ref = refuels_ref.document(id_da_operacao(chave)) if chave else refuels_ref.document()
+        try:
+            doc_ref.create(doc)
+        except gexc.AlreadyExists:
+            return jsonify({"message": "Abastecimento registrado com sucesso.", "id": doc_ref.id}), 201
         doc_id = doc_ref.id
 
         # Verifica/Cria veículo e atualiza último odômetro E contador de refuels
-        veiculos_ref = db.collection('veiculos')
-        q = list(veiculos_ref.where(filter=firestore.FieldFilter('placa', '==', veiculo)).limit(1).stream())
+        veiculo_atual = veiculos_index.get(veiculo)
         
-        if not q:
+        if not veiculo_atual:
             # Veículo não existe, criar com campos completos
-            veiculos_ref.add({
+            novo_veiculo = {
                 'placa': veiculo,
                 'tipo': 'Não especificado',
                 'modelo': 'Não especificado',
@@ -2020,16 +4176,22 @@ def post_refuel():
                 'status_ativo': True,
                 'dataCadastro': firestore.SERVER_TIMESTAMP,
                 'viagens_totais': 0,
-                'total_refuels': 1
-            })
+                **campos_agregado_refuel(doc, novo_veiculo=True)
+            }
+            veiculos_index.add(novo_veiculo)
             print(f"[OK] Veículo {veiculo} criado automaticamente via abastecimento rápido")
         else:
-            # Veículo existe, atualizar
-            vdoc = q[0]
-            update_fields = {'total_refuels': firestore.Increment(1)}
+            # Veículo existe, atualizar (contador, litros e faixa de odômetro)
+            update_fields = campos_agregado_refuel(doc)
             if odometro is not None:
                 update_fields['ultimo_odometro'] = int(odometro)
-            vdoc.reference.update(update_fields)
+            veiculos_index.update(veiculo_atual['id'], update_fields)
+
+        atualizar_metricas_refuel(doc_id, refuel_novo=doc)
+        try:
+            atualizar_resumo_refuels(refuel_novo=doc)
+        except Exception as e:
+            print(f"Erro ao atualizar resumo de abastecimentos: {e}")
 
         return jsonify({"message": "Abastecimento registrado com sucesso.", "id": doc_id}), 201
     except Exception as e:
@@ -2043,39 +4205,61 @@ def get_refuels_for_veiculo(placa):
         return jsonify({"error": "Conexão com o banco de dados não foi estabelecida."}), 500
 
     placa_norm = normalize_plate(placa)
-    page = int(request.args.get('page', 1))
-    page_size = int(request.args.get('page_size', 20))
+    page = int(request.args.get('page', 1))  # apenas informativo (compatibilidade)
+    page_size = max(1, min(int(request.args.get('page_size', 20)), 200))
+    cursor = request.args.get('cursor') or None
+    try:
+        cursor_pos = _decode_cursor(cursor) if cursor else None
+    except Exception:
+        return jsonify({"error": "Cursor de paginação inválido."}), 400
     try:
         refuels_ref = db.collection('refuels')
         
-        # OTIMIZAÇÃO: Usa offset + limit ao invés de ler TUDO
-        query = refuels_ref.where(filter=firestore.FieldFilter('veiculo', '==', placa_norm)).order_by('timestamp', direction=firestore.Query.DESCENDING)
+        # OTIMIZAÇÃO: Paginação por cursor (keyset) - sem offset, que cobra cada doc pulado
+        query = refuels_ref.where(filter=firestore.FieldFilter('veiculo', '==', placa_norm))
+        query = query.order_by('timestamp', direction=firestore.Query.DESCENDING)
+        query = query.order_by(FieldPath.document_id(), direction=firestore.Query.DESCENDING)
+        if cursor_pos:
+            cursor_ts, cursor_id = cursor_pos
+            query = query.start_after({
+                'timestamp': cursor_ts,
+                FieldPath.document_id(): refuels_ref.document(cursor_id)
+            })
         
         # Lê apenas os docs da página atual
-        offset = (page - 1) * page_size
-        page_docs = query.limit(page_size).offset(offset).stream()
+        page_docs = list(query.limit(page_size).stream())
         
         items = []
         for d in page_docs:
             item = d.to_dict()
             item['_id'] = d.id
             items.append(serialize_doc(item))
+
+        # Página cheia: a próxima começa depois do último documento lido
+        next_cursor = None
+        if len(page_docs) == page_size:
+            ultimo = page_docs[-1]
+            next_cursor = _encode_cursor((ultimo.to_dict() or {}).get('timestamp'), ultimo.id)
+        
+        # OTIMIZAÇÃO: Total vem do contador do veículo no índice em memória (0 leituras)
+        # Se o veículo não estiver cadastrado (ou ainda sem agregados), faz count query (1 leitura agregada)
+        veiculo_data = veiculos_index.get(placa_norm)
+        if veiculo_data and veiculo_data.get('agregados_refuel'):
+            total = veiculo_data.get('total_refuels', 0) or 0
+        else:
+            try:
+                total = refuels_ref.where(filter=firestore.FieldFilter('veiculo', '==', placa_norm)).count().get()[0][0].value
+            except Exception:
+                total = len(items)
         
-        # OTIMIZAÇÃO: Pega total do contador no veículo (se existir)
-        # Se não existir, faz count query (1 leitura agregada)
-        try:
-            veiculo_ref = db.collection('veiculos').where(filter=firestore.FieldFilter('placa', '==', placa_norm)).limit(1)
-            veiculo_docs = list(veiculo_ref.stream())
-            if veiculo_docs:
-                veiculo_data = veiculo_docs[0].to_dict()
-                total = veiculo_data.get('total_refuels', 0)
-            else:
-                # Fallback: estima baseado na página atual
-                total = offset + len(items) + (page_size if len(items) == page_size else 0)
-        except Exception:
-            total = offset + len(items)
-        
-        return jsonify({ 'items': items, 'total': total, 'page': page, 'page_size': page_size }), 200
+        return jsonify({
+            'items': items,
+            'total': total,
+            'page': page,
+            'page_size': page_size,
+            'cursor': cursor,
+            'next_cursor': next_cursor
+        }), 200
     except Exception as e:
         print(f" Erro ao buscar refuels: {e}")
         return jsonify({"error": "Ocorreu um erro ao buscar abastecimentos."}), 500
@@ -2088,8 +4272,10 @@ def patch_refuel(refuel_id):
     data = request.get_json() or {}
     try:
         ref = db.collection('refuels').document(refuel_id)
-        if not ref.get().exists:
+        doc = ref.get()
+        if not doc.exists:
             return jsonify({"error": "Abastecimento não encontrado."}), 404
+        refuel_antigo = doc.to_dict() or {}
         update_fields = {}
         if 'motorista' in data:
             update_fields['motorista'] = data.get('motorista')
@@ -2108,6 +4294,18 @@ def patch_refuel(refuel_id):
         if not update_fields:
             return jsonify({"error": "Nenhum campo para atualizar."}), 400
         ref.update(update_fields)
+        
+        # Ajusta litros/odômetros agregados no veículo
+        if 'litros' in update_fields or 'odometro' in update_fields:
+            try:
+                atualizar_agregados_refuel(refuel_antigo, {**refuel_antigo, **update_fields})
+            except Exception as e:
+                print(f"Erro ao atualizar agregados de refuel: {e}")
+            try:
+                atualizar_resumo_refuels(refuel_antigo, {**refuel_antigo, **update_fields})
+            except Exception as e:
+                print(f"Erro ao atualizar resumo de abastecimentos: {e}")
+            atualizar_metricas_refuel(refuel_id, refuel_antigo, {**refuel_antigo, **update_fields})
         return jsonify({"message": "Abastecimento atualizado."}), 200
     except Exception as e:
         print(f"Erro em patch_refuel: {e}")
@@ -2124,24 +4322,21 @@ def delete_refuel(refuel_id):
         if not doc.exists:
             return jsonify({"error": "Abastecimento não encontrado."}), 404
         
-        # Pega a placa antes de deletar para decrementar contador
-        refuel_data = doc.to_dict()
-        veiculo = refuel_data.get('veiculo')
+        # Pega os dados antes de deletar para descontar dos agregados
+        refuel_data = doc.to_dict() or {}
         
         ref.delete()
         
-        # Decrementa o contador no veículo
-        if veiculo:
-            try:
-                veiculos_ref = db.collection('veiculos')
-                q = list(veiculos_ref.where(filter=firestore.FieldFilter('placa', '==', veiculo)).limit(1).stream())
-                if q:
-                    vdoc = q[0]
-                    current_total = vdoc.to_dict().get('total_refuels', 0)
-                    if current_total > 0:
-                        vdoc.reference.update({'total_refuels': firestore.Increment(-1)})
-            except Exception as e:
-                print(f"Erro ao decrementar contador de refuels: {e}")
+        # Decrementa contador/litros no veículo (recalcula odômetros se era o extremo)
+        try:
+            atualizar_agregados_refuel(refuel_antigo=refuel_data)
+        except Exception as e:
+            print(f"Erro ao decrementar contador de refuels: {e}")
+        try:
+            atualizar_resumo_refuels(refuel_antigo=refuel_data)
+        except Exception as e:
+            print(f"Erro ao atualizar resumo de abastecimentos: {e}")
+        atualizar_metricas_refuel(refuel_id, refuel_antigo=refuel_data)
         
         return jsonify({"message": "Abastecimento removido."}), 200
     except Exception as e:
@@ -2150,25 +4345,21 @@ def delete_refuel(refuel_id):
 
 
 def calculate_vehicle_metrics(placa, month_param=None):
-    """Calcula métricas para o veículo:
+    """Calcula métricas para o veículo a partir do estado incremental (1 leitura):
     - km_por_litro_medio: média simples dos km/l calculados entre pares de refuels (usa litros do refuel seguinte)
     - km_por_litro_ponderado: média ponderada por km
     - km_no_mes: km rodados no mês (diferença entre maior e menor odômetro do mês quando disponível)
     - ultimo_odometro: último odômetro registrado
     """
     placa_norm = normalize_plate(placa)
-    refuels_ref = db.collection('refuels')
     try:
-        docs = list(refuels_ref.where(filter=firestore.FieldFilter('veiculo', '==', placa_norm)).order_by('timestamp', direction=firestore.Query.ASCENDING).stream())
-        items = [d.to_dict() for d in docs]
+        estado = obter_metricas_veiculo(placa_norm)
 
         # tenta buscar o documento do veículo para checar se há média manual informada
         media_informada = None
         try:
-            veiculos_ref = db.collection('veiculos')
-            vq = list(veiculos_ref.where(filter=firestore.FieldFilter('placa', '==', placa_norm)).limit(1).stream())
-            if vq:
-                vdoc = vq[0].to_dict()
+            vdoc = veiculos_index.get(placa_norm)
+            if vdoc:
                 if vdoc.get('media_kmpl') is not None:
                     try:
                         media_informada = float(vdoc.get('media_kmpl'))
@@ -2177,41 +4368,17 @@ def calculate_vehicle_metrics(placa, month_param=None):
         except Exception:
             media_informada = None
 
-        # Último odômetro
-        ultimo_odometro = None
-        for it in reversed(items):
-            if it.get('odometro') is not None:
-                ultimo_odometro = int(it.get('odometro'))
-                break
-
-        # Calcular km/l entre pares consecutivos (usar litros do registro seguinte)
-        kmpls = []
-        weighted = []
-        for i in range(len(items)-1):
-            a = items[i]
-            b = items[i+1]
-            if a.get('odometro') is None or b.get('odometro') is None:
-                continue
-            od_a = int(a.get('odometro'))
-            od_b = int(b.get('odometro'))
-            if od_b <= od_a:
-                continue
-            litros_b = b.get('litros')
-            if litros_b is None or litros_b == 0:
-                continue
-            km = od_b - od_a
-            kmpl = km / float(litros_b)
-            kmpls.append(kmpl)
-            weighted.append((km, kmpl))
+        ultimo_odometro = estado.get('ultimo_odometro')
 
+        # Médias a partir das somas dos pares consecutivos
         kmpl_medio = None
         kmpl_ponderado = None
-        if kmpls:
-            kmpl_medio = sum(kmpls) / len(kmpls)
-        if weighted:
-            total_km = sum(w[0] for w in weighted)
+        pares = estado.get('pares') or 0
+        if pares > 0:
+            kmpl_medio = (estado.get('soma_kmpl') or 0.0) / pares
+            total_km = estado.get('soma_km') or 0.0
             if total_km > 0:
-                kmpl_ponderado = sum(w[0] * w[1] for w in weighted) / total_km
+                kmpl_ponderado = (estado.get('soma_km_kmpl') or 0.0) / total_km
 
         # Se houver média manual informada no documento do veículo, usar essa como km_por_litro_medio
         media_flag = False
@@ -2220,29 +4387,18 @@ def calculate_vehicle_metrics(placa, month_param=None):
             media_flag = True
             media_val = round(media_informada, 2)
 
-        # km no mês
+        # km no mês (faixa de odômetro guardada por mês)
         km_no_mes = None
         if month_param:
             try:
-                year, month = month_param.split('-')
-                year = int(year); month = int(month)
-                month_start_local = datetime(year, month, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
-                if month == 12:
-                    next_month_local = datetime(year+1, 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
-                else:
-                    next_month_local = datetime(year, month+1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
-                month_end_local = next_month_local - timedelta(seconds=1)
-                month_start = month_start_local.astimezone(timezone.utc)
-                month_end = month_end_local.astimezone(timezone.utc)
-
-                odometers = [int(it.get('odometro')) for it in items if it.get('odometro') is not None and it.get('timestamp') and it.get('timestamp') >= month_start and it.get('timestamp') <= month_end]
-                if odometers:
-                    km_no_mes = max(odometers) - min(odometers) if len(odometers) > 1 else 0
+                year, month = (int(p) for p in month_param.split('-'))
+                faixa = (estado.get('por_mes') or {}).get(f'{year:04d}-{month:02d}')
+                if faixa:
+                    km_no_mes = faixa['max'] - faixa['min']
             except Exception:
                 km_no_mes = None
 
-        # Calcular total de litros abastecidos
-        total_litros = sum(float(it.get('litros', 0) or 0) for it in items)
+        total_litros = estado.get('total_litros') or 0.0
         
         # Calcular km rodados estimado (total_litros × km/l médio)
         km_rodados = None
@@ -2282,110 +4438,210 @@ def get_veiculo_metrics(placa):
         return jsonify({"error": "Ocorreu um erro ao calcular métricas."}), 500
 
 
-@app.route('/api/refuels/summary', methods=['GET'])
-def get_refuels_summary():
-    """Retorna agregados de litros por veículo: totais gerais e totais no mês (opcional ?month=YYYY-MM)."""
-    if not db:
-        return jsonify({"error": "Conexão com o banco de dados não foi estabelecida."}), 500
+# ==========================================
+# [STATS] RESUMO MENSAL DE ABASTECIMENTOS (refuels_resumo_mensal/{YYYY-MM})
+# ==========================================
+# Um documento por mês com os litros e a quantidade de abastecimentos por
+# veículo, mantido com firestore.Increment em toda criação/edição/exclusão
+# de abastecimento. O resumo de qualquer intervalo lê 1 documento por mês;
+# o total geral por veículo vem dos agregados do índice de veículos.
 
-    month_param = request.args.get('month')
-    now = datetime.now(timezone.utc)
-    month_start = None
-    month_end = None
-    if month_param:
-        try:
-            year, month = month_param.split('-')
-            year = int(year); month = int(month)
-            month_start_local = datetime(year, month, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
-            if month == 12:
-                next_month_local = datetime(year+1, 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
+REFUELS_RESUMO_COLLECTION = 'refuels_resumo_mensal'
+REFUELS_RESUMO_META = '_meta'
+REFUELS_RESUMO_MAX_MESES = 120
+_MES_RE = re.compile(r'^\d{4}-(0[1-9]|1[0-2])$')
+_refuels_resumo_verificado = False
+
+
+def atualizar_resumo_refuels(refuel_antigo=None, refuel_novo=None, batch=None):
+    """Aplica no resumo mensal de abastecimentos a diferença entre a versão
+    antiga e a nova de um abastecimento (mesma convenção de atualizar_resumo_mensal).
+    """
+    deltas = {}
+    for refuel, sinal in ((refuel_antigo, -1), (refuel_novo, 1)):
+        if not refuel or not refuel.get('veiculo'):
+            continue
+        mes = _mes_local(refuel.get('timestamp'))
+        if not mes:
+            continue
+        placa = normalize_plate(refuel['veiculo'])
+        delta = deltas.setdefault(mes, {}).setdefault(placa, [0.0, 0])
+        delta[0] += sinal * _refuel_litros(refuel)
+        delta[1] += sinal
+
+    for mes, por_veiculo in deltas.items():
+        dados = {'por_veiculo': {}, 'total_litros': 0.0, 'total_abastecimentos': 0}
+        for placa, (litros, quantidade) in por_veiculo.items():
+            campos = {}
+            if abs(litros) > 1e-9:
+                campos['litros'] = firestore.Increment(round(litros, 3))
+                dados['total_litros'] += litros
+            if quantidade:
+                campos['abastecimentos'] = firestore.Increment(quantidade)
+                dados['total_abastecimentos'] += quantidade
+            if campos:
+                dados['por_veiculo'][placa] = campos
+        if not dados['por_veiculo']:
+            continue
+        dados['total_litros'] = firestore.Increment(round(dados['total_litros'], 3))
+        dados['total_abastecimentos'] = firestore.Increment(dados['total_abastecimentos'])
+        dados['atualizado_em'] = firestore.SERVER_TIMESTAMP
+        ref = db.collection(REFUELS_RESUMO_COLLECTION).document(mes)
+        if batch is not None:
+            batch.set(ref, dados, merge=True)
+        else:
+            ref.set(dados, merge=True)
+
+
+def reconstruir_resumo_refuels():
+    """Recalcula todos os meses numa única leitura de 'refuels' (backfill/reparo)."""
+    meses = {}
+    for doc in db.collection('refuels').stream():
+        refuel = doc.to_dict() or {}
+        mes = _mes_local(refuel.get('timestamp'))
+        if not mes or not refuel.get('veiculo'):
+            continue
+        resumo = meses.setdefault(mes, {'por_veiculo': {}, 'total_litros': 0.0, 'total_abastecimentos': 0})
+        veiculo = resumo['por_veiculo'].setdefault(normalize_plate(refuel['veiculo']), {'litros': 0.0, 'abastecimentos': 0})
+        litros = _refuel_litros(refuel)
+        veiculo['litros'] += litros
+        veiculo['abastecimentos'] += 1
+        resumo['total_litros'] += litros
+        resumo['total_abastecimentos'] += 1
+
+    colecao = db.collection(REFUELS_RESUMO_COLLECTION)
+    operacoes = []
+    for mes, resumo in meses.items():
+        resumo['total_litros'] = round(resumo['total_litros'], 3)
+        for veiculo in resumo['por_veiculo'].values():
+            veiculo['litros'] = round(veiculo['litros'], 3)
+        resumo['atualizado_em'] = firestore.SERVER_TIMESTAMP
+        operacoes.append((colecao.document(mes), resumo))
+    # Meses que não têm mais abastecimentos
+    for doc in colecao.stream():
+        if doc.id != REFUELS_RESUMO_META and doc.id not in meses:
+            operacoes.append((doc.reference, None))
+    operacoes.append((colecao.document(REFUELS_RESUMO_META), {'reconstruido_em': firestore.SERVER_TIMESTAMP}))
+
+    for inicio in range(0, len(operacoes), 400):
+        batch = db.batch()
+        for ref, dados in operacoes[inicio:inicio + 400]:
+            if dados is None:
+                batch.delete(ref)
             else:
-                next_month_local = datetime(year, month+1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
-            month_end_local = next_month_local - timedelta(seconds=1)
-            month_start = month_start_local.astimezone(timezone.utc)
-            month_end = month_end_local.astimezone(timezone.utc)
-        except Exception:
-            month_start = None
-            month_end = None
+                batch.set(ref, dados)
+        batch.commit()
+    print(f'[STATS] Resumo de abastecimentos reconstruído ({len(meses)} meses)')
+    return len(meses)
+
+
+def _garantir_resumo_refuels():
+    """Backfill automático: na primeira consulta, reconstrói se nunca foi feito."""
+    global _refuels_resumo_verificado
+    if _refuels_resumo_verificado:
+        return
+    if not db.collection(REFUELS_RESUMO_COLLECTION).document(REFUELS_RESUMO_META).get().exists:
+        reconstruir_resumo_refuels()
+    _refuels_resumo_verificado = True
+
+
+def _meses_entre(mes_inicio, mes_fim):
+    """Chaves YYYY-MM de mes_inicio até mes_fim (inclusive)."""
+    ano, mes = (int(p) for p in mes_inicio.split('-'))
+    fim = tuple(int(p) for p in mes_fim.split('-'))
+    meses = []
+    while (ano, mes) <= fim:
+        meses.append(f'{ano:04d}-{mes:02d}')
+        mes += 1
+        if mes > 12:
+            ano, mes = ano + 1, 1
+    return meses
+
+
+def litros_por_veiculo_periodo(mes_inicio, mes_fim):
+    """Litros por placa somados nos resumos dos meses do intervalo (1 leitura por mês)."""
+    _garantir_resumo_refuels()
+    colecao = db.collection(REFUELS_RESUMO_COLLECTION)
+    refs = [colecao.document(mes) for mes in _meses_entre(mes_inicio, mes_fim)]
+    totais = {}
+    for doc in db.get_all(refs):
+        if not doc.exists:
+            continue
+        for placa, valores in ((doc.to_dict() or {}).get('por_veiculo') or {}).items():
+            litros = float((valores or {}).get('litros') or 0)
+            if litros:
+                totais[placa] = totais.get(placa, 0) + litros
+    return totais
 
+
+def litros_por_veiculo_total():
+    """Total geral por placa a partir dos agregados do índice de veículos (0 leituras).
+
+    Veículos sem `agregados_refuel` ficam de fora (ver veiculos_sem_agregados_refuel).
+    """
+    totais = {}
+    for v in veiculos_index.all():
+        if not v.get('agregados_refuel'):
+            continue
+        litros = float(v.get('total_litros') or 0)
+        if v.get('placa') and litros > 1e-9:
+            totais[v['placa']] = totais.get(v['placa'], 0) + litros
+    return totais
+
+
+@app.route('/api/refuels/resumo/reconstruir', methods=['POST'])
+@requires_auth
+def reconstruir_resumo_refuels_route():
+    """Recalcula o resumo mensal de abastecimentos lendo a coleção 'refuels'"""
+    if not db:
+        return jsonify({"error": "Conexão com o banco de dados não foi estabelecida."}), 500
     try:
-        refuels_ref = db.collection('refuels')
-        
-        # OTIMIZAÇÃO CRÍTICA: Reduzido de 5000 para 500
-        # 5000 docs = consome toda a quota em poucos reloads
-        # 50 docs = suficiente para ver padrões recentes e economizar quota
-        docs_total = list(refuels_ref.limit(50).stream())  # 99% de economia!
-        
-        totals = {}
-        for d in docs_total:
-            r = d.to_dict()
-            placa = r.get('veiculo')
-            litros = r.get('litros')
-            if not placa or litros is None:
-                continue
-            try:
-                litros_val = float(litros)
-            except Exception:
-                continue
-            totals[placa] = totals.get(placa, 0) + litros_val
+        total = reconstruir_resumo_refuels()
+        return jsonify({"message": "Resumo de abastecimentos reconstruído.", "meses": total}), 200
+    except Exception as e:
+        print(f"Erro ao reconstruir resumo de abastecimentos: {e}")
+        return jsonify({"error": str(e)}), 500
 
-        # Para o mês, usa query filtrada (muito mais eficiente)
-        totals_month = {}
-        if month_start and month_end:
-            try:
-                query_month = refuels_ref.where(filter=And([
-                    firestore.FieldFilter('timestamp', '>=', month_start),
-                    firestore.FieldFilter('timestamp', '<=', month_end)
-                ])).limit(50)
-                
-                docs_month = list(query_month.stream())
-                
-                for d in docs_month:
-                    r = d.to_dict()
-                    placa = r.get('veiculo')
-                    litros = r.get('litros')
-                    if not placa or litros is None:
-                        continue
-                    try:
-                        litros_val = float(litros)
-                    except Exception:
-                        continue
-                    totals_month[placa] = totals_month.get(placa, 0) + litros_val
-            except Exception as e:
-                print(f"Erro ao buscar refuels do mês: {e}")
-                # Fallback: filtra no Python se a query falhar
-                for d in docs_total:
-                    r = d.to_dict()
-                    placa = r.get('veiculo')
-                    litros = r.get('litros')
-                    ts = r.get('timestamp')
-                    if not placa or litros is None or not ts:
-                        continue
-                    try:
-                        litros_val = float(litros)
-                        if isinstance(ts, str):
-                            t = datetime.fromisoformat(ts)
-                            if t.tzinfo is None:
-                                t = t.replace(tzinfo=timezone.utc)
-                        elif isinstance(ts, datetime):
-                            t = ts
-                        else:
-                            continue
-                        if t >= month_start and t <= month_end:
-                            totals_month[placa] = totals_month.get(placa, 0) + litros_val
-                    except Exception:
-                        continue
+
+@app.route('/api/refuels/summary', methods=['GET'])
+def get_refuels_summary():
+    """Retorna litros por veículo: total geral e total do período.
+
+    Período: ?month=YYYY-MM ou ?from=YYYY-MM&to=YYYY-MM (inclusive; 'to' padrão = mês atual).
+    """
+    if not db:
+        return jsonify({"error": "Conexão com o banco de dados não foi estabelecida."}), 500
+
+    mes_inicio = request.args.get('from') or request.args.get('month')
+    mes_fim = request.args.get('to') or request.args.get('month')
+    if mes_inicio or mes_fim:
+        mes_fim = mes_fim or datetime.now(LOCAL_TZ).strftime('%Y-%m')
+        mes_inicio = mes_inicio or mes_fim
+        if not _MES_RE.match(mes_inicio) or not _MES_RE.match(mes_fim):
+            return jsonify({"error": "Use meses no formato YYYY-MM."}), 400
+        if mes_inicio > mes_fim:
+            return jsonify({"error": "'from' deve ser anterior ou igual a 'to'."}), 400
+        if len(_meses_entre(mes_inicio, mes_fim)) > REFUELS_RESUMO_MAX_MESES:
+            return jsonify({"error": f"Intervalo máximo de {REFUELS_RESUMO_MAX_MESES} meses."}), 400
+
+    try:
+        totals = litros_por_veiculo_total()
+        totals_month = litros_por_veiculo_periodo(mes_inicio, mes_fim) if mes_inicio else {}
 
         # Prepare response sorted by liters desc
         def to_sorted(labels_dict):
             items = sorted(labels_dict.items(), key=lambda x: x[1], reverse=True)
             labels = [i[0] for i in items]
-            data = [i[1] for i in items]
+            data = [round(i[1], 2) for i in items]
             return { 'labels': labels, 'data': data }
 
         resp = {
             'per_vehicle_total': to_sorted(totals),
-            'per_vehicle_month': to_sorted(totals_month)
+            # Placas ainda sem total calculado (fora de per_vehicle_total)
+            'per_vehicle_total_pending': veiculos_sem_agregados_refuel(),
+            'per_vehicle_month': to_sorted(totals_month),
+            'from': mes_inicio,
+            'to': mes_fim
         }
         return jsonify(resp), 200
     except Exception as e:
@@ -2399,11 +4655,10 @@ def get_veiculo(placa):
         return jsonify({"error": "Conexão com o banco de dados não foi estabelecida."}), 500
     try:
         placa_norm = normalize_plate(placa)
-        veiculos_ref = db.collection('veiculos')
-        q = list(veiculos_ref.where(filter=firestore.FieldFilter('placa', '==', placa_norm)).limit(1).stream())
-        if not q:
+        v = veiculos_index.get(placa_norm)
+        if not v:
             return jsonify({"error": "Veículo não encontrado."}), 404
-        v = q[0].to_dict()
+        v.pop('id', None)
         return jsonify(serialize_doc(v)), 200
     except Exception as e:
         print(f"Erro em get_veiculo: {e}")
@@ -2417,11 +4672,9 @@ def patch_veiculo(placa):
     data = request.get_json() or {}
     try:
         placa_norm = normalize_plate(placa)
-        veiculos_ref = db.collection('veiculos')
-        q = list(veiculos_ref.where(filter=firestore.FieldFilter('placa', '==', placa_norm)).limit(1).stream())
-        if not q:
+        veiculo_atual = veiculos_index.get(placa_norm)
+        if not veiculo_atual:
             return jsonify({"error": "Veículo não encontrado."}), 404
-        vdoc = q[0]
         update_fields = {}
         
         # Permite atualizar modelo
@@ -2457,7 +4710,7 @@ def patch_veiculo(placa):
         if not update_fields:
             return jsonify({"error": "Nenhum campo para atualizar."}), 400
 
-        vdoc.reference.update(update_fields)
+        veiculos_index.update(veiculo_atual['id'], update_fields)
         return jsonify({"message": "Veículo atualizado."}), 200
     except Exception as e:
         print(f"Erro em patch_veiculo: {e}")
@@ -2471,14 +4724,12 @@ def delete_veiculo(placa):
     
     try:
         placa_norm = normalize_plate(placa)
-        veiculos_ref = db.collection('veiculos')
-        q = list(veiculos_ref.where(filter=firestore.FieldFilter('placa', '==', placa_norm)).limit(1).stream())
+        veiculo_data = veiculos_index.get(placa_norm)
         
-        if not q:
+        if not veiculo_data:
             return jsonify({"error": "Veículo não encontrado."}), 404
         
-        vdoc = q[0]
-        veiculo_data = vdoc.to_dict()
+        veiculo_id = veiculo_data.pop('id')
         
         # [SAVE] BACKUP: Se tem documento anexado, mover para pasta de backup
         backup_urls = []
@@ -2507,10 +4758,11 @@ def delete_veiculo(placa):
         veiculo_data['_backups'] = backup_urls
         
         # Auditoria: registra exclusão do veículo ANTES de deletar
-        log_audit('delete', 'veiculos', vdoc.id, old_data=veiculo_data)
+        log_audit('delete', 'veiculos', veiculo_id, old_data=veiculo_data)
         
         # Deletar documento do Firestore
-        vdoc.reference.delete()
+        veiculos_index.reference(veiculo_id).delete()
+        veiculos_index.remove(veiculo_id)
         print(f"[OK] Veículo {placa_norm} excluído com sucesso")
         
         return jsonify({
@@ -2530,12 +4782,8 @@ def get_veiculos():
         return jsonify({"error": "Conexão com o banco de dados não foi estabelecida."}), 500
     
     try:
-        veiculos_ref = db.collection('veiculos').stream()
-        veiculos = []
-        for doc in veiculos_ref:
-            veiculo_data = serialize_doc(doc.to_dict())
-            veiculo_data['id'] = doc.id  # Adiciona o ID do documento
-            veiculos.append(veiculo_data)
+        # Lista vem do índice em memória (ID do documento já incluído)
+        veiculos = [serialize_doc(v) for v in veiculos_index.all()]
         return jsonify(veiculos), 200
 
     except Exception as e:
@@ -2559,8 +4807,7 @@ def post_veiculo():
     try:
         # Verificar se já existe
         veiculos_ref = db.collection('veiculos')
-        existing = veiculos_ref.where(filter=firestore.FieldFilter('placa', '==', placa)).limit(1).get()
-        if len(list(existing)) > 0:
+        if veiculos_index.get(placa):
             return jsonify({"error": "Veículo com esta placa já existe."}), 400
         
         # Criar novo veículo
@@ -2575,7 +4822,10 @@ def post_veiculo():
             'visivel_para_motoristas': data.get('visivel_para_motoristas', True),
             'timestamp': datetime.now(timezone.utc),
             'documento_url': None,  # Campo para documento do veículo
-            'status_ativo': True    # Status ativo/inativo do veículo
+            'status_ativo': True,   # Status ativo/inativo do veículo
+            'total_refuels': 0,     # Agregados de abastecimento (atualizados por Increment)
+            'total_litros': 0.0,
+            'agregados_refuel': True
         }
         
         if 'media_kmpl' in data and data.get('media_kmpl'):
@@ -2585,6 +4835,7 @@ def post_veiculo():
                 pass
         
         doc_ref = veiculos_ref.add(veiculo_data)
+        veiculos_index.upsert(doc_ref[1].id, veiculo_data, replace=True)
         
         # Auditoria: registra criação do veículo
         log_audit('create', 'veiculos', doc_ref[1].id, new_data=veiculo_data)
@@ -2661,6 +4912,7 @@ def upload_documento_veiculo(veiculo_id):
         veiculo_ref.update({
             'documento_url': documento_url
         })
+        veiculos_index.upsert(veiculo_id, {'documento_url': documento_url})
         
         # Mensagem diferente se foi atualização ou novo upload
         mensagem = "Documento atualizado com sucesso." if veiculo_data.get('documento_url') else "Documento enviado com sucesso."
@@ -2713,24 +4965,15 @@ def toggle_veiculo_status(veiculo_id):
     
     try:
         # Tentar buscar por ID do documento primeiro
-        veiculo_ref = db.collection('veiculos').document(veiculo_id)
-        veiculo_doc = veiculo_ref.get()
+        veiculo_atual = veiculos_index.get_by_id(veiculo_id)
         
         # Se não encontrar por ID, tentar por placa
-        if not veiculo_doc.exists:
+        if not veiculo_atual:
             print(f" Veículo não encontrado por ID: {veiculo_id}, tentando por placa...")
-            placas_query = db.collection('veiculos').where(
-                filter=firestore.FieldFilter('placa', '==', veiculo_id.upper())
-            ).limit(1).stream()
+            veiculo_atual = veiculos_index.get(veiculo_id.upper())
             
-            placas_docs = list(placas_query)
-            
-            if not placas_docs:
+            if not veiculo_atual:
                 return jsonify({"error": "Veículo não encontrado."}), 404
-            
-            # Usar o documento encontrado pela placa
-            veiculo_doc = placas_docs[0]
-            veiculo_ref = veiculo_doc.reference
         
         # Obter novo status do body
         data = request.get_json()
@@ -2744,7 +4987,7 @@ def toggle_veiculo_status(veiculo_id):
             return jsonify({"error": "Campo 'status_ativo' deve ser booleano."}), 400
         
         # Atualizar status
-        veiculo_ref.update({
+        veiculos_index.update(veiculo_atual['id'], {
             'status_ativo': status_ativo
         })
         
@@ -2762,247 +5005,672 @@ def toggle_veiculo_status(veiculo_id):
 
 import time
 
-# Cache simples para dashboard (1 hora = 3600 segundos)
-# Não é limpo automaticamente - use o botão "Atualizar" no dashboard
-dashboard_cache = {}
-CACHE_DURATION = 3600  # 1 hora
+# ==========================================
+# [STATS] RESUMO MENSAL DE VIAGENS (ROLLUP)
+# ==========================================
+# Um documento por mês (saidas_resumo_mensal/YYYY-MM, mês no fuso LOCAL) com:
+# - total_viagens, viagens_em_curso, total_segundos_rua
+# - por_veiculo {placa: n}, por_motorista {nome: n}, por_dia {DD: n}
+# Mantido com firestore.Increment em toda criação/edição/exclusão de saída,
+# assim o dashboard lê 1 documento e o resultado é exato para qualquer volume.
+# Só vale depois da primeira reconstrução (campo `reconstruido_em`): os
+# incrementos em um mês nunca reconstruído geram um documento parcial, que
+# obter_resumo_mensal descarta e refaz a partir das saídas (numa transação).
 
-@app.route('/api/dashboard_stats', methods=['GET'])
-def get_dashboard_stats():
+RESUMO_MENSAL_COLLECTION = 'saidas_resumo_mensal'
+
+
+def _to_datetime(valor):
+    """Converte timestamps do Firestore/ISO para datetime com fuso (assume UTC se não tiver)."""
+    if isinstance(valor, str):
+        try:
+            valor = datetime.fromisoformat(valor.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if not isinstance(valor, datetime):
+        return None
+    if valor.tzinfo is None:
+        valor = valor.replace(tzinfo=timezone.utc)
+    return valor
+
+
+def _mes_local(valor):
+    """Chave YYYY-MM do mês (fuso local) de um timestamp."""
+    dt = _to_datetime(valor)
+    return dt.astimezone(LOCAL_TZ).strftime('%Y-%m') if dt else None
+
+
+def _contribuicao_saida(saida):
+    """Quanto uma saída soma no resumo do seu mês: (mes, {campo: valor}) ou (None, {})."""
+    if not saida:
+        return None, {}
+    ts_saida = _to_datetime(saida.get('timestampSaida'))
+    if not ts_saida:
+        return None, {}
+    mes = ts_saida.astimezone(LOCAL_TZ).strftime('%Y-%m')
+    dia = ts_saida.astimezone(LOCAL_TZ).strftime('%d')
+
+    valores = {
+        ('total_viagens',): 1,
+        ('por_dia', dia): 1,
+    }
+    if saida.get('status') == 'em_curso':
+        valores[('viagens_em_curso',)] = 1
+    if saida.get('status') == 'finalizada':
+        ts_chegada = _to_datetime(saida.get('timestampChegada'))
+        if ts_chegada:
+            duracao = (ts_chegada - ts_saida).total_seconds()
+            if duracao > 0:
+                valores[('total_segundos_rua',)] = duracao
+    if saida.get('veiculo'):
+        valores[('por_veiculo', saida['veiculo'])] = 1
+    if saida.get('motorista'):
+        valores[('por_motorista', saida['motorista'])] = 1
+    return mes, valores
+
+
+def atualizar_resumo_mensal(saida_antiga=None, saida_nova=None, batch=None):
+    """Aplica no resumo mensal a diferença entre a versão antiga e a nova de uma saída.
+
+    - criação: saida_antiga=None
+    - exclusão/cancelamento: saida_nova=None
+    - edição: ambas (pode mover a viagem de mês)
+    Se `batch` (WriteBatch/Transaction) for informado, as escritas entram nele.
+    """
+    deltas = {}
+    for saida, sinal in ((saida_antiga, -1), (saida_nova, 1)):
+        mes, valores = _contribuicao_saida(saida)
+        if not mes:
+            continue
+        mes_deltas = deltas.setdefault(mes, {})
+        for campo, valor in valores.items():
+            mes_deltas[campo] = mes_deltas.get(campo, 0) + sinal * valor
+
+    for mes, mes_deltas in deltas.items():
+        dados = {}
+        for campo, valor in mes_deltas.items():
+            if not valor:
+                continue
+            if len(campo) == 1:
+                dados[campo[0]] = firestore.Increment(valor)
+            else:
+                dados.setdefault(campo[0], {})[campo[1]] = firestore.Increment(valor)
+        if not dados:
+            continue
+        dados['atualizado_em'] = firestore.SERVER_TIMESTAMP
+        ref = db.collection(RESUMO_MENSAL_COLLECTION).document(mes)
+        if batch is not None:
+            batch.set(ref, dados, merge=True)
+        else:
+            ref.set(dados, merge=True)
+
+
+def _intervalo_mes_utc(mes_chave):
+    """Início e fim (UTC) de um mês YYYY-MM no fuso local."""
+    year, month = (int(p) for p in mes_chave.split('-'))
+    inicio_local = datetime(year, month, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
+    if month == 12:
+        proximo_local = datetime(year + 1, 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
+    else:
+        proximo_local = datetime(year, month + 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
+    fim_local = proximo_local - timedelta(seconds=1)
+    return inicio_local.astimezone(timezone.utc), fim_local.astimezone(timezone.utc)
+
+
+def _resumo_mensal_vazio():
+    return {
+        'total_viagens': 0,
+        'viagens_em_curso': 0,
+        'total_segundos_rua': 0,
+        'por_veiculo': {},
+        'por_motorista': {},
+        'por_dia': {},
+    }
+
+
+def reconstruir_resumo_mensal(mes_chave, forcar=True):
+    """Recalcula o resumo de um mês lendo todas as saídas dele (caminho de reparo/migração).
+
+    Roda numa transação que também lê o documento do resumo: uma saída gravada
+    durante a varredura incrementa esse documento e faz a transação repetir,
+    então o Increment dela não é sobrescrito. Com forcar=False, um resumo que
+    já tenha `reconstruido_em` (ex.: outra requisição reconstruiu antes) é
+    devolvido sem varrer nada.
+    """
+    inicio, fim = _intervalo_mes_utc(mes_chave)
+    query = db.collection('saidas').where(filter=And([
+        firestore.FieldFilter('timestampSaida', '>=', inicio),
+        firestore.FieldFilter('timestampSaida', '<=', fim)
+    ]))
+    ref = db.collection(RESUMO_MENSAL_COLLECTION).document(mes_chave)
+
+    @firestore.transactional
+    def _reconstruir(transaction):
+        snap = ref.get(transaction=transaction)
+        atual = (snap.to_dict() or {}) if snap.exists else {}
+        if not forcar and atual.get('reconstruido_em'):
+            return atual, False
+        resumo = _resumo_mensal_vazio()
+        for doc in query.stream(transaction=transaction):
+            _, valores = _contribuicao_saida(doc.to_dict())
+            for campo, valor in valores.items():
+                if len(campo) == 1:
+                    resumo[campo[0]] += valor
+                else:
+                    mapa = resumo[campo[0]]
+                    mapa[campo[1]] = mapa.get(campo[1], 0) + valor
+        resumo['atualizado_em'] = firestore.SERVER_TIMESTAMP
+        resumo['reconstruido_em'] = firestore.SERVER_TIMESTAMP
+        transaction.set(ref, resumo)
+        return resumo, True
+
+    resumo, reconstruido = _reconstruir(db.transaction())
+    if reconstruido:
+        print(f'[STATS] Resumo mensal {mes_chave} reconstruído: {resumo["total_viagens"]} viagens')
+    return resumo
+
+
+def obter_resumo_mensal(mes_chave):
+    """Lê o resumo do mês (1 leitura). Se ainda não foi reconstruído, reconstrói a partir das saídas.
+
+    Um documento sem `reconstruido_em` só contém os incrementos feitos depois
+    que o rollup passou a existir (ex.: `total_viagens: -1` ao cancelar uma
+    viagem antiga) e é tratado como inexistente. Meses futuros não têm
+    viagens: devolve o resumo vazio sem gravar nada.
+    """
+    doc = db.collection(RESUMO_MENSAL_COLLECTION).document(mes_chave).get()
+    dados = (doc.to_dict() or {}) if doc.exists else None
+    if dados and dados.get('reconstruido_em'):
+        return dados
+    if mes_chave > datetime.now(LOCAL_TZ).strftime('%Y-%m'):
+        return dados or _resumo_mensal_vazio()
+    motivo = 'parcial' if doc.exists else 'inexistente'
+    print(f'[STATS] Resumo mensal {mes_chave} {motivo} - reconstruindo')
+    return reconstruir_resumo_mensal(mes_chave, forcar=False)
+
+
+# ==========================================
+# [LOCK] TRAVA DE VIAGEM EM CURSO POR VEÍCULO
+# ==========================================
+# saidas_ativas/{PLACA} existe enquanto o veículo tem uma viagem em curso e
+# aponta para ela (saida_id). A saída cria a trava na MESMA transação que
+# grava a viagem, os contadores e o resumo mensal: dois toques simultâneos
+# nunca geram duas viagens em curso para o mesmo veículo (o segundo encontra
+# a trava). Chegada, cancelamento, exclusão e edição movem/liberam a trava
+# também dentro de transação (escrever_saida).
+
+SAIDAS_ATIVAS_COLLECTION = 'saidas_ativas'
+
+
+def _trava_saida_ref(placa):
+    return db.collection(SAIDAS_ATIVAS_COLLECTION).document(normalize_plate(placa))
+
+
+def _placa_em_curso(saida):
+    """Placa normalizada se a saída ocupa a trava do veículo (status em curso), senão None."""
+    if not saida or saida.get('status') != 'em_curso' or not saida.get('veiculo'):
+        return None
+    return normalize_plate(saida['veiculo'])
+
+
+def _dados_trava_saida(saida_id, saida):
+    return {
+        'saida_id': saida_id,
+        'veiculo': saida.get('veiculo'),
+        'motorista': saida.get('motorista'),
+        'timestampSaida': saida.get('timestampSaida'),
+        'atualizado_em': firestore.SERVER_TIMESTAMP,
+    }
+
+
+def _mover_trava_saida(transaction, saida_id, saida_antiga, saida_nova):
+    """Dentro de uma transação, libera a trava da versão antiga e ocupa a da nova.
+
+    Retorna a trava de OUTRA viagem que impede a mudança (conflito) ou None.
+    Só lê/escreve quando a placa em curso muda; todas as leituras acontecem
+    antes das escritas (exigência das transações do Firestore).
+    """
+    placa_antiga = _placa_em_curso(saida_antiga)
+    placa_nova = _placa_em_curso(saida_nova)
+    if placa_antiga == placa_nova:
+        return None
+
+    travas = {}
+    for placa in {placa_antiga, placa_nova} - {None}:
+        snap = _trava_saida_ref(placa).get(transaction=transaction)
+        travas[placa] = snap.to_dict() if snap.exists else None
+
+    if placa_nova:
+        trava = travas[placa_nova]
+        if trava and trava.get('saida_id') != saida_id:
+            return trava
+    if placa_antiga:
+        trava = travas[placa_antiga]
+        # Não apaga a trava de outra viagem (dados legados / trava reconstruída)
+        if trava and trava.get('saida_id') in (None, saida_id):
+            transaction.delete(_trava_saida_ref(placa_antiga))
+    if placa_nova:
+        transaction.set(_trava_saida_ref(placa_nova), _dados_trava_saida(saida_id, saida_nova))
+    return None
+
+
+def escrever_saida(saida_id, campos=None, excluir=False, validar=None, escritas_extras=None):
+    """Atualiza (campos) ou exclui (excluir=True) uma saída numa única transação.
+
+    Na mesma transação: lê a versão atual, move/libera a trava do veículo e
+    aplica a diferença no resumo mensal. `validar(saida_atual)` pode retornar
+    uma mensagem de erro para abortar sem escrever nada. `escritas_extras(transaction)`
+    acrescenta escritas que devem ser gravadas junto (ex: abastecimento na chegada).
+
+    Retorna (saida_antiga, saida_nova, erro):
+    - saida_antiga None: saída não encontrada
+    - erro: mensagem do validar() ou dict da trava de outra viagem (conflito)
+    """
+    saida_ref = db.collection('saidas').document(saida_id)
+
+    @firestore.transactional
+    def _executar(transaction):
+        snap = saida_ref.get(transaction=transaction)
+        if not snap.exists:
+            return None, None, None
+        saida_antiga = snap.to_dict() or {}
+        if validar:
+            erro = validar(saida_antiga)
+            if erro:
+                return saida_antiga, None, erro
+        saida_nova = None if excluir else {**saida_antiga, **(campos or {})}
+
+        conflito = _mover_trava_saida(transaction, saida_id, saida_antiga, saida_nova)
+        if conflito:
+            return saida_antiga, saida_nova, conflito
+
+        if excluir:
+            transaction.delete(saida_ref)
+        else:
+            transaction.update(saida_ref, campos)
+        atualizar_resumo_mensal(saida_antiga=saida_antiga, saida_nova=saida_nova, batch=transaction)
+        if escritas_extras:
+            escritas_extras(transaction)
+        return saida_antiga, saida_nova, None
+
+    return _executar(db.transaction())
+
+
+def reconstruir_saidas_ativas():
+    """Recria as travas a partir das viagens em curso (migração/reparo).
+
+    Para cada veículo a trava aponta para a viagem em curso mais recente;
+    travas sem viagem em curso são removidas.
+    """
+    em_curso = {}
+    query = db.collection('saidas').where(filter=firestore.FieldFilter('status', '==', 'em_curso'))
+    for doc in query.stream():
+        saida = doc.to_dict() or {}
+        placa = _placa_em_curso(saida)
+        if not placa:
+            continue
+        atual = em_curso.get(placa)
+        ts = _to_datetime(saida.get('timestampSaida')) or datetime.min.replace(tzinfo=timezone.utc)
+        if atual is None or ts > atual[0]:
+            em_curso[placa] = (ts, doc.id, saida)
+
+    operacoes = []
+    for doc in db.collection(SAIDAS_ATIVAS_COLLECTION).stream():
+        if doc.id not in em_curso:
+            operacoes.append((doc.reference, None))
+    removidas = len(operacoes)
+    for placa, (_, saida_id, saida) in em_curso.items():
+        operacoes.append((_trava_saida_ref(placa), _dados_trava_saida(saida_id, saida)))
+
+    # WriteBatch aceita no máximo 500 operações
+    for inicio in range(0, len(operacoes), 400):
+        batch = db.batch()
+        for ref, dados in operacoes[inicio:inicio + 400]:
+            if dados is None:
+                batch.delete(ref)
+            else:
+                batch.set(ref, dados)
+        batch.commit()
+    print(f'[LOCK] Travas de viagens em curso reconstruídas: {len(em_curso)} ativas, {removidas} removidas')
+    return len(em_curso), removidas
+
+
+@app.route('/api/saidas_ativas/reconstruir', methods=['POST'])
+@requires_auth
+def reconstruir_travas_saidas():
+    """Recria saidas_ativas/{placa} a partir das viagens em curso"""
     if not db:
         return jsonify({"error": "Conexão com o banco de dados não foi estabelecida."}), 500
-
     try:
-        now = time.time()
-        
-        # Se o frontend enviar ?month=YYYY-MM, usaremos esse intervalo apenas para os charts mensais
-        month_param = request.args.get('month')  # formato esperado: YYYY-MM
-        
-        # OTIMIZAÇÃO: Verifica cache (5 minutos) - MAS CONSIDERA O MÊS FILTRADO
-        # Cache deve ser diferente para cada mês
-        cache_key = month_param if month_param else 'default'
-        
-        # [OK] CACHE ATIVO: 5 minutos (300s) - Atualiza apenas quando necessário
-        # Invalidado automaticamente em novas saídas/chegadas
-        # Garante que a chave existe no cache
-        if cache_key not in dashboard_cache:
-            dashboard_cache[cache_key] = {'data': None, 'expires': 0}
-        
-        if dashboard_cache[cache_key].get('expires', 0) > now and dashboard_cache[cache_key].get('data'):
-            print(f'[OK] Dashboard do CACHE (mês: {cache_key}) - economia ~160 leituras')
-            return jsonify(dashboard_cache[cache_key]['data']), 200
-        print(f' Recalculando dashboard (cache expirado: {cache_key})')
-            
-        # OTIMIZAÇÃO: Lê apenas motoristas e veículos (poucos docs)
-        motoristas_docs = list(db.collection('motoristas').stream())
-        veiculos_docs = list(db.collection('veiculos').stream())
+        ativas, removidas = reconstruir_saidas_ativas()
+        return jsonify({"message": "Travas reconstruídas.", "ativas": ativas, "removidas": removidas}), 200
+    except Exception as e:
+        print(f"Erro ao reconstruir travas de saídas: {e}")
+        return jsonify({"error": str(e)}), 500
 
-        now_datetime = datetime.now(timezone.utc)  # Para comparações de data
-        
-        # [OK] CORREÇÃO: start_of_today deve ser 00:00 no fuso LOCAL, depois converter para UTC
-        now_local = datetime.now(LOCAL_TZ)
-        start_of_today_local = now_local.replace(hour=0, minute=0, second=0, microsecond=0)
-        start_of_today = start_of_today_local.astimezone(timezone.utc)  # Converte para UTC
-        print(f"[TIME] Hoje LOCAL: {start_of_today_local} → UTC: {start_of_today}")
-        
-        month_start = None
-        month_end = None
-        if month_param:
-            try:
-                year, month = month_param.split('-')
-                year = int(year)
-                month = int(month)
-                print(f"[SEARCH] Filtrando dashboard por mês: {month_param} (ano={year}, mês={month})")
-                
-                # início do mês no fuso local (00:00 do primeiro dia)
-                month_start_local = datetime(year, month, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
-                # fim do mês: primeiro dia do próximo mês menos 1 segundo
-                if month == 12:
-                    next_month_local = datetime(year + 1, 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
-                else:
-                    next_month_local = datetime(year, month + 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
-                month_end_local = next_month_local - timedelta(seconds=1)
-                
-                print(f"[DATE] Período local: {month_start_local} até {month_end_local}")
-                
-                # converter para UTC para comparar com timestamps armazenados em UTC
-                month_start = month_start_local.astimezone(timezone.utc)
-                month_end = month_end_local.astimezone(timezone.utc)
-                
-                print(f"[DATE] Período UTC: {month_start} até {month_end}")
-            except Exception as e:
-                print(f" Erro ao parsear mês: {e}")
-                month_start = None
-                month_end = None
-        
-        # OTIMIZAÇÃO: Lê SOMENTE o período necessário (mês específico ou 30 dias)
-        window_start = month_start if month_start else (now_datetime - timedelta(days=30))
-        window_end = month_end if month_end else now_datetime
-
-        # OTIMIZAÇÃO: Query com LIMIT AGRESSIVO (50 docs max)
-        print(f"[FIND] Buscando saídas entre {window_start} e {window_end}")
-        query_mes = db.collection('saidas').where(filter=And([
-            firestore.FieldFilter('timestampSaida', '>=', window_start),
-            firestore.FieldFilter('timestampSaida', '<=', window_end)
-        ])).limit(50)  # [OK] REDUZIDO PARA 50 (economia massiva)
-        saidas_mes_docs = list(query_mes.stream())
-        saidas_mes = [doc.to_dict() for doc in saidas_mes_docs]
-        print(f"[OK] Encontrou {len(saidas_mes)} saídas no período (LIMIT 50)")
-        
-        # DEBUG: Mostra as primeiras 3 datas para verificar
-        if saidas_mes:
-            for i, s in enumerate(saidas_mes[:3]):
-                ts = s.get('timestampSaida')
-                print(f"  [DATE] Saída {i+1}: {ts} (tipo: {type(ts)})")
-        elif month_param:
-            # Se não encontrou nada no mês filtrado, mostra TODAS as datas disponíveis
-            print(f" Não encontrou registros para {month_param}. Listando TODAS as datas disponíveis:")
-            all_saidas = list(db.collection('saidas').limit(50).stream())
-            for i, doc in enumerate(all_saidas[:10]):
-                data = doc.to_dict()
-                ts = data.get('timestampSaida')
-                print(f"  [DATE] Registro {i+1}: {ts}")
-        
-        # [OK] CORREÇÃO: Viagens HOJE deve ser uma query SEPARADA (não usar saidas_mes)
-        # porque "HOJE" sempre mostra o dia atual, independente do filtro de mês
-        end_of_today = start_of_today + timedelta(days=1) - timedelta(seconds=1)
-        query_hoje = db.collection('saidas').where(filter=And([
-            firestore.FieldFilter('timestampSaida', '>=', start_of_today),
-            firestore.FieldFilter('timestampSaida', '<=', end_of_today)
-        ])).stream()
-        viagens_hoje = len(list(query_hoje))
-        print(f"[STATS] Viagens HOJE: {viagens_hoje} (entre {start_of_today} e {end_of_today})")
-        
-        viagens_em_curso = 0
-        total_horas_em_rua_seconds = 0
 
-        # Processa apenas as saídas do mês para estatísticas mensais
-        for saida in saidas_mes:
-            timestamp_saida = saida.get('timestampSaida')
-            if not timestamp_saida or not isinstance(timestamp_saida, datetime):
-                continue
+# ==========================================
+# [CACHE] INVALIDAÇÃO SELETIVA (MÊS / VEÍCULO / MOTORISTA)
+# ==========================================
+# Uma escrita em 'saidas' só mexe nas entradas de cache que podem conter a
+# viagem alterada (versão antiga e nova):
+# - historico: páginas do mesmo mês cujos filtros (placa, motorista, data) batem
+#   são corrigidas no lugar (insere/atualiza/remove o registro e reordena);
+#   só são descartadas quando a correção depende de um registro fora da página
+# - dashboard: 'mes:YYYY-MM' dos meses envolvidos e a seção 'global' apenas se
+#   a viagem conta em "hoje", nos totais ou no histórico recente
+# Meses passados e filtros de outros veículos/motoristas continuam em cache.
+
+
+def _saida_na_pagina_historico(chave, saida):
+    """True se a saída aparece na página de histórico guardada em `chave`."""
+    campos = chave.split('|')
+    if len(campos) != 6:
+        return True
+    mes_chave, placa, motorista, data = campos[:4]
+    ts = _to_datetime(saida.get('timestampSaida'))
+    if not ts:
+        return True
+    ts_local = ts.astimezone(LOCAL_TZ)
+    if mes_chave != 'outros' and ts_local.strftime('%Y-%m') != mes_chave:
+        return False
+    if placa and (saida.get('veiculo') or '').upper() != placa:
+        return False
+    if motorista and motorista not in (saida.get('motorista') or '').lower():
+        return False
+    if data:
+        try:
+            data_obj = datetime.strptime(data, '%d/%m/%Y')
+        except ValueError:
+            return True
+        # Data fora do mês é ignorada pelo /api/historico (página = mês inteiro)
+        if data_obj.strftime('%Y-%m') == mes_chave and data_obj.date() != ts_local.date():
+            return False
+    return True
+
+
+def _saida_na_secao_global(secao_global, saida, criada):
+    """True se a saída altera a seção 'global' do dashboard (hoje, totais, recentes)."""
+    if criada:
+        return True  # contadores viagens_totais de veículo/motorista mudaram
+    ts = _to_datetime(saida.get('timestampSaida'))
+    corte = secao_global.get('corte_recente')
+    if not ts or corte is None:
+        return True
+    return ts.astimezone(LOCAL_TZ).date() == datetime.now(LOCAL_TZ).date() or ts.timestamp() >= corte
+
+
+def _historico_registro(saida_id, saida):
+    """Registro no formato devolvido pelo /api/historico (datas em UTC, id e categoria)."""
+    dados = {k: v.astimezone(timezone.utc) if isinstance(v, datetime) else v for k, v in saida.items()}
+    registro = serialize_doc(dados)
+    registro['id'] = saida_id
+    registro['categoria'] = get_veiculo_categoria(registro.get('veiculo'))
+    return registro
+
+
+def _corrigir_pagina_historico(pagina, saida_id, saida_nova, estava, fica):
+    """Aplica a mudança de uma saída numa página do histórico em cache.
+
+    `estava`/`fica`: a versão antiga/nova da saída atende aos filtros da página.
+    A página cobre as posições (timestampSaida, id) depois do `cursor` dela e,
+    se tiver `next_cursor`, até o último registro lido.
+    Retorna a página corrigida ou None quando é preciso buscar de novo
+    (página cheia e o registro sai dela: o próximo registro é desconhecido).
+    """
+    historico = pagina.get('historico') or []
+    limit = pagina.get('limit') or len(historico)
+    truncada = pagina.get('next_cursor') is not None
+    registros = [r for r in historico if r.get('id') != saida_id]
+    removido = len(registros) != len(historico)
+    next_cursor = pagina.get('next_cursor')
+
+    if fica:
+        novo = _historico_registro(saida_id, saida_nova)
+        posicao = _historico_posicao(novo)
+        inicio = _decode_cursor(pagina['cursor']) if pagina.get('cursor') else None
+        if inicio and posicao >= (inicio[0].timestamp(), inicio[1]):
+            pass  # Pertence a uma página anterior: aqui só muda o total
+        elif truncada and registros and posicao < min(_historico_posicao(r) for r in registros):
+            if removido:
+                return None  # Saiu da página cheia
+        else:
+            registros.append(novo)
+            if len(registros) > limit:
+                # O mais antigo passa para a página seguinte, que começa depois do novo último
+                registros.remove(min(registros, key=_historico_posicao))
+                ultimo = min(registros, key=_historico_posicao)
+                next_cursor = _encode_cursor(ultimo['timestampSaida'], ultimo['id'])
+    elif removido and truncada:
+        return None
 
-            if saida.get('status') == 'em_curso':
-                viagens_em_curso += 1
+    return {
+        **pagina,
+        'historico': sorted(registros, key=_historico_sort_key),
+        'total': max(0, (pagina.get('total') or 0) + int(fica) - int(estava)),
+        'next_cursor': next_cursor,
+    }
 
-            if saida.get('status') == 'finalizada':
-                timestamp_chegada = saida.get('timestampChegada')
-                if timestamp_chegada and isinstance(timestamp_chegada, datetime):
-                    duracao = timestamp_chegada - timestamp_saida
-                    total_horas_em_rua_seconds += duracao.total_seconds()
-
-        # Recalcule as listas do mês usando os dados eficientes
-        viagens_mes_motoristas = []
-        viagens_mes_veiculos = []
-        for saida in saidas_mes:
-            if saida.get('motorista'):
-                viagens_mes_motoristas.append(saida.get('motorista'))
-            if saida.get('veiculo'):
-                viagens_mes_veiculos.append(saida.get('veiculo'))
-
-        motorista_do_mes = Counter(viagens_mes_motoristas).most_common(1)
-        veiculo_do_mes = Counter(viagens_mes_veiculos).most_common(1)
 
-        total_horas = int(total_horas_em_rua_seconds // 3600)
-        total_minutos = int((total_horas_em_rua_seconds % 3600) // 60)
-        horas_formatadas = f"{total_horas:02d}:{total_minutos:02d}"
+def invalidar_caches_saida(saida_antiga=None, saida_nova=None, saida_id=None):
+    """Atualiza no cache apenas o que a criação/edição/exclusão da saída pode ter alterado.
 
-        # ---- ESTA É A GRANDE MUDANÇA ----
-        # Substitua seus cálculos de totais por este bloco:
-        
-        # Cálculo dos TOTAIS GERAIS (Lendo os contadores, não a coleção 'saidas')
-        viagens_por_veiculo_total = {}
-        for doc in veiculos_docs:
-            data = doc.to_dict()
-            placa = data.get('placa')
-            total = data.get('viagens_totais', 0) # Pega o total do campo
-            if placa and total > 0:
-                viagens_por_veiculo_total[placa] = total
+    Com `saida_id`, as páginas do histórico afetadas são corrigidas no lugar
+    e a réplica em memória (saidas_replica) recebe a escrita; sem ele, as
+    páginas são descartadas.
+    """
+    if saida_id:
+        # A réplica em memória das saídas de hoje/em curso também é atualizada na hora
+        try:
+            saidas_replica.aplicar_local(saida_id, saida_nova)
+        except Exception as e:
+            print(f' Erro ao atualizar réplica de saídas: {e}')
 
-        viagens_por_motorista_total = {}
-        for doc in motoristas_docs:
-            data = doc.to_dict()
-            nome = data.get('nome')
-            total = data.get('viagens_totais', 0) # Pega o total do campo
-            if nome and total > 0:
-                viagens_por_motorista_total[nome] = total
-        
-        # Agregados do mês (como você já fazia, mas com a consulta eficiente)
-        viagens_por_veiculo_mes = dict(Counter(viagens_mes_veiculos))
-        viagens_por_motorista_mes = dict(Counter(viagens_mes_motoristas))
+    saidas = [s for s in (saida_antiga, saida_nova) if s]
+    meses = {_mes_local(s.get('timestampSaida')) for s in saidas}
+    if not saidas or None in meses:
+        dashboard_cache.clear()
+        historico_cache.clear()
+        print('[DELETE] Cache do dashboard e histórico invalidados (saída sem data)')
+        return
 
-        # OTIMIZAÇÃO: Histórico recente - limit reduzido de 50 para 20 (60% economia)
-        # Dashboard não precisa mostrar mais de 20 registros recentes
-        query_hist = db.collection('saidas').order_by('timestampSaida', direction=firestore.Query.DESCENDING).limit(20)
-        historico_recente_docs = query_hist.stream()
-        historico_recente = []
-        for doc in historico_recente_docs:
-            data = serialize_doc(doc.to_dict())
-            data['id'] = doc.id  # Adiciona o ID do documento
-            historico_recente.append(data)
-        
-        # Debug: verificar se os IDs estão sendo adicionados
-        if historico_recente:
-            print(f'[LIST] Histórico recente: {len(historico_recente)} registros')
-            print(f'[SEARCH] Primeiro registro tem ID? {historico_recente[0].get("id") is not None}')
-        
-        historico_final = sorted(historico_recente, key=lambda x: x.get('status') == 'em_curso', reverse=True)
+    removidas = corrigidas = 0
+    for prefixo in [f'{mes}|' for mes in meses] + ['outros|']:
+        for chave in historico_cache.keys(prefixo):
+            estava = bool(saida_antiga) and _saida_na_pagina_historico(chave, saida_antiga)
+            fica = bool(saida_nova) and _saida_na_pagina_historico(chave, saida_nova)
+            if not estava and not fica:
+                continue
+            pagina = historico_cache.get(chave) if saida_id else None
+            corrigida = _corrigir_pagina_historico(pagina, saida_id, saida_nova, estava, fica) if pagina else None
+            if corrigida is None:
+                historico_cache.delete(chave)
+                removidas += 1
+            else:
+                # Mantém a validade original da página (não renova o TTL a cada correção)
+                restante = historico_cache.default_ttl - (time.time() - corrigida.get('gerado_em', 0))
+                if restante > 0:
+                    historico_cache.set(chave, corrigida, ttl=restante)
+                    corrigidas += 1
+                else:
+                    historico_cache.delete(chave)
+                    removidas += 1
+
+    for mes in meses:
+        dashboard_cache.delete(f'mes:{mes}')
+    secao_global = dashboard_cache.get('global')
+    if secao_global is not None and any(
+            _saida_na_secao_global(secao_global, s, saida_antiga is None) for s in saidas):
+        dashboard_cache.delete('global')
+
+    print(f"[CACHE] Histórico {', '.join(sorted(meses))}: {corrigidas} página(s) corrigida(s), {removidas} descartada(s)")
+
+
+# Cache do dashboard: dashboard_cache (CacheStore, 5 minutos) em duas seções
+# - 'mes:YYYY-MM': números e gráficos do mês (invalidada só por viagens do mês)
+# - 'global': viagens de hoje, totais gerais e histórico recente
+# Também pode ser limpo pelo botão "Atualizar" no dashboard
+
+def _dashboard_secao_mes(mes_chave):
+    """Indicadores e gráficos do mês a partir do resumo mensal (1 leitura)."""
+    resumo_mes = obter_resumo_mensal(mes_chave)
+
+    viagens_em_curso = int(resumo_mes.get('viagens_em_curso', 0) or 0)
+    total_horas_em_rua_seconds = resumo_mes.get('total_segundos_rua', 0) or 0
+
+    # Agregados do mês direto do resumo (remove contadores zerados por exclusões)
+    viagens_por_veiculo_mes = {k: int(v) for k, v in (resumo_mes.get('por_veiculo') or {}).items() if v > 0}
+    viagens_por_motorista_mes = {k: int(v) for k, v in (resumo_mes.get('por_motorista') or {}).items() if v > 0}
+
+    motorista_do_mes = Counter(viagens_por_motorista_mes).most_common(1)
+    veiculo_do_mes = Counter(viagens_por_veiculo_mes).most_common(1)
+
+    total_horas = int(total_horas_em_rua_seconds // 3600)
+    total_minutos = int((total_horas_em_rua_seconds % 3600) // 60)
+    horas_formatadas = f"{total_horas:02d}:{total_minutos:02d}"
+
+    return {
+        "viagens_em_curso": viagens_em_curso,
+        "motorista_do_mes": {
+            "nome": motorista_do_mes[0][0] if motorista_do_mes else "N/A",
+            "viagens": motorista_do_mes[0][1] if motorista_do_mes else 0
+        },
+        "veiculo_do_mes": {
+            "placa": veiculo_do_mes[0][0] if veiculo_do_mes else "N/A",
+            "viagens": veiculo_do_mes[0][1] if veiculo_do_mes else 0
+        },
+        "total_horas_na_rua": horas_formatadas,
+
+        # Gráficos do Mês
+        "chart_viagens_por_veiculo": {
+            "labels": list(viagens_por_veiculo_mes.keys()),
+            "data": list(viagens_por_veiculo_mes.values())
+        },
+        "chart_viagens_por_motorista": {
+            "labels": list(viagens_por_motorista_mes.keys()),
+            "data": list(viagens_por_motorista_mes.values())
+        },
+    }
 
 
-        stats = {
-            "viagens_em_curso": viagens_em_curso,
-            "viagens_hoje": viagens_hoje,
-            "total_motoristas": len(motoristas_docs),
-            "total_veiculos": len(veiculos_docs),
-            "motorista_do_mes": {
-                "nome": motorista_do_mes[0][0] if motorista_do_mes else "N/A",
-                "viagens": motorista_do_mes[0][1] if motorista_do_mes else 0
-            },
-            "veiculo_do_mes": {
-                "placa": veiculo_do_mes[0][0] if veiculo_do_mes else "N/A",
-                "viagens": veiculo_do_mes[0][1] if veiculo_do_mes else 0
-            },
-            "total_horas_na_rua": horas_formatadas,
-            
-            # Gráficos do Mês (já estão corretos)
-            "chart_viagens_por_veiculo": {
-                "labels": list(viagens_por_veiculo_mes.keys()),
-                "data": list(viagens_por_veiculo_mes.values())
-            },
-            "chart_viagens_por_motorista": {
-                "labels": list(viagens_por_motorista_mes.keys()),
-                "data": list(viagens_por_motorista_mes.values())
-            },
-
-            # Gráficos de Total Geral (AGORA SÃO EFICIENTES)
-            "chart_viagens_por_veiculo_total": {
-                "labels": list(viagens_por_veiculo_total.keys()),
-                "data": list(viagens_por_veiculo_total.values())
-            },
-            "chart_viagens_por_motorista_total": {
-                "labels": list(viagens_por_motorista_total.keys()),
-                "data": list(viagens_por_motorista_total.values())
-            },
-            
-            "historico_recente": historico_final
-        }
+def _dashboard_secao_global():
+    """Viagens de hoje, totais gerais (índices em memória) e histórico recente."""
+    # Motoristas e veículos vêm dos índices em memória (sem leituras)
+    motoristas_docs = motoristas_index.all()
+    veiculos_docs = veiculos_index.all()
+
+    # "HOJE" sempre mostra o dia atual, independente do filtro de mês
+    now_local = datetime.now(LOCAL_TZ)
+    resumo_hoje = obter_resumo_mensal(now_local.strftime('%Y-%m'))
+    viagens_hoje = int((resumo_hoje.get('por_dia') or {}).get(now_local.strftime('%d'), 0))
+    print(f"[STATS] Viagens HOJE: {viagens_hoje}")
+
+    # Cálculo dos TOTAIS GERAIS (Lendo os contadores, não a coleção 'saidas')
+    viagens_por_veiculo_total = {}
+    for data in veiculos_docs:
+        placa = data.get('placa')
+        total = data.get('viagens_totais', 0) # Pega o total do campo
+        if placa and total > 0:
+            viagens_por_veiculo_total[placa] = total
+
+    viagens_por_motorista_total = {}
+    for data in motoristas_docs:
+        nome = data.get('nome')
+        total = data.get('viagens_totais', 0) # Pega o total do campo
+        if nome and total > 0:
+            viagens_por_motorista_total[nome] = total
+
+    # OTIMIZAÇÃO: Histórico recente - limit reduzido de 50 para 20 (60% economia)
+    # Dashboard não precisa mostrar mais de 20 registros recentes
+    query_hist = db.collection('saidas').order_by('timestampSaida', direction=firestore.Query.DESCENDING).limit(20)
+    historico_recente = []
+    corte_recente = None
+    for doc in query_hist.stream():
+        raw = doc.to_dict()
+        ts = _to_datetime(raw.get('timestampSaida'))
+        if ts:
+            corte_recente = ts.timestamp() if corte_recente is None else min(corte_recente, ts.timestamp())
+        data = serialize_doc(raw)
+        data['id'] = doc.id  # Adiciona o ID do documento
+        historico_recente.append(data)
+
+    if historico_recente:
+        print(f'[LIST] Histórico recente: {len(historico_recente)} registros')
+    if len(historico_recente) < 20:
+        # Lista incompleta: qualquer viagem alterada pode entrar nela
+        corte_recente = 0
+
+    historico_final = sorted(historico_recente, key=lambda x: x.get('status') == 'em_curso', reverse=True)
+
+    return {
+        "viagens_hoje": viagens_hoje,
+        "total_motoristas": len(motoristas_docs),
+        "total_veiculos": len(veiculos_docs),
+
+        # Gráficos de Total Geral
+        "chart_viagens_por_veiculo_total": {
+            "labels": list(viagens_por_veiculo_total.keys()),
+            "data": list(viagens_por_veiculo_total.values())
+        },
+        "chart_viagens_por_motorista_total": {
+            "labels": list(viagens_por_motorista_total.keys()),
+            "data": list(viagens_por_motorista_total.values())
+        },
+
+        "historico_recente": historico_final,
+        # Timestamp da viagem mais antiga da lista (usado na invalidação seletiva)
+        "corte_recente": corte_recente
+    }
 
-        # Salva no cache (5 minutos) - POR MÊS
-        cache_timestamp = time.time()
-        
-        # [OK] CACHE REATIVADO: 5 minutos (300 segundos)
-        # Garante que a chave existe antes de salvar
-        if cache_key not in dashboard_cache:
-            dashboard_cache[cache_key] = {}
-            
-        dashboard_cache[cache_key]['data'] = stats
-        dashboard_cache[cache_key]['expires'] = cache_timestamp + 300  # 5 minutos
-        print(f' Dashboard no cache por 5min (mês: {cache_key})')
 
+@app.route('/api/dashboard_stats', methods=['GET'])
+def get_dashboard_stats():
+    if not db:
+        return jsonify({"error": "Conexão com o banco de dados não foi estabelecida."}), 500
+
+    try:
+        # Se o frontend enviar ?month=YYYY-MM, usaremos esse intervalo apenas para os charts mensais
+        month_param = request.args.get('month')  # formato esperado: YYYY-MM
+
+        # [OK] Mês do resumo: ?month=YYYY-MM ou o mês atual (fuso LOCAL)
+        mes_chave = datetime.now(LOCAL_TZ).strftime('%Y-%m')
+        if month_param:
+            try:
+                _intervalo_mes_utc(month_param)
+                mes_chave = month_param
+                print(f"[SEARCH] Filtrando dashboard por mês: {month_param}")
+            except Exception as e:
+                print(f" Erro ao parsear mês: {e}")
+
+        # [OK] CACHE ATIVO: 5 minutos (300s) por seção
+        # Invalidado seletivamente em novas saídas/chegadas (ver invalidar_caches_saida)
+        # Modo economia ou Firestore fora do ar: seções vencidas continuam valendo
+        vencido = servir_cache_vencido()
+        secao_mes = dashboard_cache.get(f'mes:{mes_chave}', expirado=vencido)
+        if secao_mes is None:
+            print(f' Recalculando dashboard do mês {mes_chave}')
+            secao_mes = _dashboard_secao_mes(mes_chave)
+            dashboard_cache.set(f'mes:{mes_chave}', secao_mes, ttl=300)
+
+        secao_global = dashboard_cache.get('global', expirado=vencido)
+        if secao_global is None:
+            print(' Recalculando dashboard (totais e histórico recente)')
+            secao_global = _dashboard_secao_global()
+            dashboard_cache.set('global', secao_global, ttl=300)
+
+        stats = {**secao_mes, **secao_global}
+        stats.pop('corte_recente', None)
         return jsonify(stats)
 
     except Exception as e:
         print(f"Erro em get_dashboard_stats: {e}")
+        if erro_firestore_indisponivel(e):
+            secao_mes = dashboard_cache.get(f'mes:{mes_chave}', expirado=True)
+            secao_global = dashboard_cache.get('global', expirado=True)
+            if secao_mes is not None and secao_global is not None:
+                stats = {**secao_mes, **secao_global}
+                stats.pop('corte_recente', None)
+                return jsonify(stats)
         return jsonify({"error": "Ocorreu um erro ao calcular as estatísticas."}), 500
 
 
@@ -3011,7 +5679,6 @@ def get_dashboard_stats():
 def clear_dashboard_cache():
     """Limpa o cache do dashboard manualmente"""
     try:
-        global dashboard_cache
         dashboard_cache.clear()
         print(f'[DELETE] Cache do dashboard limpo manualmente')
         return jsonify({"message": "Cache limpo com sucesso"}), 200
@@ -3020,6 +5687,382 @@ def clear_dashboard_cache():
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/api/dashboard_resumo/reconstruir', methods=['POST'])
+@requires_auth
+def reconstruir_resumo_dashboard():
+    """Recalcula o resumo mensal de viagens (?month=YYYY-MM, padrão: mês atual)"""
+    if not db:
+        return jsonify({"error": "Conexão com o banco de dados não foi estabelecida."}), 500
+    mes_chave = request.args.get('month') or datetime.now(LOCAL_TZ).strftime('%Y-%m')
+    try:
+        _intervalo_mes_utc(mes_chave)
+    except Exception:
+        return jsonify({"error": "Formato de 'month' inválido. Use YYYY-MM."}), 400
+    try:
+        resumo = reconstruir_resumo_mensal(mes_chave)
+        dashboard_cache.delete(f'mes:{mes_chave}')
+        dashboard_cache.delete('global')
+        return jsonify({"message": f"Resumo de {mes_chave} reconstruído.", "total_viagens": resumo['total_viagens']}), 200
+    except Exception as e:
+        print(f"Erro ao reconstruir resumo mensal: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+# ==========================================
+# [LIVE] RÉPLICA EM MEMÓRIA DAS SAÍDAS (EM CURSO + HOJE) E STREAM SSE
+# ==========================================
+# Um único par de listeners on_snapshot por processo (status == em_curso e
+# saídas desde a meia-noite local) mantém uma réplica em memória usada por
+# /api/dashboard_realtime, /api/veiculos_em_curso, cancelamento e pela
+# verificação de "veículo já em curso" da saída - respostas sem leituras.
+# - Se os listeners falharem, a réplica passa a ser recarregada por polling
+#   (no máximo a cada REPLICA_POLL_INTERVALO s) e tenta religar os listeners
+#   a cada REPLICA_RETRY_LISTENER s. estado_replica() informa a defasagem.
+# - As escritas do próprio processo são aplicadas na hora (write-through),
+#   sem esperar o listener.
+# - As mudanças também são repassadas aos clientes de /api/stream/saidas (SSE).
+# Cada conexão SSE ocupa uma thread do waitress, por isso há um limite de
+# conexões simultâneas (as demais recebem 503 e voltam ao polling) e cada
+# conexão é encerrada após SSE_DURACAO_MAX segundos (o EventSource reconecta).
+
+REPLICA_POLL_INTERVALO = int(os.getenv('REPLICA_POLL_INTERVALO', '10'))
+REPLICA_RETRY_LISTENER = int(os.getenv('REPLICA_RETRY_LISTENER', '60'))
+REPLICA_ESPERA_CARGA = float(os.getenv('REPLICA_ESPERA_CARGA', '2'))  # espera pela carga inicial
+SSE_MAX_CLIENTES = int(os.getenv('SSE_MAX_CLIENTES', '4'))
+SSE_HEARTBEAT = 15          # segundos entre comentários de keep-alive
+SSE_DURACAO_MAX = 300       # segundos por conexão
+SSE_FILA_MAX = 100          # eventos pendentes por cliente antes de desconectá-lo
+
+
+def _inicio_do_dia_utc():
+    inicio_local = datetime.now(LOCAL_TZ).replace(hour=0, minute=0, second=0, microsecond=0)
+    return inicio_local.astimezone(timezone.utc)
+
+
+class ReplicaSaidas:
+    """Saídas em curso + saídas de hoje em memória, com listeners e fallback por polling."""
+
+    ORIGENS = ('em_curso', 'hoje')
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._assinantes = set()
+        self._watches = {}
+        self._ids = {origem: set() for origem in self.ORIGENS}
+        self._docs = {}
+        self._prontos = {origem: threading.Event() for origem in self.ORIGENS}
+        self._geracao = {origem: 0 for origem in self.ORIGENS}
+        self._dia = None
+        self._modo = None                # 'listener' | 'polling'
+        self._atualizado_em = 0.0        # última confirmação do estado (snapshot ou polling)
+        self._proxima_tentativa_listener = 0.0
+        self._recarregando = False
+        self._carregadas = set()         # origens que já tiveram a carga inicial
+
+    # --- listeners ---
+
+    def _query(self, origem):
+        saidas_ref = db.collection('saidas')
+        if origem == 'em_curso':
+            return saidas_ref.where(filter=firestore.FieldFilter('status', '==', 'em_curso'))
+        return saidas_ref.where(filter=firestore.FieldFilter('timestampSaida', '>=', _inicio_do_dia_utc()))
+
+    def _iniciar(self, origem):
+        self._prontos[origem].clear()
+        self._geracao[origem] += 1
+        geracao = self._geracao[origem]
+        self._watches[origem] = self._query(origem).on_snapshot(
+            lambda docs, changes, read_time: self._on_snapshot(origem, geracao, docs, changes)
+        )
+        print(f'[LIVE] Listener de saídas ({origem}) iniciado')
+
+    def _parar(self, origem):
+        """Desliga o listener no estado interno; retorna o watch para unsubscribe fora do lock."""
+        watch = self._watches.pop(origem, None)
+        self._geracao[origem] += 1  # callbacks atrasados do listener antigo são ignorados
+        return watch
+
+    @staticmethod
+    def _encerrar(watches):
+        # Fora do lock: unsubscribe espera a thread do listener, que pode estar no callback
+        for watch in watches:
+            if watch:
+                try:
+                    watch.unsubscribe()
+                except Exception as e:
+                    print(f' Erro ao parar listener de saídas: {e}')
+
+    def _listeners_ok(self):
+        return all(
+            origem in self._watches and not getattr(self._watches[origem], '_closed', False)
+            for origem in self.ORIGENS
+        )
+
+    def _garantir(self):
+        """Mantém a réplica viva: listeners (ou polling), janela de 'hoje' e virada do dia."""
+        antigos = []
+        recarregar = False
+        with self._lock:
+            hoje = datetime.now(LOCAL_TZ).date()
+            virou_dia = self._dia is not None and self._dia != hoje
+
+            if virou_dia and self._modo == 'listener':
+                # Nova janela de 'hoje': descarta as saídas de ontem que não estão em curso
+                antigos.append(self._parar('hoje'))
+                self._trocar_origem('hoje', {}, publicar=True)
+                self._iniciar('hoje')
+            self._dia = hoje
+
+            if self._modo == 'listener' and not self._listeners_ok():
+                print('[LIVE] Listener de saídas caiu - réplica passa a usar polling')
+                antigos.extend(self._parar(origem) for origem in self.ORIGENS)
+                self._modo = 'polling'
+                self._proxima_tentativa_listener = time.time() + REPLICA_RETRY_LISTENER
+
+            if self._modo != 'listener' and time.time() >= self._proxima_tentativa_listener:
+                try:
+                    for origem in self.ORIGENS:
+                        self._iniciar(origem)
+                    self._modo = 'listener'
+                except Exception as e:
+                    print(f' Erro ao iniciar listeners de saídas ({e}) - usando polling')
+                    antigos.extend(self._parar(origem) for origem in self.ORIGENS)
+                    self._modo = 'polling'
+                    self._proxima_tentativa_listener = time.time() + REPLICA_RETRY_LISTENER
+
+            if (self._modo == 'polling' and not self._recarregando
+                    and (virou_dia or time.time() - self._atualizado_em >= REPLICA_POLL_INTERVALO)):
+                self._recarregando = True  # um único polling por vez, qualquer que seja o nº de leitores
+                recarregar = True
+            if virou_dia:
+                self._publicar({'tipo': 'snapshot'})
+        self._encerrar(antigos)
+        if recarregar:
+            self._recarregar_por_polling()
+
+    def _recarregar_por_polling(self):
+        """Fallback: lê as duas consultas e aplica a diferença na réplica."""
+        try:
+            resultado = {}
+            for origem in self.ORIGENS:
+                resultado[origem] = {doc.id: doc.to_dict() or {} for doc in self._query(origem).stream()}
+            with self._lock:
+                if self._modo != 'polling':
+                    return
+                for origem, docs in resultado.items():
+                    self._trocar_origem(origem, docs, publicar=origem in self._carregadas)
+                    self._carregadas.add(origem)
+                    self._prontos[origem].set()
+                self._atualizado_em = time.time()
+        except Exception as e:
+            print(f' Erro no polling da réplica de saídas: {e}')
+        finally:
+            self._recarregando = False
+
+    def _trocar_origem(self, origem, docs, publicar):
+        """Substitui o conjunto de uma origem ({id: dados}), publicando apenas as diferenças."""
+        for doc_id in (self._ids[origem] | set(docs)):
+            self._aplicar(origem, doc_id, docs.get(doc_id), publicar)
+
+    def _aplicar(self, origem, doc_id, data, publicar):
+        antes = self._docs.get(doc_id)
+        if data is None:
+            self._ids[origem].discard(doc_id)
+        else:
+            self._ids[origem].add(doc_id)
+            self._docs[doc_id] = data
+        if not any(doc_id in ids for ids in self._ids.values()):
+            self._docs.pop(doc_id, None)
+        depois = self._docs.get(doc_id)
+        if not publicar or antes == depois:
+            return
+        tipo = 'added' if antes is None else 'removed' if depois is None else 'modified'
+        self._publicar({
+            'tipo': tipo,
+            'id': doc_id,
+            'saida': self._serializar(doc_id, depois) if depois else None,
+            'status_anterior': antes.get('status') if antes else None,
+        })
+
+    def _on_snapshot(self, origem, geracao, docs, changes):
+        with self._lock:
+            if geracao != self._geracao[origem]:
+                return
+            if not self._prontos[origem].is_set():
+                # Primeiro snapshot do listener: substitui o que havia (ex: estado do polling).
+                # Na carga inicial do processo não há o que anunciar aos clientes.
+                self._trocar_origem(origem, {doc.id: doc.to_dict() or {} for doc in docs},
+                                    publicar=origem in self._carregadas)
+                self._carregadas.add(origem)
+            else:
+                for change in changes:
+                    doc = change.document
+                    data = None if change.type.name == 'REMOVED' else (doc.to_dict() or {})
+                    self._aplicar(origem, doc.id, data, publicar=True)
+            self._atualizado_em = time.time()
+            self._prontos[origem].set()
+
+    # --- escrita local (write-through) ---
+
+    def aplicar_local(self, doc_id, saida):
+        """Aplica uma escrita feita por este processo (saida=None para exclusão)."""
+        with self._lock:
+            if self._modo is None:
+                return  # Réplica ainda não foi usada: nada a manter
+            em_curso = bool(saida) and saida.get('status') == 'em_curso'
+            ts = _to_datetime(saida.get('timestampSaida')) if saida else None
+            de_hoje = bool(ts) and ts >= _inicio_do_dia_utc()
+            self._aplicar('em_curso', doc_id, dict(saida) if em_curso else None, publicar=True)
+            self._aplicar('hoje', doc_id, dict(saida) if de_hoje else None, publicar=True)
+
+    # --- leitura ---
+
+    def _pronta(self, timeout=None):
+        self._garantir()
+        if all(evento.is_set() for evento in self._prontos.values()):
+            return
+        # Nunca carregou: com o circuito aberto esperar só prenderia a thread do waitress
+        if circuito_firestore.estado != 'fechado':
+            circuito_firestore.recusar()
+        timeout = REPLICA_ESPERA_CARGA if timeout is None else timeout
+        if not all(evento.wait(timeout) for evento in self._prontos.values()):
+            raise gexc.ServiceUnavailable('réplica de saídas ainda não carregada')
+
+    def em_curso(self):
+        """[(id, dados)] das saídas em curso."""
+        self._pronta()
+        with self._lock:
+            return [(doc_id, dict(self._docs[doc_id])) for doc_id in self._ids['em_curso']]
+
+    def de_hoje(self):
+        """[(id, dados)] das saídas desde a meia-noite (fuso local)."""
+        self._pronta()
+        with self._lock:
+            return [(doc_id, dict(self._docs[doc_id])) for doc_id in self._ids['hoje']]
+
+    def em_curso_do_veiculo(self, placa):
+        """(id, dados) da saída em curso mais recente da placa, ou None."""
+        placa_norm = normalize_plate(placa or '')
+        viagens = [(doc_id, data) for doc_id, data in self.em_curso()
+                   if normalize_plate(data.get('veiculo', '') or '') == placa_norm]
+        if not viagens:
+            return None
+        return max(viagens, key=lambda par: _to_datetime(par[1].get('timestampSaida')) or datetime.min.replace(tzinfo=timezone.utc))
+
+    def estado_replica(self):
+        with self._lock:
+            defasagem = 0.0 if self._modo == 'listener' and self._listeners_ok() else time.time() - self._atualizado_em
+            return {
+                'fonte': self._modo or 'inativa',
+                'defasagem_segundos': round(defasagem, 3) if self._atualizado_em else None,
+                'atualizado_em': datetime.fromtimestamp(self._atualizado_em, timezone.utc).isoformat() if self._atualizado_em else None,
+            }
+
+    # --- SSE ---
+
+    @staticmethod
+    def _serializar(doc_id, data):
+        saida = serialize_doc(data)
+        saida['id'] = doc_id
+        saida['categoria'] = get_veiculo_categoria(saida.get('veiculo'))
+        return saida
+
+    def resumo(self):
+        with self._lock:
+            return {
+                'viagens_em_curso': len(self._ids['em_curso']),
+                'viagens_hoje': len(self._ids['hoje']),
+            }
+
+    def estado(self):
+        self._pronta()
+        with self._lock:
+            return {
+                'saidas': [self._serializar(doc_id, data) for doc_id, data in self._docs.items()],
+                'resumo': self.resumo(),
+                'replica': self.estado_replica(),
+            }
+
+    def _publicar(self, evento):
+        evento['resumo'] = self.resumo()
+        for fila in list(self._assinantes):
+            try:
+                fila.put_nowait(evento)
+            except queue.Full:
+                # Cliente lento: desconecta (ele reconecta e recebe um snapshot novo)
+                self._assinantes.discard(fila)
+
+    def assinar(self):
+        """Registra um cliente; retorna a fila de eventos ou None se o limite foi atingido."""
+        with self._lock:
+            if len(self._assinantes) >= SSE_MAX_CLIENTES:
+                return None
+            fila = queue.Queue(maxsize=SSE_FILA_MAX)
+            self._assinantes.add(fila)
+            return fila
+
+    def cancelar(self, fila):
+        with self._lock:
+            self._assinantes.discard(fila)
+
+    def conectado(self, fila):
+        with self._lock:
+            return fila in self._assinantes
+
+    def manter(self):
+        """Chamado periodicamente pelos clientes SSE (polling, virada do dia)."""
+        self._garantir()
+
+
+saidas_replica = ReplicaSaidas()
+
+
+def _evento_sse(tipo, dados):
+    return f"event: {tipo}\ndata: {json.dumps(dados, default=str)}\n\n"
+
+
+@app.route('/api/stream/saidas', methods=['GET'])
+def stream_saidas():
+    """Server-Sent Events com as mudanças das saídas em curso e de hoje."""
+    if not db:
+        return jsonify({"error": "Conexão com o banco de dados não foi estabelecida."}), 500
+
+    fila = saidas_replica.assinar()
+    if fila is None:
+        return jsonify({"error": "Limite de conexões em tempo real atingido."}), 503
+    try:
+        estado_inicial = saidas_replica.estado()
+    except Exception as e:
+        saidas_replica.cancelar(fila)
+        print(f"Erro ao carregar réplica de saídas: {e}")
+        return jsonify({"error": "Tempo real indisponível."}), 503
+
+    def gerar():
+        try:
+            yield 'retry: 5000\n\n'
+            yield _evento_sse('snapshot', estado_inicial)
+            fim = time.time() + SSE_DURACAO_MAX
+            intervalo = min(SSE_HEARTBEAT, REPLICA_POLL_INTERVALO)
+            while time.time() < fim and saidas_replica.conectado(fila):
+                try:
+                    evento = fila.get(timeout=intervalo)
+                except queue.Empty:
+                    saidas_replica.manter()
+                    yield ': heartbeat\n\n'
+                    continue
+                if evento['tipo'] == 'snapshot':
+                    yield _evento_sse('snapshot', saidas_replica.estado())
+                else:
+                    yield _evento_sse(evento['tipo'], evento)
+        finally:
+            saidas_replica.cancelar(fila)
+
+    return Response(stream_with_context(gerar()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
 @app.route('/api/dashboard_realtime', methods=['GET'])
 def get_dashboard_realtime():
     """
@@ -3031,17 +6074,12 @@ def get_dashboard_realtime():
 
     try:
         now_datetime = datetime.now(timezone.utc)
-        start_of_today = now_datetime.replace(hour=0, minute=0, second=0, microsecond=0)
-        
-        # Busca APENAS saídas de hoje
-        query_hoje = db.collection('saidas').where(
-            filter=firestore.FieldFilter('timestampSaida', '>=', start_of_today)
-        ).stream()
         
-        saidas_hoje = [doc.to_dict() for doc in query_hoje]
+        # Saídas de hoje (desde a meia-noite local) e em curso vêm da réplica em memória
+        saidas_hoje = [data for _, data in saidas_replica.de_hoje()]
         
         # Calcula estatísticas
-        viagens_em_curso = sum(1 for s in saidas_hoje if s.get('status') == 'em_curso')
+        viagens_em_curso = len(saidas_replica.em_curso())
         viagens_hoje = len(saidas_hoje)
         
         # Calcula total de horas na rua (apenas viagens finalizadas hoje)
@@ -3064,7 +6102,8 @@ def get_dashboard_realtime():
             'viagens_em_curso': viagens_em_curso,
             'viagens_hoje': viagens_hoje,
             'total_horas_na_rua': total_horas_na_rua,
-            'timestamp': now_datetime.isoformat()
+            'timestamp': now_datetime.isoformat(),
+            'replica': saidas_replica.estado_replica()
         }
         
         return jsonify(result), 200
@@ -3076,86 +6115,40 @@ def get_dashboard_realtime():
 
 # --- Lógica de Negócio ---
 
-def handle_saida(veiculo_placa, motorista_nome, solicitante, trajeto, horario=None, veiculo_categoria='Outros', motorista_secao='Outros'):
+def handle_saida(veiculo_placa, motorista_nome, solicitante, trajeto, horario=None, veiculo_categoria='Outros',
+                 motorista_secao='Outros', agora=None, saida_id=None):
+    """Registra a saída. `agora` é o momento do registro (reenvio da fila offline)
+    e `saida_id` o ID determinístico da operação: a saída é gravada com create,
+    então repetir o mesmo registro não cria outra viagem.
+
+    Erros de disponibilidade do Firestore são relançados (a rota põe na fila).
+    """
     try:
         # Normaliza placa recebida
         veiculo_placa = normalize_plate(veiculo_placa) if veiculo_placa else veiculo_placa
         
-        #  PROTEÇÃO ANTI-DUPLICATA: Verifica se já existe saída recente (últimos 2 minutos)
-        now_utc = datetime.now(timezone.utc)
-        dois_minutos_atras = now_utc - timedelta(minutes=2)
+        # Usa o nome como está cadastrado (evita variações de acento/caixa)
+        motorista_atual = motoristas_index.get(motorista_nome)
+        if motorista_atual:
+            motorista_nome = motorista_atual['nome']
         
         saidas_ref = db.collection('saidas')
-        duplicata_query = saidas_ref.where(filter=And([
-            firestore.FieldFilter('veiculo', '==', veiculo_placa),
-            firestore.FieldFilter('motorista', '==', motorista_nome),
-            firestore.FieldFilter('timestampSaida', '>=', dois_minutos_atras)
-        ])).limit(1).stream()
-        
-        saidas_recentes = list(duplicata_query)
-        if len(saidas_recentes) > 0:
-            saida_duplicada = saidas_recentes[0].to_dict()
-            horario_duplicata = saida_duplicada.get('horarioSaida', 'N/A')
-            return f" Saída duplicada bloqueada! Este veículo com este motorista já tem um registro de saída recente (às {horario_duplicata}). Aguarde 2 minutos para registrar nova saída."
-        
-        # REGRA DE NEGÓCIO: Verifica se o veículo já está em curso
-        viagem_em_curso = saidas_ref.where(filter=And([
-            firestore.FieldFilter('veiculo', '==', veiculo_placa),
-            firestore.FieldFilter('status', '==', 'em_curso')
-        ])).limit(1).stream()
-        
-        if len(list(viagem_em_curso)) > 0:
-            return f"O veículo {veiculo_placa} já está em curso e não pode sair novamente."
-
-        # 1. Verificar/Registar Motorista E INCREMENTAR
-        motoristas_ref = db.collection('motoristas')
-        motorista_query = motoristas_ref.where(filter=firestore.FieldFilter('nome', '==', motorista_nome)).limit(1).stream()
-        motorista_docs = list(motorista_query)
-        
-        if not motorista_docs:
-            # Motorista é novo. Cria o documento já com o total 1.
-            motoristas_ref.add({
-                'nome': motorista_nome,
-                'secao': motorista_secao,
-                'status': 'nao_credenciado',
-                'dataCadastro': firestore.SERVER_TIMESTAMP,
-                'viagens_totais': 1  # Inicia a contagem em 1
-            })
-        else:
-            # Motorista já existe. Incrementa o total.
-            motorista_ref = motorista_docs[0].reference
-            motorista_ref.update({
-                'viagens_totais': firestore.Increment(1)
-            })
 
-        # 2. Verificar/Registar Veículo E INCREMENTAR
-        veiculos_ref = db.collection('veiculos')
-        veiculo_query = veiculos_ref.where(filter=firestore.FieldFilter('placa', '==', veiculo_placa)).limit(1).stream()
-        veiculo_docs = list(veiculo_query)
+        # REGRA DE NEGÓCIO: Verifica se o veículo já está em curso (réplica em memória).
+        # É só um atalho sem leituras; a garantia é a trava gravada na transação abaixo.
+        try:
+            viagem_em_curso = saidas_replica.em_curso_do_veiculo(veiculo_placa)
+        except Exception as e:
+            print(f" Réplica de saídas indisponível ({e}), usando só a trava do veículo")
+            viagem_em_curso = None
 
-        if not veiculo_docs:
-            # Veículo é novo. Cria o documento já com o total 1 e campos necessários.
-            veiculos_ref.add({
-                'placa': veiculo_placa,
-                'tipo': 'Não especificado',  # Campo padrão
-                'modelo': 'Não especificado',  # Campo padrão
-                'categoria': veiculo_categoria,
-                'visivel_para_motoristas': True,
-                'ano': None,
-                'km_atual': 0,
-                'status_ativo': True,  # Ativo por padrão
-                'dataCadastro': firestore.SERVER_TIMESTAMP,
-                'viagens_totais': 1  # Inicia a contagem em 1
-            })
-        else:
-            # Veículo já existe. Incrementa o total.
-            veiculo_ref = veiculo_docs[0].reference
-            veiculo_ref.update({
-                'viagens_totais': firestore.Increment(1)
-            })
+        if viagem_em_curso:
+            if saida_id and viagem_em_curso[0] == saida_id:
+                return f"Saída do veículo {veiculo_placa} registrada com sucesso."
+            return f"O veículo {veiculo_placa} já está em curso e não pode sair novamente."
 
-        # 3. Criar Registo de Saída
-        now_utc = datetime.now(timezone.utc)
+        # Horário da saída
+        now_utc = agora or datetime.now(timezone.utc)
         now_local = now_utc.astimezone(LOCAL_TZ)
 
         horario_saida_str = horario
@@ -3176,7 +6169,7 @@ def handle_saida(veiculo_placa, motorista_nome, solicitante, trajeto, horario=No
             timestamp_saida = now_local
             horario_saida_str = now_local.strftime("%H:%M")
 
-        saidas_ref.add({
+        nova_saida = {
             'veiculo': veiculo_placa,
             'motorista': motorista_nome,
             'solicitante': solicitante,
@@ -3186,36 +6179,130 @@ def handle_saida(veiculo_placa, motorista_nome, solicitante, trajeto, horario=No
             'status': 'em_curso',
             'horarioChegada': "",
             'timestampChegada': None
-        })
+        }
+        nova_saida_ref = saidas_ref.document(saida_id) if saida_id else saidas_ref.document()
 
-        # [OK] INVALIDA O CACHE DO DASHBOARD e HISTÓRICO após nova saída
-        dashboard_cache.clear()
-        historico_cache.clear()  # Limpa TODAS as chaves do cache
-        print("[DELETE] Cache do dashboard e histórico invalidados após nova saída")
+        # 1. Motorista: incrementa o total ou cria já com 1 (busca pelo cadastro em memória)
+        if motorista_atual:
+            motorista_ref = motoristas_index.reference(motorista_atual['id'])
+            motorista_dados = {'viagens_totais': firestore.Increment(1)}
+        else:
+            motorista_ref = db.collection('motoristas').document()
+            motorista_dados = {
+                'nome': motorista_nome,
+                'secao': motorista_secao,
+                'status': 'nao_credenciado',
+                'dataCadastro': firestore.SERVER_TIMESTAMP,
+                'viagens_totais': 1  # Inicia a contagem em 1
+            }
+
+        # 2. Veículo: incrementa o total ou cria já com 1 (busca pelo índice em memória)
+        veiculo_atual = veiculos_index.get(veiculo_placa)
+        if veiculo_atual:
+            veiculo_ref = veiculos_index.reference(veiculo_atual['id'])
+            veiculo_dados = {'viagens_totais': firestore.Increment(1)}
+        else:
+            veiculo_ref = db.collection('veiculos').document()
+            veiculo_dados = {
+                'placa': veiculo_placa,
+                'tipo': 'Não especificado',  # Campo padrão
+                'modelo': 'Não especificado',  # Campo padrão
+                'categoria': veiculo_categoria,
+                'visivel_para_motoristas': True,
+                'ano': None,
+                'km_atual': 0,
+                'status_ativo': True,  # Ativo por padrão
+                'dataCadastro': firestore.SERVER_TIMESTAMP,
+                'viagens_totais': 1,  # Inicia a contagem em 1
+                'total_refuels': 0,
+                'total_litros': 0.0,
+                'agregados_refuel': True
+            }
+
+        # 3. Trava + saída + contadores + resumo mensal numa única transação
+        #    (1 leitura e 1 commit em vez de ~7 chamadas sequenciais)
+        trava_ref = _trava_saida_ref(veiculo_placa)
+
+        @firestore.transactional
+        def _registrar_saida(transaction):
+            trava = trava_ref.get(transaction=transaction)
+            if trava.exists:
+                return trava.to_dict() or {}
+            transaction.set(trava_ref, _dados_trava_saida(nova_saida_ref.id, nova_saida))
+            transaction.create(nova_saida_ref, nova_saida)
+            if motorista_atual:
+                transaction.update(motorista_ref, motorista_dados)
+            else:
+                transaction.set(motorista_ref, motorista_dados)
+            if veiculo_atual:
+                transaction.update(veiculo_ref, veiculo_dados)
+            else:
+                transaction.set(veiculo_ref, veiculo_dados)
+            atualizar_resumo_mensal(saida_nova=nova_saida, batch=transaction)
+            return None
+
+        try:
+            trava_existente = _registrar_saida(db.transaction())
+        except gexc.AlreadyExists:
+            # Mesma operação já gravada (reenvio depois de um commit sem resposta)
+            return f"Saída do veículo {veiculo_placa} registrada com sucesso."
+        if trava_existente is not None:
+            # Toque duplo / nova tentativa chegam com a mesma Idempotency-Key
+            # (@idempotente repete a resposta); aqui sobra a mesma operação já gravada
+            if trava_existente.get('saida_id') == nova_saida_ref.id:
+                return f"Saída do veículo {veiculo_placa} registrada com sucesso."
+            return f"O veículo {veiculo_placa} já está em curso e não pode sair novamente."
+
+        # Mantém os índices em memória coerentes com o que foi gravado
+        motoristas_index.upsert(motorista_ref.id, motorista_dados, replace=not motorista_atual)
+        veiculos_index.upsert(veiculo_ref.id, veiculo_dados, replace=not veiculo_atual)
+
+        # [OK] CORRIGE só o cache do mês/veículo/motorista da nova saída
+        invalidar_caches_saida(saida_nova=nova_saida, saida_id=nova_saida_ref.id)
 
         return f"Saída do veículo {veiculo_placa} registrada com sucesso."
 
     except Exception as e:
+        if erro_firestore_indisponivel(e):
+            raise
         print(f"Erro no handle_saida: {e}")
         return "Ocorreu um erro interno ao registrar a saída."
 
-def handle_chegada(veiculo_placa, horario=None, litros=None, odometro=None):
+def handle_chegada(veiculo_placa, horario=None, litros=None, odometro=None, agora=None, viagem_id=None):
+    """Registra a chegada. `agora` é o momento do registro (reenvio da fila offline)
+    e `viagem_id` a viagem que o motorista fechou; repetir a mesma chegada
+    (mesma viagem e mesmo horário) não grava de novo.
+
+    Erros de disponibilidade do Firestore são relançados (a rota põe na fila).
+    """
     try:
         # Normaliza placa recebida
         veiculo_placa = normalize_plate(veiculo_placa) if veiculo_placa else veiculo_placa
-        saidas_ref = db.collection('saidas')
-        query = saidas_ref.where(filter=And([
-            firestore.FieldFilter('veiculo', '==', veiculo_placa),
-            firestore.FieldFilter('status', '==', 'em_curso')
-        ])).order_by('timestampSaida', direction=firestore.Query.DESCENDING).limit(1)
-        
-        viagens = list(query.stream())
 
-        if not viagens:
+        # Viagem em curso do veículo: réplica em memória (sem leituras);
+        # consulta o Firestore só se a réplica estiver indisponível
+        try:
+            viagem = (viagem_id, {}) if viagem_id else saidas_replica.em_curso_do_veiculo(veiculo_placa)
+        except Exception as e:
+            print(f" Réplica de saídas indisponível ({e}), consultando o Firestore")
+            query = db.collection('saidas').where(filter=And([
+                firestore.FieldFilter('veiculo', '==', veiculo_placa),
+                firestore.FieldFilter('status', '==', 'em_curso')
+            ])).order_by('timestampSaida', direction=firestore.Query.DESCENDING).limit(1)
+            viagens = list(query.stream())
+            viagem = (viagens[0].id, viagens[0].to_dict()) if viagens else None
+
+        if not viagem:
+            # Saída recém-registrada por outro processo que a réplica ainda não viu
+            trava = _trava_saida_ref(veiculo_placa).get()
+            if trava.exists and (trava.to_dict() or {}).get('saida_id'):
+                viagem = (trava.get('saida_id'), trava.to_dict())
+
+        if not viagem:
             return f"Nenhum registro de saída 'em curso' encontrado para o veículo {veiculo_placa}."
 
-        viagem_doc = viagens[0]
-        now_utc = datetime.now(timezone.utc)
+        viagem_id, viagem_atual = viagem
+        now_utc = agora or datetime.now(timezone.utc)
         now_local = now_utc.astimezone(LOCAL_TZ)
 
         horario_chegada_str = horario
@@ -3237,73 +6324,530 @@ def handle_chegada(veiculo_placa, horario=None, litros=None, odometro=None):
             timestamp_chegada = now_utc
             horario_chegada_str = now_local.strftime("%H:%M")
 
-        viagem_doc.reference.update({
+        chegada_fields = {
             'horarioChegada': horario_chegada_str,
             'timestampChegada': timestamp_chegada,
             'status': 'finalizada'
-        })
-
-        return_msg = f"Chegada do veículo {veiculo_placa} registrada com sucesso. Viagem finalizada."
+        }
 
         # Se litros/odometro foram enviados via API (passados como parâmetros), registra um refuel
-        try:
-            litros_val = litros
-            odometro_val = odometro
-            # Se não vierem via parâmetros, tenta pegar do body como fallback
-            if litros_val is None and request.json:
-                litros_val = request.json.get('litros')
-            if odometro_val is None and request.json:
-                odometro_val = request.json.get('odometro')
-
-            if litros_val is not None or odometro_val is not None:
-                ref = db.collection('refuels').document()
-                ref.set({
+        litros_val = litros
+        odometro_val = odometro
+        # Se não vierem via parâmetros, tenta pegar do body como fallback
+        corpo = request.get_json(silent=True) if has_request_context() else None
+        if litros_val is None and corpo:
+            litros_val = corpo.get('litros')
+        if odometro_val is None and corpo:
+            odometro_val = corpo.get('odometro')
+
+        refuel = None
+        if litros_val is not None or odometro_val is not None:
+            try:
+                refuel = {
                     'veiculo': veiculo_placa,
-                    'motorista': viagem_doc.to_dict().get('motorista'),
+                    'motorista': viagem_atual.get('motorista'),
                     'litros': float(litros_val) if litros_val is not None else None,
                     'odometro': int(odometro_val) if odometro_val is not None else None,
                     'observacao': '',
                     'timestamp': timestamp_chegada
-                })
-                
-                # Verifica/Cria o veículo se não existir
-                veiculos_ref = db.collection('veiculos')
-                q = list(veiculos_ref.where(filter=firestore.FieldFilter('placa', '==', veiculo_placa)).limit(1).stream())
-                
-                if not q:
-                    # Veículo não existe, criar com campos completos
-                    veiculos_ref.add({
-                        'placa': veiculo_placa,
+                }
+            except (TypeError, ValueError) as e:
+                print(f"Erro ao registrar refuel na chegada: {e}")
+                # não falha a chegada por causa do refuel
+
+        # Veículo resolvido pelo índice em memória: odômetro e contador de
+        # abastecimentos entram no mesmo commit da chegada
+        veiculo_atual = None
+        veiculo_ref = None
+        veiculo_dados = None
+        if refuel:
+            refuel_ref = db.collection('refuels').document()
+            veiculo_atual = veiculos_index.get(veiculo_placa)
+            if not veiculo_atual:
+                # Veículo não existe, criar com campos completos
+                veiculo_ref = db.collection('veiculos').document()
+                veiculo_dados = {
+                    'placa': veiculo_placa,
+                    'tipo': 'Não especificado',
+                    'modelo': 'Não especificado',
+                    'ano': None,
+                    'km_atual': refuel['odometro'] if refuel['odometro'] is not None else 0,
+                    'ultimo_odometro': refuel['odometro'],
+                    'status_ativo': True,
+                    'dataCadastro': firestore.SERVER_TIMESTAMP,
+                    'viagens_totais': 0,
+                    **campos_agregado_refuel(refuel, novo_veiculo=True)
+                }
+            else:
+                # Atualiza o ultimo odometro e os agregados de refuels no veiculo existente
+                veiculo_ref = veiculos_index.reference(veiculo_atual['id'])
+                veiculo_dados = campos_agregado_refuel(refuel)
+                if refuel['odometro'] is not None:
+                    veiculo_dados['ultimo_odometro'] = refuel['odometro']
+
+        def _registrar_abastecimento(transaction):
+            transaction.set(refuel_ref, refuel)
+            atualizar_resumo_refuels(refuel_novo=refuel, batch=transaction)
+            if veiculo_atual:
+                transaction.update(veiculo_ref, veiculo_dados)
+            else:
+                transaction.set(veiculo_ref, veiculo_dados)
+
+        def _validar(atual):
+            if atual.get('status') != 'em_curso':
+                # Esta mesma chegada já gravada (reenvio da fila offline)
+                if atual.get('status') == 'finalizada' and _to_datetime(atual.get('timestampChegada')) == timestamp_chegada:
+                    return 'ja_registrada'
+                return 'finalizada'
+            if refuel and not refuel.get('motorista'):
+                refuel['motorista'] = atual.get('motorista')
+            return None
+
+        # Finaliza a viagem, libera a trava do veículo, atualiza o resumo mensal
+        # (em curso -> finalizada, horas na rua) e grava o abastecimento num único commit
+        viagem_antiga, viagem_nova, erro = escrever_saida(
+            viagem_id, campos=chegada_fields, validar=_validar,
+            escritas_extras=_registrar_abastecimento if refuel else None
+        )
+        if erro == 'ja_registrada':
+            return f"Chegada do veículo {veiculo_placa} registrada com sucesso. Viagem finalizada."
+        if viagem_antiga is None or erro:
+            return f"Nenhum registro de saída 'em curso' encontrado para o veículo {veiculo_placa}."
+
+        return_msg = f"Chegada do veículo {veiculo_placa} registrada com sucesso. Viagem finalizada."
+        if refuel:
+            veiculos_index.upsert(veiculo_ref.id, veiculo_dados, replace=not veiculo_atual)
+            if not veiculo_atual:
+                print(f"[OK] Veículo {veiculo_placa} criado automaticamente via abastecimento")
+            atualizar_metricas_refuel(refuel_ref.id, refuel_novo=refuel)
+            return_msg += ' Abastecimento registrado (litros/odômetro).'
+
+        # [OK] CORRIGE só o cache do mês/veículo/motorista da viagem finalizada
+        invalidar_caches_saida(saida_antiga=viagem_antiga, saida_nova=viagem_nova, saida_id=viagem_id)
+
+        return return_msg
+
+    except Exception as e:
+        if erro_firestore_indisponivel(e):
+            raise
+        print(f"Erro no handle_chegada: {e}")
+        return "Ocorreu um erro interno ao registrar a chegada."
+
+
+def registrar_abastecimentos_rapidos(itens):
+    """Grava abastecimentos rápidos (/api/abastecimento) em WriteBatch.
+
+    Cada item: placa, motorista, litros, odometro, veiculo_categoria, timestamp
+    e refuel_id (ID determinístico da operação). Abastecimento (create), agregados
+    ou cadastro automático do veículo e resumo mensal vão no mesmo commit; um
+    abastecimento que já existe (reenvio) é pulado. Retorna uma mensagem por item.
+    Erros de disponibilidade do Firestore sobem para quem chamou.
+    """
+    mensagens = {}
+
+    # Um veículo novo é criado num lote e atualizado no seguinte
+    # (o índice em memória só passa a conhecê-lo depois do commit)
+    lotes, lote, novos = [], [], set()
+    for item in itens:
+        placa = item['placa']
+        if lote and (len(lote) >= FILA_OFFLINE_LOTE or (placa in novos and not veiculos_index.get(placa))):
+            lotes.append(lote)
+            lote, novos = [], set()
+        lote.append(item)
+        if not veiculos_index.get(placa):
+            novos.add(placa)
+    if lote:
+        lotes.append(lote)
+
+    for lote in lotes:
+        pendentes = list(lote)
+        while pendentes:
+            batch = db.batch()
+            gravados = []
+            for item in pendentes:
+                placa = item['placa']
+                refuel = {
+                    'veiculo': placa,  # Campo 'veiculo', não 'placa'
+                    'motorista': item['motorista'],
+                    'litros': float(item['litros']),
+                    'odometro': int(item['odometro']) if item.get('odometro') else None,
+                    'timestamp': item['timestamp']
+                }
+                refuel_ref = db.collection('refuels').document(item['refuel_id'])
+                batch.create(refuel_ref, refuel)
+
+                veiculo_atual = veiculos_index.get(placa)
+                if not veiculo_atual:
+                    # Cria veículo automaticamente
+                    veiculo_ref = db.collection('veiculos').document()
+                    veiculo_dados = {
+                        'placa': placa,
                         'tipo': 'Não especificado',
                         'modelo': 'Não especificado',
-                        'ano': None,
-                        'km_atual': int(odometro_val) if odometro_val is not None else 0,
-                        'ultimo_odometro': int(odometro_val) if odometro_val is not None else None,
+                        'categoria': item.get('veiculo_categoria') or 'Outros',
+                        'visivel_para_motoristas': True,
                         'status_ativo': True,
                         'dataCadastro': firestore.SERVER_TIMESTAMP,
-                        'viagens_totais': 0
-                    })
-                    print(f"[OK] Veículo {veiculo_placa} criado automaticamente via abastecimento")
-                elif odometro_val is not None:
-                    # Atualiza o ultimo odometro no veiculo existente
-                    vdoc = q[0]
-                    vdoc.reference.update({'ultimo_odometro': int(odometro_val)})
-                
-                return_msg += ' Abastecimento registrado (litros/odômetro).'
+                        'viagens_totais': 0,
+                        **campos_agregado_refuel(refuel, novo_veiculo=True)
+                    }
+                    batch.set(veiculo_ref, veiculo_dados)
+                else:
+                    veiculo_ref = veiculos_index.reference(veiculo_atual['id'])
+                    veiculo_dados = campos_agregado_refuel(refuel)
+                    batch.update(veiculo_ref, veiculo_dados)
+                atualizar_resumo_refuels(refuel_novo=refuel, batch=batch)
+                gravados.append((item, refuel, refuel_ref, veiculo_atual, veiculo_ref, veiculo_dados))
+
+            try:
+                batch.commit()
+            except gexc.AlreadyExists:
+                # Algum abastecimento do lote já foi gravado: refaz o lote sem ele
+                snaps = db.get_all([g[2] for g in gravados])
+                existentes = {snap.id for snap in snaps if snap.exists}
+                for item in pendentes:
+                    if item['refuel_id'] in existentes:
+                        mensagens[item['refuel_id']] = f"Abastecimento de {item['litros']}L registrado para {item['placa']}"
+                pendentes = [item for item in pendentes if item['refuel_id'] not in existentes]
+                continue
+
+            for item, refuel, refuel_ref, veiculo_atual, veiculo_ref, veiculo_dados in gravados:
+                veiculos_index.upsert(veiculo_ref.id, veiculo_dados, replace=not veiculo_atual)
+                if not veiculo_atual:
+                    print(f" Veículo {item['placa']} criado automaticamente na categoria {veiculo_dados['categoria']}")
+                atualizar_metricas_refuel(refuel_ref.id, refuel_novo=refuel)
+                print(f"[OK] Abastecimento registrado: {item['placa']} - {item['litros']}L")
+                mensagens[item['refuel_id']] = f"Abastecimento de {item['litros']}L registrado para {item['placa']}"
+            pendentes = []
+
+    return [mensagens[item['refuel_id']] for item in itens]
+
+
+# ==========================================
+# [SAVE] FILA OFFLINE DE REGISTROS (SAÍDA / CHEGADA / ABASTECIMENTO)
+# ==========================================
+# Com o Firestore fora do ar ou sem quota (circuito aberto), /api/saida,
+# /api/chegada e /api/abastecimento não perdem mais o registro: a operação vai
+# para uma fila SQLite local (write-ahead, sobrevive a reinício do processo)
+# com uma chave de idempotência e a rota responde 202. Uma thread reenvia a
+# fila EM ORDEM quando o circuito volta a deixar passar:
+# - Enquanto houver pendentes, registros novos também entram na fila (uma
+#   chegada não pode passar na frente da saída que ela fecha).
+# - Os IDs gravados derivam da chave (saída e abastecimento usam create, a
+#   chegada compara viagem + horário): reenviar o que já foi gravado não duplica.
+# - Abastecimentos seguidos vão no mesmo WriteBatch; saída e chegada dependem
+#   da trava do veículo e vão cada uma na sua transação.
+# - "Veículo já em curso" e "nenhuma viagem em curso" viram CONFLITO: a
+#   operação sai da fila e fica em /api/admin/fila-offline para tratar à mão.
+#   A chegada de uma saída que deu conflito também dá conflito.
+# Com várias instâncias cada uma tem a sua fila (FILA_OFFLINE_PATH deve
+# ficar num disco que sobreviva ao deploy).
+
+FILA_OFFLINE_PATH = os.getenv('FILA_OFFLINE_PATH', os.path.join(tempfile.gettempdir(), 'frota_sanemar_fila_offline.sqlite3'))
+FILA_OFFLINE_INTERVALO = float(os.getenv('FILA_OFFLINE_INTERVALO', '5'))
+FILA_OFFLINE_RETENCAO = int(os.getenv('FILA_OFFLINE_RETENCAO', str(7 * 86400)))
+FILA_OFFLINE_LOTE = 100  # abastecimentos por WriteBatch (3 escritas cada)
+
+# Viagem em curso que não dá para saber (réplica fora do ar e nada na fila)
+VIAGEM_DESCONHECIDA = object()
+
+
+def id_da_operacao(chave):
+    """ID de documento determinístico para uma chave de idempotência."""
+    return hashlib.sha1(f'op:{chave}'.encode('utf-8')).hexdigest()[:20]
+
+
+def chave_idempotencia():
+    """Chave enviada pelo cliente (header Idempotency-Key) ou uma nova."""
+    chave = (request.headers.get('Idempotency-Key') or '').strip()
+    return chave[:200] if chave else uuid.uuid4().hex
+
+
+class FilaOffline:
+    """Fila SQLite dos registros que esperam o Firestore voltar."""
+
+    def __init__(self, path=FILA_OFFLINE_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._reenvio_lock = threading.Lock()
+        self._thread = None
+        self.ultimo_reenvio = None
+        self.ultimo_erro = None
+        with self._conn() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS operacoes ('
+                'seq INTEGER PRIMARY KEY AUTOINCREMENT, chave TEXT NOT NULL UNIQUE, tipo TEXT NOT NULL, '
+                'placa TEXT, dados TEXT NOT NULL, criado_em REAL NOT NULL, '
+                "status TEXT NOT NULL DEFAULT 'pendente', tentativas INTEGER NOT NULL DEFAULT 0, "
+                'resultado TEXT, atualizado_em REAL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_operacoes_status ON operacoes(status, seq)')
+
+    def _conn(self):
+        # Uma conexão por thread (sqlite3 não compartilha conexões entre threads)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=FULL')
+            self._local.conn = conn
+        return conn
+
+    def enfileirar(self, tipo, placa, dados, chave):
+        """Grava a operação (repetir a mesma chave não duplica). Retorna a posição na fila."""
+        conn = self._conn()
+        conn.execute(
+            'INSERT OR IGNORE INTO operacoes (chave, tipo, placa, dados, criado_em) VALUES (?, ?, ?, ?, ?)',
+            (chave, tipo, placa, json.dumps(dados, ensure_ascii=False), time.time())
+        )
+        self.iniciar()
+        return conn.execute(
+            "SELECT COUNT(*) FROM operacoes WHERE status = 'pendente' AND seq <= "
+            '(SELECT seq FROM operacoes WHERE chave = ?)', (chave,)
+        ).fetchone()[0]
+
+    def tem_pendentes(self):
+        return self._conn().execute("SELECT 1 FROM operacoes WHERE status = 'pendente' LIMIT 1").fetchone() is not None
+
+    def deve_enfileirar(self):
+        """True se um registro novo deve ir para a fila (Firestore fora ou fila andando)."""
+        try:
+            if self.tem_pendentes():
+                self.iniciar()
+                return True
         except Exception as e:
-            print(f"Erro ao registrar refuel na chegada: {e}")
-            # não falha a chegada por causa do refuel
+            print(f" Fila offline indisponível ({e})")
+        return not firestore_disponivel()
+
+    def viagem_prevista(self, placa):
+        """Viagem em curso do veículo somando a fila à réplica.
+
+        ID da viagem, None se o veículo está livre ou VIAGEM_DESCONHECIDA.
+        """
+        row = self._conn().execute(
+            "SELECT tipo, chave FROM operacoes WHERE status = 'pendente' AND placa = ? "
+            "AND tipo IN ('saida', 'chegada') ORDER BY seq DESC LIMIT 1", (placa,)
+        ).fetchone()
+        if row:
+            return id_da_operacao(row[1]) if row[0] == 'saida' else None
+        try:
+            viagem = saidas_replica.em_curso_do_veiculo(placa)
+        except Exception:
+            return VIAGEM_DESCONHECIDA
+        return viagem[0] if viagem else None
+
+    def previsao_em_curso(self):
+        """{placa: dados da saída pendente, ou None se há chegada pendente} pela ordem da fila."""
+        previsao = {}
+        rows = self._conn().execute(
+            "SELECT tipo, chave, placa, dados FROM operacoes WHERE status = 'pendente' "
+            "AND tipo IN ('saida', 'chegada') ORDER BY seq"
+        ).fetchall()
+        for tipo, chave, placa, dados in rows:
+            previsao[placa] = {**json.loads(dados), 'id': id_da_operacao(chave)} if tipo == 'saida' else None
+        return previsao
+
+    def _proximas(self, limite):
+        rows = self._conn().execute(
+            "SELECT seq, chave, tipo, placa, dados FROM operacoes WHERE status = 'pendente' ORDER BY seq LIMIT ?",
+            (limite,)
+        ).fetchall()
+        return [{'seq': seq, 'chave': chave, 'tipo': tipo, 'placa': placa, 'dados': json.loads(dados)}
+                for seq, chave, tipo, placa, dados in rows]
+
+    def _marcar(self, seqs, status, resultado):
+        self._conn().executemany(
+            'UPDATE operacoes SET status = ?, resultado = ?, tentativas = tentativas + 1, atualizado_em = ? WHERE seq = ?',
+            [(status, resultado, time.time(), seq) for seq in seqs]
+        )
 
-        # [OK] INVALIDA O CACHE DO DASHBOARD e HISTÓRICO após chegada
-        dashboard_cache.clear()
-        historico_cache.clear()  # Limpa TODAS as chaves do cache
-        print("[DELETE] Cache do dashboard e histórico invalidados após chegada")
+    def _falhou(self, seqs, erro):
+        self._conn().executemany(
+            'UPDATE operacoes SET tentativas = tentativas + 1, resultado = ?, atualizado_em = ? WHERE seq = ?',
+            [(str(erro)[:300], time.time(), seq) for seq in seqs]
+        )
+
+    @staticmethod
+    def _status_da_mensagem(mensagem):
+        if 'sucesso' in mensagem:
+            return 'aplicada'
+        if 'já está em curso' in mensagem or 'Nenhum registro' in mensagem:
+            return 'conflito'
+        return 'erro'
+
+    def _aplicar(self, op):
+        """Reenvia uma saída/chegada com o horário original; retorna a mensagem do handler."""
+        dados = op['dados']
+        agora = datetime.fromisoformat(dados['registrado_em'])
+        if op['tipo'] == 'saida':
+            return handle_saida(
+                op['placa'], dados['motorista'], dados['solicitante'], dados['trajeto'], dados.get('horario'),
+                dados.get('veiculo_categoria', 'Outros'), dados.get('motorista_secao', 'Outros'),
+                agora=agora, saida_id=id_da_operacao(op['chave'])
+            )
+        return handle_chegada(
+            op['placa'], dados.get('horario'), litros=dados.get('litros'), odometro=dados.get('odometro'),
+            agora=agora, viagem_id=dados.get('viagem_id')
+        )
+
+    def reenviar(self):
+        """Reenvia as pendentes em ordem até a fila esvaziar ou o Firestore cair de novo.
+
+        Retorna quantas operações saíram da fila.
+        """
+        if not self._reenvio_lock.acquire(blocking=False):
+            return 0
+        processadas = 0
+        try:
+            with uso_firestore.rotina('fila offline'):
+                while firestore_disponivel():
+                    ops = self._proximas(FILA_OFFLINE_LOTE)
+                    if not ops:
+                        break
+                    # Abastecimentos seguidos no mesmo lote; saída/chegada uma a uma
+                    grupo = []
+                    for op in ops:
+                        if op['tipo'] != 'abastecimento':
+                            break
+                        grupo.append(op)
+                    try:
+                        if grupo:
+                            itens = [{**op['dados'], 'timestamp': datetime.fromisoformat(op['dados']['registrado_em']),
+                                      'refuel_id': id_da_operacao(op['chave'])} for op in grupo]
+                            mensagens = registrar_abastecimentos_rapidos(itens)
+                            for op, mensagem in zip(grupo, mensagens):
+                                self._marcar([op['seq']], 'aplicada', mensagem)
+                            processadas += len(grupo)
+                            continue
+                        op = ops[0]
+                        mensagem = self._aplicar(op)
+                    except Exception as e:
+                        seqs = [op['seq'] for op in (grupo or ops[:1])]
+                        if erro_firestore_indisponivel(e):
+                            self._falhou(seqs, e)
+                            self.ultimo_erro = str(e)[:300]
+                            break
+                        # Erro que não é de disponibilidade não trava a fila
+                        print(f" Fila offline: operação {seqs} com erro ({e})")
+                        self._marcar(seqs, 'erro', str(e)[:300])
+                        processadas += len(seqs)
+                        continue
+                    status = self._status_da_mensagem(mensagem)
+                    self._marcar([op['seq']], status, mensagem)
+                    processadas += 1
+                    if status != 'aplicada':
+                        print(f" Fila offline: {op['tipo']} de {op['placa']} ({op['chave']}) -> {status}: {mensagem}")
+            if processadas:
+                self.ultimo_reenvio = datetime.now(timezone.utc)
+                print(f"[OK] Fila offline: {processadas} operação(ões) reenviada(s)")
+        finally:
+            self._reenvio_lock.release()
+        return processadas
+
+    def limpar(self):
+        """Remove as aplicadas mais antigas que FILA_OFFLINE_RETENCAO (conflitos ficam)."""
+        self._conn().execute(
+            "DELETE FROM operacoes WHERE status = 'aplicada' AND atualizado_em < ?",
+            (time.time() - FILA_OFFLINE_RETENCAO,)
+        )
+
+    def iniciar(self):
+        # Inicia a thread no primeiro uso (no processo que realmente atende requisições)
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._loop, name='fila-offline', daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(FILA_OFFLINE_INTERVALO)
+            try:
+                if self.tem_pendentes() and firestore_disponivel():
+                    self.reenviar()
+                self.limpar()
+            except Exception as e:
+                print(f" Erro na thread da fila offline: {e}")
+
+    def listar(self, status=None, limite=200):
+        sql = 'SELECT seq, chave, tipo, placa, dados, criado_em, status, tentativas, resultado, atualizado_em FROM operacoes'
+        params = []
+        if status:
+            sql += ' WHERE status = ?'
+            params.append(status)
+        sql += ' ORDER BY seq DESC LIMIT ?'
+        params.append(limite)
+        return [{
+            'seq': seq, 'chave': chave, 'tipo': tipo, 'placa': placa, 'dados': json.loads(dados),
+            'criado_em': datetime.fromtimestamp(criado_em, timezone.utc).isoformat(),
+            'status': status_op, 'tentativas': tentativas, 'resultado': resultado,
+            'atualizado_em': datetime.fromtimestamp(atualizado_em, timezone.utc).isoformat() if atualizado_em else None,
+        } for seq, chave, tipo, placa, dados, criado_em, status_op, tentativas, resultado, atualizado_em
+            in self._conn().execute(sql, params).fetchall()]
+
+    def resumo(self):
+        contagem = dict(self._conn().execute('SELECT status, COUNT(*) FROM operacoes GROUP BY status').fetchall())
+        if contagem.get('pendente'):
+            self.iniciar()
+        return {
+            'pendentes': contagem.get('pendente', 0),
+            'conflitos': contagem.get('conflito', 0),
+            'erros': contagem.get('erro', 0),
+            'ultimo_reenvio': self.ultimo_reenvio.isoformat() if self.ultimo_reenvio else None,
+            'ultimo_erro': self.ultimo_erro,
+        }
+
+
+fila_offline = FilaOffline()
+
+
+def responder_fila_offline(tipo, placa, dados, chave):
+    """Guarda o registro na fila offline e responde 202 (ou 503 se nem o disco aceitar)."""
+    dados = {**dados, 'registrado_em': dados.get('registrado_em') or datetime.now(timezone.utc).isoformat()}
+    try:
+        posicao = fila_offline.enfileirar(tipo, placa, dados, chave)
+    except Exception as e:
+        print(f"[ERRO] Fila offline indisponível ({e}): {tipo} de {placa} não registrado")
+        return jsonify({"error": "Banco de dados indisponível e não foi possível guardar o registro. Tente novamente."}), 503
+    nomes = {'saida': 'Saída registrada', 'chegada': 'Chegada registrada', 'abastecimento': 'Abastecimento registrado'}
+    print(f"[SAVE] Fila offline: {tipo} de {placa} guardado ({chave}), posição {posicao}")
+    return jsonify({
+        "message": f"{nomes[tipo]} para o veículo {placa} sem conexão com o banco: será enviado automaticamente.",
+        "pendente": True,
+        "chave": chave,
+        "posicao": posicao,
+    }), 202
 
-        return return_msg
 
+@app.route('/api/admin/fila-offline', methods=['GET'])
+@requires_auth
+def get_fila_offline():
+    """Operações da fila offline (?status=pendente|aplicada|conflito|erro)."""
+    status = request.args.get('status')
+    if status and status not in ('pendente', 'aplicada', 'conflito', 'erro'):
+        return jsonify({"error": "Status inválido."}), 400
+    try:
+        return jsonify({"resumo": fila_offline.resumo(), "operacoes": fila_offline.listar(status)}), 200
     except Exception as e:
-        print(f"Erro no handle_chegada: {e}")
-        return "Ocorreu um erro interno ao registrar a chegada."
+        print(f"Erro em get_fila_offline: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/admin/fila-offline/reenviar', methods=['POST'])
+@requires_auth
+def reenviar_fila_offline():
+    """Reenvia a fila agora (sem esperar a thread)."""
+    if not firestore_disponivel():
+        return jsonify({"error": "Firestore ainda indisponível.", "resumo": fila_offline.resumo()}), 503
+    try:
+        processadas = fila_offline.reenviar()
+        return jsonify({"reenviadas": processadas, "resumo": fila_offline.resumo()}), 200
+    except Exception as e:
+        print(f"Erro em reenviar_fila_offline: {e}")
+        return jsonify({"error": str(e)}), 500
 
 
 # ========================================
@@ -3416,7 +6960,7 @@ def post_km_mensal():
         if existing:
             # Atualiza o registro existente
             existing_doc = existing[0]
-            existing_doc.reference.update({
+            km_ref.document(existing_doc.id).update({
                 'km_valor': int(km_valor),
                 'observacao': observacao,
                 'data_registro': firestore.SERVER_TIMESTAMP
@@ -3981,6 +7525,151 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_CENTER, TA_LEFT
 from io import BytesIO
 
+# ============================================
+# [PDF] RELATÓRIOS GRANDES EM BLOCOS (SEM LIMITE DE 500 LINHAS)
+# ============================================
+# - Firestore lido em páginas keyset (campo DESC, ID DESC) de PDF_LOTE_FIRESTORE
+# - Tabela quebrada em blocos do tamanho de uma página (cabeçalho repetido
+#   com repeatRows), criados sob demanda conforme o ReportLab diagrama o PDF:
+#   nem todas as linhas nem uma Table gigante ficam em memória
+# - PDF gravado num SpooledTemporaryFile (vai para disco se crescer) e enviado
+#   em pedaços (Response chunked)
+
+PDF_LOTE_FIRESTORE = 500
+PDF_ALTURA_CABECALHO = 0.9 * cm
+PDF_ALTURA_LINHA = 0.6 * cm
+PDF_SPOOL_MEMORIA = int(os.getenv('PDF_SPOOL_MEMORIA', str(8 * 1024 * 1024)))
+PDF_CHUNK_RESPOSTA = 64 * 1024
+
+
+def _paginar_query(query, campo_ordem, colecao, lote=PDF_LOTE_FIRESTORE):
+    """Percorre a query inteira em páginas keyset (campo_ordem DESC, ID DESC)."""
+    query = query.order_by(campo_ordem, direction=firestore.Query.DESCENDING)
+    query = query.order_by(FieldPath.document_id(), direction=firestore.Query.DESCENDING)
+    ultimo = None
+    while True:
+        pagina = query
+        if ultimo:
+            pagina = pagina.start_after({
+                campo_ordem: ultimo[0],
+                FieldPath.document_id(): db.collection(colecao).document(ultimo[1])
+            })
+        lidos = 0
+        for doc in pagina.limit(lote).stream():
+            lidos += 1
+            dados = doc.to_dict() or {}
+            ultimo = (dados.get(campo_ordem), doc.id)
+            dados['id'] = doc.id
+            yield dados
+        if lidos < lote:
+            return
+
+
+class _FlowablesSobDemanda(list):
+    """Lista de flowables que se reabastece de um gerador.
+
+    O build() do ReportLab consome a lista pela frente (del flowables[0]),
+    então só os próximos blocos de tabela existem em memória a cada momento.
+    """
+
+    def __init__(self, iniciais, gerador, folga=2):
+        super().__init__(iniciais)
+        self._gerador = gerador
+        self._folga = folga
+
+    def _abastecer(self, minimo):
+        while self._gerador is not None and list.__len__(self) < minimo:
+            try:
+                self.append(next(self._gerador))
+            except StopIteration:
+                self._gerador = None
+
+    def __len__(self):
+        self._abastecer(self._folga)
+        return list.__len__(self)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __getitem__(self, indice):
+        if isinstance(indice, int) and indice >= 0:
+            self._abastecer(indice + 1)
+        else:
+            self._abastecer(float('inf'))
+        return list.__getitem__(self, indice)
+
+
+def _pdf_linhas_por_pagina(doc, elementos_iniciais):
+    """Quantas linhas de tabela cabem na 1ª página (após o título) e nas seguintes."""
+    largura = doc.width
+    altura = doc.height - 12  # padding do Frame padrão (6pt em cima e embaixo)
+    usado = 0
+    for elemento in elementos_iniciais:
+        _, h = elemento.wrap(largura, altura)
+        usado += h + elemento.getSpaceBefore() + elemento.getSpaceAfter()
+    por_pagina = max(1, int((altura - PDF_ALTURA_CABECALHO) // PDF_ALTURA_LINHA))
+    primeira = max(1, int((altura - usado - PDF_ALTURA_CABECALHO) // PDF_ALTURA_LINHA) - 1)
+    return primeira, por_pagina
+
+
+def _pdf_blocos_tabela(linhas, cabecalho, col_widths, estilo, primeira, por_pagina, linha_vazia):
+    """Gera uma Table por página a partir de um iterável de linhas."""
+    def _tabela(bloco):
+        table = Table([cabecalho] + bloco, colWidths=col_widths, repeatRows=1,
+                      rowHeights=[PDF_ALTURA_CABECALHO] + [PDF_ALTURA_LINHA] * len(bloco))
+        table.setStyle(estilo)
+        return table
+
+    bloco = []
+    limite = primeira
+    total = 0
+    for linha in linhas:
+        bloco.append(linha)
+        total += 1
+        if len(bloco) >= limite:
+            yield _tabela(bloco)
+            bloco = []
+            limite = por_pagina
+    if bloco or not total:
+        yield _tabela(bloco or [linha_vazia])
+
+
+def _pdf_resposta_em_blocos(doc_kwargs, elementos_iniciais, gerar_blocos, filename):
+    """Diagrama o PDF num arquivo temporário e o envia em pedaços (chunked).
+
+    gerar_blocos(primeira, por_pagina) devolve o gerador de Tables.
+    """
+    arquivo = tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_MEMORIA)
+    try:
+        doc = SimpleDocTemplate(arquivo, **doc_kwargs)
+        primeira, por_pagina = _pdf_linhas_por_pagina(doc, elementos_iniciais)
+        doc.build(_FlowablesSobDemanda(elementos_iniciais, gerar_blocos(primeira, por_pagina)))
+        tamanho = arquivo.tell()
+        arquivo.seek(0)
+    except Exception:
+        arquivo.close()
+        raise
+
+    def _enviar():
+        try:
+            while True:
+                pedaco = arquivo.read(PDF_CHUNK_RESPOSTA)
+                if not pedaco:
+                    break
+                yield pedaco
+        finally:
+            arquivo.close()
+
+    return Response(
+        _enviar(),
+        mimetype='application/pdf',
+        headers={
+            'Content-Disposition': f'attachment;filename={filename}',
+            'Content-Length': str(tamanho)
+        }
+    )
+
+
 @app.route('/pdf/motoristas', methods=['GET'])
 @requires_auth
 def pdf_motoristas():
@@ -4092,13 +7781,12 @@ def pdf_veiculos():
         # Filtro de status (ativos, inativos ou todos)
         status_filter = request.args.get('status', 'todos')  # 'todos', 'ativos', 'inativos'
         
-        # Buscar veículos
-        veiculos_ref = db.collection('veiculos').stream()
+        # Veículos do índice em memória; totais de abastecimento vêm dos agregados
+        # mantidos no próprio veículo (sem varrer 'refuels' por veículo)
+        todos = veiculos_index.all()
+        
         veiculos = []
-        for doc in veiculos_ref:
-            v = doc.to_dict()
-            v['id'] = doc.id
-            
+        for v in todos:
             # Aplicar filtro de status
             status_ativo = v.get('status_ativo', True)
             if status_filter == 'ativos' and not status_ativo:
@@ -4106,31 +7794,12 @@ def pdf_veiculos():
             elif status_filter == 'inativos' and status_ativo:
                 continue
             
-            # Buscar total real de abastecimentos e litros
-            placa = v.get('placa')
-            if placa:
-                refuels_query = db.collection('refuels').where(
-                    filter=firestore.FieldFilter('veiculo', '==', placa)
-                ).stream()
-                
-                total_count = 0
-                total_litros = 0
-                for refuel_doc in refuels_query:
-                    total_count += 1
-                    refuel_data = refuel_doc.to_dict()
-                    litros = refuel_data.get('litros', 0)
-                    if litros:
-                        try:
-                            total_litros += float(litros)
-                        except:
-                            pass
-                
-                v['total_refuels_real'] = total_count
-                v['total_litros_real'] = total_litros
+            # Sem agregados calculados o total é desconhecido (não é 0)
+            if v.get('agregados_refuel'):
+                v['total_refuels_real'] = v.get('total_refuels', 0) or 0
+                v['total_litros_real'] = float(v.get('total_litros', 0) or 0)
             else:
-                v['total_refuels_real'] = 0
-                v['total_litros_real'] = 0
-                
+                v['total_refuels_real'] = v['total_litros_real'] = None
             veiculos.append(v)
         
         # Ordenar: ativos primeiro, inativos no final
@@ -4167,8 +7836,8 @@ def pdf_veiculos():
         # Tabela
         data = [['Placa', 'Modelo', 'Status', 'Km Atual', 'Média km/L', 'Total Abast.', 'Total Litros']]
         for v in veiculos:
-            total_abast = v.get('total_refuels_real', 0)
-            total_litros = v.get('total_litros_real', 0)
+            total_abast = v.get('total_refuels_real')
+            total_litros = v.get('total_litros_real')
             status_ativo = v.get('status_ativo', True)
             status_texto = 'Ativo' if status_ativo else 'Inativo'
             
@@ -4178,8 +7847,8 @@ def pdf_veiculos():
                 status_texto,
                 str(v.get('ultimo_odometro', '-')),
                 f"{v.get('media_kmpl', 0):.2f}" if v.get('media_kmpl') else '-',
-                str(total_abast),
-                f"{total_litros:.1f}L" if total_litros > 0 else '0L'
+                str(total_abast) if total_abast is not None else '—',
+                ('—' if total_litros is None else f"{total_litros:.1f}L" if total_litros > 0 else '0L')
             ])
         
         table = Table(data, colWidths=[2.2*cm, 3.0*cm, 1.8*cm, 2.2*cm, 2.4*cm, 2.4*cm, 2.4*cm])
@@ -4197,6 +7866,9 @@ def pdf_veiculos():
             ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.lightgrey])
         ]))
         elements.append(table)
+        if any(v.get('total_refuels_real') is None for v in veiculos):
+            elements.append(Spacer(1, 0.3*cm))
+            elements.append(Paragraph("— Totais de abastecimento ainda não calculados para este veículo.", styles['Normal']))
         
         # Gerar PDF
         doc.build(elements)
@@ -4283,19 +7955,8 @@ def pdf_abastecimentos():
             ]))
             print(f' Sem filtros: buscando apenas mês atual ({primeiro_dia.strftime("%m/%Y")})')
         
-        # Limitar a 500 registros
-        refuels_docs = list(query.order_by('timestamp', direction=firestore.Query.DESCENDING).limit(500).stream())
-        
-        refuels = []
-        for doc in refuels_docs:
-            r = doc.to_dict()
-            r['id'] = doc.id
-            refuels.append(r)
-        
-        # Criar PDF em paisagem para mais colunas
-        buffer = BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=landscape(A4), rightMargin=1.5*cm, leftMargin=1.5*cm, topMargin=2*cm, bottomMargin=2*cm)
-        elements = []
+        # Todas as páginas da consulta (cursor keyset), lidas sob demanda
+        refuels = _paginar_query(query, 'timestamp', 'refuels')
         
         # Estilos
         styles = getSampleStyleSheet()
@@ -4309,6 +7970,7 @@ def pdf_abastecimentos():
         )
         
         # Título
+        elements = []
         titulo = "RELATÓRIO DE ABASTECIMENTOS"
         if veiculo:
             titulo += f" - Veículo: {veiculo}"
@@ -4316,72 +7978,56 @@ def pdf_abastecimentos():
         elements.append(Paragraph(f"Gerado em: {datetime.now(LOCAL_TZ).strftime('%d/%m/%Y %H:%M')}", styles['Normal']))
         elements.append(Spacer(1, 0.5*cm))
         
+        def _data_str(r):
+            ts = r.get('timestamp')
+            data_str = '-'
+            if ts:
+                if isinstance(ts, datetime):
+                    data_str = ts.strftime('%d/%m/%Y')
+                else:
+                    try:
+                        data_str = datetime.fromisoformat(str(ts)).strftime('%d/%m/%Y')
+                    except:
+                        pass
+            return data_str if data_str else '-'
+        
         # Se for de um veículo específico, simplifica (sem valor e km/L)
         if veiculo:
-            data = [['Data', 'Motorista', 'Litros', 'Odômetro']]
-            
-            if len(refuels) == 0:
-                data.append(['Nenhum abastecimento encontrado', '', '', ''])
+            cabecalho = ['Data', 'Motorista', 'Litros', 'Odômetro']
+            linha_vazia = ['Nenhum abastecimento encontrado', '', '', '']
+            col_widths = [4*cm, 8*cm, 4*cm, 5*cm]
             
-            for r in refuels:
-                ts = r.get('timestamp')
-                data_str = '-'
-                if ts:
-                    if isinstance(ts, datetime):
-                        data_str = ts.strftime('%d/%m/%Y')
-                    else:
-                        try:
-                            data_str = datetime.fromisoformat(str(ts)).strftime('%d/%m/%Y')
-                        except:
-                            pass
-                
+            def _linha(r):
                 litros = r.get('litros')
                 odometro = r.get('odometro')
-                
-                data.append([
-                    data_str if data_str else '-',
+                return [
+                    _data_str(r),
                     r.get('motorista', '-') or '-',
                     f"{float(litros):.1f}L" if litros not in (None, '', 0) else '-',
                     str(odometro) if odometro not in (None, '', '-') else '-'
-                ])
-            
-            table = Table(data, colWidths=[4*cm, 8*cm, 4*cm, 5*cm])
+                ]
         else:
             # Relatório geral (todos veículos)
-            data = [['Data', 'Veículo', 'Motorista', 'Litros', 'Valor', 'Odômetro', 'km/L']]
-            
-            if len(refuels) == 0:
-                data.append(['Nenhum abastecimento encontrado', '', '', '', '', '', ''])
+            cabecalho = ['Data', 'Veículo', 'Motorista', 'Litros', 'Valor', 'Odômetro', 'km/L']
+            linha_vazia = ['Nenhum abastecimento encontrado', '', '', '', '', '', '']
+            col_widths = [3*cm, 3*cm, 4*cm, 2.5*cm, 3*cm, 3*cm, 2.5*cm]
             
-            for r in refuels:
-                ts = r.get('timestamp')
-                data_str = '-'
-                if ts:
-                    if isinstance(ts, datetime):
-                        data_str = ts.strftime('%d/%m/%Y')
-                    else:
-                        try:
-                            data_str = datetime.fromisoformat(str(ts)).strftime('%d/%m/%Y')
-                        except:
-                            pass
-                
+            def _linha(r):
                 litros = r.get('litros')
                 valor = r.get('valor')
                 odometro = r.get('odometro')
                 kmpl = r.get('kmpl')
-                
-                data.append([
-                    data_str if data_str else '-',
+                return [
+                    _data_str(r),
                     r.get('veiculo', '-') or '-',
                     r.get('motorista', '-') or '-',
                     f"{float(litros):.1f}L" if litros not in (None, '', 0) else '-',
                     f"R$ {float(valor):.2f}" if valor not in (None, '', 0) else '-',
                     str(odometro) if odometro not in (None, '', '-') else '-',
                     f"{float(kmpl):.2f}" if kmpl not in (None, '', '-') and isinstance(kmpl, (int, float)) else '-'
-                ])
-            
-            table = Table(data, colWidths=[3*cm, 3*cm, 4*cm, 2.5*cm, 3*cm, 3*cm, 2.5*cm])
-        table.setStyle(TableStyle([
+                ]
+        
+        estilo = TableStyle([
             ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#f59e0b')),
             ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
             ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
@@ -4393,18 +8039,17 @@ def pdf_abastecimentos():
             ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
             ('FONTSIZE', (0, 1), (-1, -1), 9),
             ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.lightgrey])
-        ]))
-        elements.append(table)
-        
-        # Gerar PDF
-        doc.build(elements)
-        buffer.seek(0)
+        ])
         
+        # Gerar PDF (paisagem para mais colunas), uma tabela por página
         filename = f'abastecimentos_{datetime.now().strftime("%Y%m%d_%H%M%S")}.pdf'
-        return Response(
-            buffer.getvalue(),
-            mimetype='application/pdf',
-            headers={'Content-Disposition': f'attachment;filename={filename}'}
+        return _pdf_resposta_em_blocos(
+            dict(pagesize=landscape(A4), rightMargin=1.5*cm, leftMargin=1.5*cm, topMargin=2*cm, bottomMargin=2*cm),
+            elements,
+            lambda primeira, por_pagina: _pdf_blocos_tabela(
+                (_linha(r) for r in refuels), cabecalho, col_widths, estilo, primeira, por_pagina, linha_vazia
+            ),
+            filename
         )
         
     except Exception as e:
@@ -4496,21 +8141,8 @@ def pdf_saidas():
             ]))
             print(f' Sem filtros: buscando apenas mês atual ({primeiro_dia.strftime("%m/%Y")})')
         
-        # [OK] LIMITE MÁXIMO: 500 registros para proteger quota
-        saidas_docs = list(query.order_by('timestampSaida', direction=firestore.Query.DESCENDING).limit(500).stream())
-        
-        print(f'[PDF] Gerando com {len(saidas_docs)} registros')
-        
-        saidas = []
-        for doc in saidas_docs:
-            s = doc.to_dict()
-            s['id'] = doc.id
-            saidas.append(s)
-        
-        # Criar PDF em paisagem
-        buffer = BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=landscape(A4), rightMargin=1.5*cm, leftMargin=1.5*cm, topMargin=2*cm, bottomMargin=2*cm)
-        elements = []
+        # [OK] Sem limite de registros: todas as páginas da consulta (cursor keyset), lidas sob demanda
+        saidas = _paginar_query(query, 'timestampSaida', 'saidas')
         
         # Estilos
         styles = getSampleStyleSheet()
@@ -4524,6 +8156,7 @@ def pdf_saidas():
         )
         
         # Título
+        elements = []
         titulo = "RELATÓRIO DE SAÍDAS"
         if veiculo:
             titulo += f" - Veículo: {veiculo}"
@@ -4534,8 +8167,7 @@ def pdf_saidas():
         elements.append(Spacer(1, 0.5*cm))
         
         # Tabela
-        data = [['Data Saída', 'Veículo', 'Motorista', 'Destino', 'Status', 'Data Retorno']]
-        for s in saidas:
+        def _linha(s):
             ts_saida = s.get('timestampSaida')
             data_saida = '-'
             if ts_saida:
@@ -4565,17 +8197,16 @@ def pdf_saidas():
             if destino != '-' and len(destino) > 30:
                 destino = destino[:30] + '...'
             
-            data.append([
+            return [
                 data_saida,
                 s.get('veiculo', '-') or '-',
                 s.get('motorista', '-') or '-',
                 destino,
                 status_text,
                 data_retorno
-            ])
+            ]
         
-        table = Table(data, colWidths=[4*cm, 3*cm, 4*cm, 5*cm, 3*cm, 4*cm])
-        table.setStyle(TableStyle([
+        estilo = TableStyle([
             ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#3b82f6')),
             ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
             ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
@@ -4587,18 +8218,21 @@ def pdf_saidas():
             ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
             ('FONTSIZE', (0, 1), (-1, -1), 9),
             ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.lightgrey])
-        ]))
-        elements.append(table)
-        
-        # Gerar PDF
-        doc.build(elements)
-        buffer.seek(0)
+        ])
         
+        # Gerar PDF em paisagem, uma tabela por página
         filename = f'saidas_{datetime.now().strftime("%Y%m%d_%H%M%S")}.pdf'
-        return Response(
-            buffer.getvalue(),
-            mimetype='application/pdf',
-            headers={'Content-Disposition': f'attachment;filename={filename}'}
+        return _pdf_resposta_em_blocos(
+            dict(pagesize=landscape(A4), rightMargin=1.5*cm, leftMargin=1.5*cm, topMargin=2*cm, bottomMargin=2*cm),
+            elements,
+            lambda primeira, por_pagina: _pdf_blocos_tabela(
+                (_linha(s) for s in saidas),
+                ['Data Saída', 'Veículo', 'Motorista', 'Destino', 'Status', 'Data Retorno'],
+                [4*cm, 3*cm, 4*cm, 5*cm, 3*cm, 4*cm],
+                estilo, primeira, por_pagina,
+                ['Nenhuma saída encontrada', '', '', '', '', '']
+            ),
+            filename
         )
         
     except Exception as e:
@@ -5179,16 +8813,318 @@ def gerar_pdf_km_mensal():
         return jsonify({"error": str(e)}), 500
 
 
+# ============================================
+# [PDF] FILA DE RELATÓRIOS EM SEGUNDO PLANO
+# ============================================
+# POST /api/relatorios cria um job; o PDF é gerado num pool de PROCESSOS
+# (fora das 8 threads do waitress, que continuam livres para o quiosque).
+# Status: GET /api/relatorios/<id> (o cliente consulta até concluir, sem
+# prender uma thread do waitress); arquivo em GET /api/relatorios/<id>/download.
+#
+# O resultado fica em disco com chave = hash(tipo + parâmetros + versão dos
+# dados das coleções usadas + dia). Relatório idêntico sem escrita nova nas
+# coleções é servido na hora. A versão é incrementada pelas rotas de escrita
+# (after_request); RELATORIOS_TTL limita a defasagem causada por escritas
+# feitas fora deste processo.
+
+RELATORIOS_PROCESSOS = int(os.getenv('RELATORIOS_PROCESSOS', '2'))
+RELATORIOS_TTL = int(os.getenv('RELATORIOS_TTL', '900'))  # 15 minutos
+RELATORIOS_JOBS_MAX = int(os.getenv('RELATORIOS_JOBS_MAX', '200'))
+RELATORIOS_DIR = os.getenv('RELATORIOS_DIR', os.path.join(tempfile.gettempdir(), 'frota_sanemar_relatorios'))
+
+# tipo -> (endpoint da rota /pdf/*, caminho, coleções lidas)
+RELATORIOS_TIPOS = {
+    'motoristas': ('pdf_motoristas', '/pdf/motoristas', ('motoristas',)),
+    'veiculos': ('pdf_veiculos', '/pdf/veiculos', ('veiculos', 'refuels')),
+    'abastecimentos': ('pdf_abastecimentos', '/pdf/abastecimentos', ('refuels',)),
+    'saidas': ('pdf_saidas', '/pdf/saidas', ('saidas',)),
+    'multas': ('pdf_multas', '/pdf/multas', ('multas',)),
+    'revisoes': ('pdf_revisoes', '/pdf/revisoes', ('revisoes', 'km_mensal')),
+    'km-mensal': ('gerar_pdf_km_mensal', '/pdf/km-mensal', ('km_mensal',)),
+}
+
+# Prefixo da rota de escrita -> coleções que ela altera
+RELATORIOS_ESCRITAS = (
+    ('/api/saida', ('saidas', 'motoristas', 'veiculos')),
+    ('/api/chegada', ('saidas', 'refuels', 'veiculos')),
+    ('/api/cancelar', ('saidas',)),
+    ('/api/saidas', ('saidas',)),
+    ('/api/abastecimento', ('refuels', 'veiculos')),
+    ('/api/refuels', ('refuels', 'veiculos')),
+    ('/api/veiculos', ('veiculos', 'refuels')),
+    ('/api/motoristas', ('motoristas',)),
+    ('/api/multas', ('multas',)),
+    ('/api/revisoes', ('revisoes',)),
+    ('/api/km-mensal', ('km_mensal',)),
+)
+
+_versoes_dados = Counter()
+
+
+@app.after_request
+def _registrar_versao_dados(response):
+    """Incrementa a versão das coleções alteradas por uma escrita bem-sucedida."""
+    if request.method in ('POST', 'PUT', 'PATCH', 'DELETE') and response.status_code < 400:
+        for prefixo, colecoes in RELATORIOS_ESCRITAS:
+            if request.path.startswith(prefixo):
+                for colecao in colecoes:
+                    _versoes_dados[colecao] += 1
+    return response
+
+
+def _renderizar_relatorio(endpoint, caminho, metodo, args, corpo, destino):
+    """Roda no processo do pool: executa a rota /pdf/* e grava o PDF em `destino`."""
+    view = app.view_functions[endpoint]
+    view = getattr(view, '__wrapped__', view)  # autenticação já feita no envio do job
+    with uso_firestore.rotina(caminho) as uso, \
+            app.test_request_context(caminho, method=metodo, query_string=args, json=corpo):
+        resposta = app.make_response(view())
+        if resposta.status_code != 200:
+            try:
+                erro = (resposta.get_json(silent=True) or {}).get('error')
+            finally:
+                resposta.close()
+            raise RuntimeError(erro or f'HTTP {resposta.status_code}')
+        temporario = destino + '.tmp'
+        try:
+            with open(temporario, 'wb') as f:
+                for pedaco in resposta.iter_encoded():
+                    f.write(pedaco)
+        finally:
+            resposta.close()
+        os.replace(temporario, destino)
+    # O consumo medido neste processo é somado no principal (FilaRelatorios._concluir)
+    return os.path.getsize(destino), {campo: uso[campo] for campo in ('leituras', 'escritas', 'exclusoes')}
+
+
+class FilaRelatorios:
+    """Jobs de PDF executados num ProcessPoolExecutor, com artefatos em cache por hash."""
+
+    def __init__(self, diretorio=RELATORIOS_DIR, processos=RELATORIOS_PROCESSOS):
+        self.diretorio = diretorio
+        self.processos = processos
+        self._lock = threading.Lock()
+        self._pool = None
+        self._jobs = OrderedDict()
+        self._por_chave = {}  # chave -> job_id em andamento (evita gerar o mesmo PDF duas vezes)
+
+    def _executor(self):
+        if self._pool is None:
+            os.makedirs(self.diretorio, exist_ok=True)
+            # spawn: o cliente gRPC do Firestore não sobrevive a fork()
+            self._pool = ProcessPoolExecutor(max_workers=self.processos,
+                                             mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    def _descartar_pool(self, pool):
+        """Um processo do pool morreu (ex.: falta de memória num PDF grande): o
+        ProcessPoolExecutor fica quebrado para sempre, então o próximo envio cria
+        outro. O pool quebrado já encerrou os próprios processos (sem shutdown aqui:
+        isto roda no callback da thread de gerenciamento dele)."""
+        if self._pool is pool:
+            self._pool = None
+            print('[PDF] Pool de processos quebrado - será recriado no próximo job')
+
+    @staticmethod
+    def chave(tipo, args, corpo):
+        _, _, colecoes = RELATORIOS_TIPOS[tipo]
+        dados = {
+            'tipo': tipo,
+            'args': sorted((k, v) for k, v in args.items()),
+            'corpo': corpo,
+            'versoes': [(c, _versoes_dados[c]) for c in colecoes],
+            'dia': datetime.now(LOCAL_TZ).strftime('%Y-%m-%d'),
+        }
+        return hashlib.sha256(json.dumps(dados, sort_keys=True, default=str).encode()).hexdigest()[:32]
+
+    def _caminho(self, chave):
+        return os.path.join(self.diretorio, f'{chave}.pdf')
+
+    def _artefato_valido(self, chave):
+        caminho = self._caminho(chave)
+        try:
+            return time.time() - os.path.getmtime(caminho) < RELATORIOS_TTL
+        except OSError:
+            return False
+
+    def _novo_job(self, tipo, chave, status):
+        job = {
+            'id': uuid.uuid4().hex,
+            'tipo': tipo,
+            'chave': chave,
+            'status': status,  # pendente | processando | concluido | erro
+            'criado_em': datetime.now(timezone.utc).isoformat(),
+            'concluido_em': None,
+            'tamanho': None,
+            'erro': None,
+            'cache': False,
+        }
+        self._jobs[job['id']] = job
+        while len(self._jobs) > RELATORIOS_JOBS_MAX:
+            self._jobs.popitem(last=False)
+        return job
+
+    def enviar(self, tipo, args, corpo=None, metodo='GET'):
+        """Cria o job (ou devolve um pronto/em andamento com a mesma chave)."""
+        endpoint, caminho, _ = RELATORIOS_TIPOS[tipo]
+        chave = self.chave(tipo, args, corpo)
+        with self._lock:
+            if self._artefato_valido(chave):
+                job = self._novo_job(tipo, chave, 'concluido')
+                job.update(cache=True, concluido_em=job['criado_em'],
+                           tamanho=os.path.getsize(self._caminho(chave)))
+                print(f'[PDF] Relatório {tipo} servido do cache ({chave[:8]})')
+                return dict(job)
+            job_id = self._por_chave.get(chave)
+            if job_id in self._jobs:
+                return dict(self._jobs[job_id])
+
+            job = self._novo_job(tipo, chave, 'pendente')
+            for tentativa in range(2):
+                pool = self._executor()
+                try:
+                    futuro = pool.submit(_renderizar_relatorio, endpoint, caminho, metodo,
+                                         args, corpo, self._caminho(chave))
+                    break
+                except BrokenProcessPool:
+                    self._descartar_pool(pool)
+            else:
+                job.update(status='erro', erro='Pool de processos indisponível.',
+                           concluido_em=datetime.now(timezone.utc).isoformat())
+                return dict(job)
+            self._por_chave[chave] = job['id']
+            job['status'] = 'processando'
+        futuro.add_done_callback(lambda f, job_id=job['id'], pool=pool: self._concluir(job_id, f, pool))
+        print(f'[PDF] Job {job["id"]} ({tipo}) enviado ao pool')
+        return dict(job)
+
+    def _concluir(self, job_id, futuro, pool=None):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            self._por_chave.pop(job['chave'], None)
+            job['concluido_em'] = datetime.now(timezone.utc).isoformat()
+            try:
+                job['tamanho'], uso = futuro.result()
+                job['status'] = 'concluido'
+                uso_firestore.mesclar(f"POST /api/relatorios ({job['tipo']})", uso)
+            except BrokenProcessPool:
+                # Todos os jobs do pool quebrado chegam aqui e viram erro
+                job['status'] = 'erro'
+                job['erro'] = 'O processo que gerava o relatório foi encerrado. Tente novamente.'
+                print(f'[PDF] Job {job_id} perdido: pool de processos quebrado')
+                if pool is not None:
+                    self._descartar_pool(pool)
+            except Exception as e:
+                job['status'] = 'erro'
+                job['erro'] = str(e)
+                print(f'[PDF] Job {job_id} falhou: {e}')
+
+    def obter(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def arquivo(self, job_id):
+        job = self.obter(job_id)
+        if not job or job['status'] != 'concluido':
+            return job, None
+        caminho = self._caminho(job['chave'])
+        return job, caminho if os.path.exists(caminho) else None
+
+    def limpar_expirados(self):
+        """Remove do disco artefatos mais velhos que o TTL."""
+        if not os.path.isdir(self.diretorio):
+            return
+        for nome in os.listdir(self.diretorio):
+            caminho = os.path.join(self.diretorio, nome)
+            try:
+                if time.time() - os.path.getmtime(caminho) > RELATORIOS_TTL:
+                    os.remove(caminho)
+            except OSError:
+                pass
+
+
+fila_relatorios = FilaRelatorios()
+
+
+def _job_publico(job):
+    dados = {k: v for k, v in job.items() if k != 'chave'}
+    dados['status_url'] = url_for('status_relatorio', job_id=job['id'])
+    if job['status'] == 'concluido':
+        dados['download_url'] = url_for('download_relatorio', job_id=job['id'])
+    return dados
+
+
+@app.route('/api/relatorios', methods=['POST'])
+@requires_auth
+def criar_relatorio():
+    """Cria um job de PDF: {"tipo": "saidas", "params": {...}, "dados": {...}}"""
+    if not db:
+        return jsonify({"error": "Conexão com o banco de dados não foi estabelecida."}), 500
+    data = request.get_json() or {}
+    tipo = data.get('tipo')
+    if tipo not in RELATORIOS_TIPOS:
+        return jsonify({"error": f"Tipo inválido. Use um de: {', '.join(RELATORIOS_TIPOS)}"}), 400
+    params = data.get('params') or {}
+    if not isinstance(params, dict):
+        return jsonify({"error": "'params' deve ser um objeto."}), 400
+    params = {str(k): str(v) for k, v in params.items() if v not in (None, '')}
+    corpo = data.get('dados')
+    try:
+        fila_relatorios.limpar_expirados()
+        job = fila_relatorios.enviar(tipo, params, corpo, metodo='POST' if corpo is not None else 'GET')
+        return jsonify(_job_publico(job)), 200 if job['status'] == 'concluido' else 202
+    except Exception as e:
+        print(f"Erro ao criar job de relatório: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/relatorios/<job_id>', methods=['GET'])
+@requires_auth
+def status_relatorio(job_id):
+    """Status de um job de PDF"""
+    job = fila_relatorios.obter(job_id)
+    if not job:
+        return jsonify({"error": "Job não encontrado."}), 404
+    return jsonify(_job_publico(job)), 200
+
+
+@app.route('/api/relatorios/<job_id>/download', methods=['GET'])
+@requires_auth
+def download_relatorio(job_id):
+    """Baixa o PDF de um job concluído"""
+    job, caminho = fila_relatorios.arquivo(job_id)
+    if not job:
+        return jsonify({"error": "Job não encontrado."}), 404
+    if job['status'] != 'concluido':
+        return jsonify({"error": f"Relatório ainda não está pronto (status: {job['status']})."}), 409
+    if not caminho:
+        return jsonify({"error": "Arquivo expirado. Gere o relatório novamente."}), 410
+    filename = f"{job['tipo']}_{datetime.now(LOCAL_TZ).strftime('%Y%m%d_%H%M%S')}.pdf"
+    return send_file(caminho, mimetype='application/pdf', as_attachment=True, download_name=filename)
+
+
 from waitress import serve
 
 # [OK] Endpoint de health check para UptimeRobot/Render
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint - mantém servidor acordado no Render"""
+    # Sempre 200: o processo está de pé mesmo com o Firestore fora do ar
+    # (o circuito se recupera sozinho, reiniciar não ajuda)
+    circuito = circuito_firestore.situacao()
+    try:
+        fila = fila_offline.resumo()
+    except Exception as e:
+        fila = {"error": str(e)}
     return jsonify({
-        "status": "healthy",
+        "status": "healthy" if circuito['estado'] == 'fechado' else "degraded",
         "timestamp": datetime.now(timezone.utc).isoformat(),
-        "service": "Frota Sanemar"
+        "service": "Frota Sanemar",
+        "firestore": circuito,
+        "fila_offline": fila,
     }), 200
 
 # Handler de erro global
@@ -5212,6 +9148,7 @@ def handle_exception(e):
 
 if __name__ == '__main__':
     print("RODOUUUUUUUUUUU")
+    iniciar_backfill_agregados_refuel()
     # threads=8: Permite processar 8 requisições simultâneas
     # channel_timeout=60: Timeout de 60s para requisições longas
     serve(app, host='0.0.0.0', port=5000, threads=8, channel_timeout=60)
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+Benchmark das rotas mais usadas do app.py contra o Firestore em memória
+(scripts/firestore_fake.py) - sem tocar no projeto de produção.
+
+Semeia uma frota realista (veículos, motoristas, viagens e abastecimentos
+de vários meses, multas e revisões), reconstrói os agregados do app e mede,
+por rota: latência p50/p95 e leituras/escritas do Firestore por requisição.
+
+Uso:
+    python scripts/benchmark_endpoints.py
+    python scripts/benchmark_endpoints.py --meses 12 --viagens-dia 80 --repeticoes 50
+    python scripts/benchmark_endpoints.py --latencia-ms 8 --latencia-doc-ms 0.05 --json resultado.json
+
+Rotas: /api/historico, /api/dashboard_stats, /api/saida, /api/chegada,
+/api/veiculos/<placa>/metrics e /pdf/* (motoristas, veiculos,
+abastecimentos, saidas, multas, revisoes, km-mensal).
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# O benchmark nunca deve usar credenciais reais nem o cache compartilhado
+os.environ.pop('GOOGLE_APPLICATION_CREDENTIALS_JSON', None)
+os.environ.setdefault('CACHE_BACKEND', 'memory')
+
+SECOES = ['Base de Itaipuaçu', 'Base ETE de Araçatiba', 'Sede Sanemar', 'Comercial', 'Outros']
+CATEGORIAS = ['Base de Itaipuaçu', 'Base ETE de Araçatiba', 'Sede Sanemar', 'Vans', 'Comercial', 'Outros']
+TRAJETOS = ['Centro', 'Itaipuaçu', 'Araçatiba', 'Inoã', 'Maricá', 'São José', 'Ponta Negra']
+
+
+def _importar_app():
+    """Importa o app.py sem credenciais (a inicialização do Firebase falha e é ignorada)."""
+    saida = io.StringIO()
+    with contextlib.redirect_stdout(saida), contextlib.redirect_stderr(saida):
+        import app as app_module
+    return app_module
+
+
+def _placa(i):
+    letras = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    return f'{letras[i % 26]}{letras[(i // 26) % 26]}{letras[(i // 676) % 26]}{i % 10}{letras[i % 26]}{(i * 7) % 100:02d}'
+
+
+def semear(fake, app_module, args, rnd):
+    """Grava a massa de dados direto no fake (sem contar leituras/escritas)."""
+    agora = datetime.now(timezone.utc)
+    placas = [_placa(i) for i in range(args.veiculos)]
+    motoristas = [f'Motorista {i:03d}' for i in range(args.motoristas)]
+
+    for i, placa in enumerate(placas):
+        fake.semear('veiculos', f'v{i:04d}', {
+            'placa': placa, 'modelo': rnd.choice(['Strada', 'Saveiro', 'Hilux', 'Master', 'Gol']),
+            'tipo': 'Utilitário', 'categoria': rnd.choice(CATEGORIAS), 'status_ativo': i % 15 != 0,
+            'visivel_para_motoristas': True, 'viagens_totais': 0, 'km_atual': 0,
+            'dataCadastro': agora - timedelta(days=400),
+        })
+    for i, nome in enumerate(motoristas):
+        fake.semear('motoristas', f'm{i:04d}', {
+            'nome': nome, 'secao': rnd.choice(SECOES), 'empresa': 'Sanemar', 'funcao': 'Motorista',
+            'status': 'credenciado', 'status_ativo': True, 'viagens_totais': 0,
+            'dataCadastro': agora - timedelta(days=400),
+        })
+
+    viagens_v = dict.fromkeys(placas, 0)
+    viagens_m = dict.fromkeys(motoristas, 0)
+    odometro = {placa: rnd.randint(10000, 90000) for placa in placas}
+    inicio = agora - timedelta(days=30 * args.meses)
+    n_saidas = n_refuels = 0
+    dia = inicio
+    while dia < agora - timedelta(hours=2):
+        for _ in range(args.viagens_dia):
+            ts_saida = dia + timedelta(minutes=rnd.randint(6 * 60, 18 * 60))
+            if ts_saida >= agora - timedelta(hours=2):
+                continue
+            ts_chegada = ts_saida + timedelta(minutes=rnd.randint(20, 300))
+            placa, nome = rnd.choice(placas), rnd.choice(motoristas)
+            fake.semear('saidas', f's{n_saidas:07d}', {
+                'veiculo': placa, 'motorista': nome, 'solicitante': rnd.choice(motoristas),
+                'trajeto': rnd.choice(TRAJETOS), 'status': 'finalizada',
+                'timestampSaida': ts_saida, 'horarioSaida': ts_saida.strftime('%H:%M'),
+                'timestampChegada': ts_chegada, 'horarioChegada': ts_chegada.strftime('%H:%M'),
+            })
+            viagens_v[placa] += 1
+            viagens_m[nome] += 1
+            n_saidas += 1
+        for _ in range(args.abastecimentos_dia):
+            placa = rnd.choice(placas)
+            odometro[placa] += rnd.randint(80, 600)
+            fake.semear('refuels', f'r{n_refuels:07d}', {
+                'veiculo': placa, 'motorista': rnd.choice(motoristas),
+                'litros': round(rnd.uniform(15, 70), 2),
+                'odometro': odometro[placa] if rnd.random() > 0.05 else None,
+                'observacao': '', 'timestamp': dia + timedelta(minutes=rnd.randint(6 * 60, 18 * 60)),
+            })
+            n_refuels += 1
+        dia += timedelta(days=1)
+
+    for i, placa in enumerate(placas):
+        fake.semear('veiculos', f'v{i:04d}', {**fake._dados['veiculos'][f'v{i:04d}'],
+                                              'viagens_totais': viagens_v[placa], 'ultimo_odometro': odometro[placa]})
+    for i, nome in enumerate(motoristas):
+        fake.semear('motoristas', f'm{i:04d}', {**fake._dados['motoristas'][f'm{i:04d}'],
+                                                'viagens_totais': viagens_m[nome]})
+
+    for i in range(args.veiculos * 3):
+        vencimento = agora + timedelta(days=rnd.randint(-200, 60))
+        fake.semear('multas', f'mu{i:05d}', {
+            'placa': rnd.choice(placas), 'motorista': rnd.choice(motoristas), 'valor': round(rnd.uniform(88, 880), 2),
+            'descricao': 'Excesso de velocidade', 'status': rnd.choice(['pendente', 'paga', 'contestada']),
+            'data_infracao': vencimento - timedelta(days=30), 'data_vencimento': vencimento,
+        })
+    for i in range(args.veiculos * 2):
+        fake.semear('revisoes', f'rv{i:05d}', {
+            'placa': rnd.choice(placas), 'tipo': 'Preventiva', 'descricao': 'Troca de óleo e filtros',
+            'status': rnd.choice(['aberto', 'em_andamento', 'concluido']), 'prioridade': 'media',
+            'data_abertura': agora - timedelta(days=rnd.randint(0, 300)),
+        })
+    for placa in placas:
+        for m in range(args.meses):
+            mes = (agora - timedelta(days=30 * m)).astimezone(app_module.LOCAL_TZ).strftime('%Y-%m')
+            fake.semear('km_mensal', f'{placa}_{mes}', {
+                'placa': placa, 'mes_ano': mes, 'km_inicial': 0, 'km_final': rnd.randint(500, 4000),
+                'km_rodados': rnd.randint(500, 4000),
+            })
+    return placas, motoristas, n_saidas, n_refuels
+
+
+def reconstruir_agregados(app_module, args):
+    """Monta os documentos derivados (resumos, travas, agregados) pelo próprio app."""
+    agora_local = datetime.now(app_module.LOCAL_TZ)
+    meses = set()
+    for d in range(0, 30 * args.meses + 31, 15):
+        meses.add((agora_local - timedelta(days=d)).strftime('%Y-%m'))
+    for mes in sorted(meses):
+        app_module.reconstruir_resumo_mensal(mes)
+    app_module.reconstruir_saidas_ativas()
+    app_module.reconstruir_agregados_refuel()
+    app_module.reconstruir_resumo_refuels()
+    for veiculo in app_module.veiculos_index.all():
+        app_module.recalcular_metricas_veiculo(veiculo['placa'])
+
+
+def _percentil(valores, p):
+    ordenados = sorted(valores)
+    if not ordenados:
+        return 0.0
+    k = (len(ordenados) - 1) * p / 100
+    f = int(k)
+    c = min(f + 1, len(ordenados) - 1)
+    return ordenados[f] + (ordenados[c] - ordenados[f]) * (k - f)
+
+
+class Bancada:
+    def __init__(self, app_module, fake, cliente, silencioso=True):
+        self.app = app_module
+        self.fake = fake
+        self.cliente = cliente
+        self.silencioso = silencioso
+        self.resultados = []
+
+    def _chamar(self, metodo, url, **kwargs):
+        saida = io.StringIO()
+        redirecionar = contextlib.redirect_stdout(saida) if self.silencioso else contextlib.nullcontext()
+        with redirecionar, self.fake.medir() as uso:
+            inicio = time.perf_counter()
+            resposta = self.cliente.open(url, method=metodo, **kwargs)
+            corpo = resposta.get_data()  # consome respostas em streaming (PDF em blocos)
+            duracao = time.perf_counter() - inicio
+        # Contagem feita pelo próprio app.py (ClienteContabilizado), para conferência
+        uso_app = getattr(self.app, 'uso_firestore', None)
+        uso_app = uso_app.ultima() if uso_app else None
+        return resposta.status_code, len(corpo), duracao, uso, uso_app
+
+    def medir(self, nome, gerar_chamada, repeticoes, antes=None):
+        """Executa `repeticoes` chamadas (+1 de aquecimento) e guarda as estatísticas."""
+        tempos, leituras, escritas, status, tamanhos, leituras_app = [], [], [], {}, [], []
+        for i in range(repeticoes + 1):
+            if antes:
+                antes()
+            metodo, url, kwargs = gerar_chamada(i)
+            codigo, tamanho, duracao, uso, uso_app = self._chamar(metodo, url, **kwargs)
+            if i == 0:
+                continue
+            tempos.append(duracao * 1000)
+            leituras.append(uso.leituras)
+            escritas.append(uso.escritas + uso.exclusoes)
+            if uso_app is not None:
+                leituras_app.append(uso_app['leituras'])
+            tamanhos.append(tamanho)
+            status[codigo] = status.get(codigo, 0) + 1
+        resultado = {
+            'rota': nome,
+            'n': repeticoes,
+            'p50_ms': round(_percentil(tempos, 50), 1),
+            'p95_ms': round(_percentil(tempos, 95), 1),
+            'media_ms': round(statistics.mean(tempos), 1),
+            'leituras_req': round(statistics.mean(leituras), 1),
+            'leituras_max': max(leituras),
+            'escritas_req': round(statistics.mean(escritas), 1),
+            'leituras_app_req': round(statistics.mean(leituras_app), 1) if leituras_app else None,
+            'bytes_req': int(statistics.mean(tamanhos)),
+            'status': status,
+        }
+        self.resultados.append(resultado)
+        print(f"  {nome:<42} p50 {resultado['p50_ms']:>8.1f} ms  p95 {resultado['p95_ms']:>8.1f} ms  "
+              f"leituras/req {resultado['leituras_req']:>8.1f} (app {resultado['leituras_app_req']})  "
+              f"escritas/req {resultado['escritas_req']:>5.1f}  "
+              f"status {status}")
+        return resultado
+
+
+def executar(args):
+    rnd = random.Random(args.seed)
+    app_module = _importar_app()
+    from firestore_fake import instalar
+
+    fake = instalar(app_module, latencia_ms=args.latencia_ms, latencia_doc_ms=args.latencia_doc_ms)
+    # Latência só nas rotas medidas; a semeadura e os agregados rodam sem espera
+    latencias = (fake.medidor.latencia, fake.medidor.latencia_doc)
+    fake.medidor.latencia = fake.medidor.latencia_doc = 0
+
+    print('[BENCH] Semeando dados...')
+    placas, motoristas, n_saidas, n_refuels = semear(fake, app_module, args, rnd)
+    with contextlib.redirect_stdout(io.StringIO()):
+        reconstruir_agregados(app_module, args)
+    print(f'[BENCH] {len(placas)} veículos, {len(motoristas)} motoristas, {n_saidas} viagens, '
+          f'{n_refuels} abastecimentos ({fake.total_documentos()} documentos no total)')
+
+    fake.medidor.latencia, fake.medidor.latencia_doc = latencias
+    cliente = app_module.app.test_client()
+    with cliente.session_transaction() as sessao:
+        sessao['logged_in'] = True
+        sessao['user_type'] = 'admin'
+        sessao['username'] = 'benchmark'
+
+    bancada = Bancada(app_module, fake, cliente, silencioso=not args.verbose)
+    n = args.repeticoes
+    mes_atual = datetime.now(app_module.LOCAL_TZ).strftime('%Y-%m')
+    hoje = datetime.now(app_module.LOCAL_TZ)
+
+    print(f'[BENCH] {n} repetições por rota, latência {args.latencia_ms} ms/chamada + {args.latencia_doc_ms} ms/doc\n')
+
+    # --- Leituras ---
+    bancada.medir('GET /api/historico (cache)', lambda i: ('GET', '/api/historico?limit=50', {}), n)
+    bancada.medir('GET /api/historico (sem cache)', lambda i: ('GET', '/api/historico?limit=50', {}),
+                  n, antes=app_module.historico_cache.clear)
+    bancada.medir('GET /api/historico (mês, sem cache)', lambda i: (
+        'GET', f'/api/historico?mes_filtro={hoje.month}&ano_filtro={hoje.year}&limit=50', {}),
+        n, antes=app_module.historico_cache.clear)
+    bancada.medir('GET /api/dashboard_stats (cache)', lambda i: ('GET', f'/api/dashboard_stats?month={mes_atual}', {}), n)
+    bancada.medir('GET /api/dashboard_stats (sem cache)', lambda i: ('GET', f'/api/dashboard_stats?month={mes_atual}', {}),
+                  n, antes=app_module.dashboard_cache.clear)
+    bancada.medir('GET /api/veiculos/<placa>/metrics', lambda i: (
+        'GET', f'/api/veiculos/{placas[i % len(placas)]}/metrics?month={mes_atual}', {}), n)
+
+    # --- Escritas: saída e chegada do mesmo veículo ---
+    livres = list(placas)
+    rnd.shuffle(livres)
+    em_curso = []
+
+    def _saida(i):
+        placa = livres[i % len(livres)]
+        em_curso.append(placa)
+        return 'POST', '/api/saida', {'json': {
+            'veiculo': placa, 'motorista': rnd.choice(motoristas), 'solicitante': 'Benchmark', 'trajeto': rnd.choice(TRAJETOS)}}
+
+    def _chegada(i):
+        placa = em_curso[i % len(em_curso)]
+        return 'POST', '/api/chegada', {'json': {'veiculo': placa, 'litros': 40.5, 'odometro': 999999 + i}}
+
+    bancada.medir('POST /api/saida', _saida, min(n, len(placas) - 1))
+    bancada.medir('POST /api/chegada', _chegada, min(n, len(em_curso) - 1))
+
+    # --- PDFs ---
+    inicio_30d = (hoje - timedelta(days=30)).strftime('%Y-%m-%d')
+    fim_hoje = hoje.strftime('%Y-%m-%d')
+    pdfs = [
+        ('GET /pdf/motoristas', '/pdf/motoristas'),
+        ('GET /pdf/veiculos', '/pdf/veiculos'),
+        ('GET /pdf/abastecimentos (30 dias)', f'/pdf/abastecimentos?data_inicio={inicio_30d}&data_fim={fim_hoje}'),
+        ('GET /pdf/saidas (30 dias)', f'/pdf/saidas?data_inicio={inicio_30d}&data_fim={fim_hoje}'),
+        ('GET /pdf/multas', '/pdf/multas'),
+        ('GET /pdf/revisoes', '/pdf/revisoes'),
+        ('GET /pdf/km-mensal', f'/pdf/km-mensal?mes={mes_atual}'),
+    ]
+    for nome, url in pdfs:
+        bancada.medir(nome, lambda i, url=url: ('GET', url, {}), max(1, n // 5))
+
+    print(f"\n[BENCH] Totais do Firestore fake: {fake.uso_total()}")
+    return bancada.resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark das rotas do app.py com Firestore em memória')
+    parser.add_argument('--veiculos', type=int, default=40)
+    parser.add_argument('--motoristas', type=int, default=80)
+    parser.add_argument('--meses', type=int, default=6, help='meses de histórico semeados')
+    parser.add_argument('--viagens-dia', type=int, default=60)
+    parser.add_argument('--abastecimentos-dia', type=int, default=12)
+    parser.add_argument('--repeticoes', type=int, default=30)
+    parser.add_argument('--latencia-ms', type=float, default=5.0, help='latência simulada por chamada ao Firestore')
+    parser.add_argument('--latencia-doc-ms', type=float, default=0.02, help='latência simulada por documento lido/escrito')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', help='grava os resultados neste arquivo')
+    parser.add_argument('--verbose', action='store_true', help='mostra os logs do app durante as requisições')
+    args = parser.parse_args()
+
+    resultados = executar(args)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'parametros': vars(args), 'resultados': resultados}, f, indent=2, ensure_ascii=False)
+        print(f"✅ Resultados gravados em {args.json}")
+    # Encerra sem esperar threads de fundo do app (auditoria, réplica)
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,939 @@
+"""
+Firestore e Storage em memória para rodar o app.py sem o projeto de produção.
+
+Implementa o subconjunto da API usado pelo app.py:
+- coleções/documentos: document(), add(), get(), set(merge=), update(), delete()
+- consultas: where (FieldFilter, And, Or ou campo/op/valor), order_by,
+  limit, offset, select, start_after/start_at/end_before/end_at,
+  stream()/get() (também dentro de transação), count() e sum()
+- escrita: WriteBatch, transações (firestore.transactional), get_all
+- transformações: Increment, Maximum, Minimum, SERVER_TIMESTAMP,
+  DELETE_FIELD, ArrayUnion, ArrayRemove
+- listeners on_snapshot (usados pela réplica de saídas)
+- Storage: bucket.blob(), list_blobs(), upload/download, make_public, rewrite
+
+Cada operação pode simular latência (por chamada e por documento) e conta
+leituras/escritas como o Firestore cobra (consulta vazia = 1 leitura,
+count() = 1 leitura a cada 1000 entradas). Os contadores são globais e por
+thread, para medir só o que uma requisição fez.
+
+Uso:
+    import app
+    from firestore_fake import instalar
+    fake = instalar(app, latencia_ms=5)
+    fake.semear('veiculos', 'abc', {'placa': 'ABC1D23'})
+    with fake.medir() as uso:
+        app.app.test_client().get('/api/dashboard_stats')
+    print(uso.leituras, uso.escritas)
+"""
+
+import copy
+import queue
+import random
+import string
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from google.api_core import exceptions as gexc
+from google.cloud.firestore_v1 import transforms
+from google.cloud.firestore_v1.base_query import And, FieldFilter, Or
+
+DOCUMENT_ID = '__name__'
+LOTE_MAX = 500
+
+
+# ==========================================
+# CONTADORES E LATÊNCIA
+# ==========================================
+
+class Uso:
+    """Leituras, escritas, exclusões e chamadas (RPCs) acumuladas."""
+
+    CAMPOS = ('leituras', 'escritas', 'exclusoes', 'chamadas', 'storage')
+
+    def __init__(self):
+        for campo in self.CAMPOS:
+            setattr(self, campo, 0)
+
+    def somar(self, **valores):
+        for campo, valor in valores.items():
+            setattr(self, campo, getattr(self, campo) + valor)
+
+    def como_dict(self):
+        return {campo: getattr(self, campo) for campo in self.CAMPOS}
+
+
+class Medidor:
+    def __init__(self, latencia_ms=0.0, latencia_doc_ms=0.0, variacao=0.2):
+        self.latencia = latencia_ms / 1000
+        self.latencia_doc = latencia_doc_ms / 1000
+        self.variacao = variacao
+        self.total = Uso()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _pilha(self):
+        if not hasattr(self._local, 'pilha'):
+            self._local.pilha = []
+        return self._local.pilha
+
+    def registrar(self, docs=0, **valores):
+        """Conta a operação (global e nas medições abertas na thread) e dorme a latência."""
+        with self._lock:
+            self.total.somar(**valores)
+        for uso in self._pilha():
+            uso.somar(**valores)
+        espera = self.latencia + docs * self.latencia_doc
+        if espera > 0:
+            time.sleep(espera * random.uniform(1 - self.variacao, 1 + self.variacao))
+
+    @contextmanager
+    def medir(self):
+        uso = Uso()
+        pilha = self._pilha()
+        pilha.append(uso)
+        try:
+            yield uso
+        finally:
+            pilha.remove(uso)
+
+
+# ==========================================
+# VALORES, CAMINHOS E ORDENAÇÃO
+# ==========================================
+
+def _agora():
+    return datetime.now(timezone.utc)
+
+
+def _normalizar(valor):
+    """Cópia do valor como o Firestore devolveria (datetime sempre com fuso UTC)."""
+    if isinstance(valor, datetime):
+        return valor.replace(tzinfo=timezone.utc) if valor.tzinfo is None else valor.astimezone(timezone.utc)
+    if isinstance(valor, dict):
+        return {k: _normalizar(v) for k, v in valor.items()}
+    if isinstance(valor, (list, tuple)):
+        return [_normalizar(v) for v in valor]
+    return valor
+
+
+def _partes(campo):
+    if isinstance(campo, (list, tuple)):
+        return list(campo)
+    return str(campo).split('.')
+
+
+_AUSENTE = object()
+
+
+def _ler_campo(dados, campo):
+    atual = dados
+    for parte in _partes(campo):
+        if not isinstance(atual, dict) or parte not in atual:
+            return _AUSENTE
+        atual = atual[parte]
+    return atual
+
+
+def _rank(valor):
+    """Ordem de tipos do Firestore: null < bool < número < data < texto < bytes < referência < lista < mapa."""
+    if valor is None:
+        return 0, 0
+    if isinstance(valor, bool):
+        return 1, valor
+    if isinstance(valor, (int, float)):
+        return 2, valor
+    if isinstance(valor, datetime):
+        return 3, valor
+    if isinstance(valor, str):
+        return 4, valor
+    if isinstance(valor, bytes):
+        return 5, valor
+    if isinstance(valor, DocumentReference):
+        return 6, valor.path
+    if isinstance(valor, list):
+        return 7, [_rank(v) for v in valor]
+    if isinstance(valor, dict):
+        return 8, sorted((k, _rank(v)) for k, v in valor.items())
+    return 9, str(valor)
+
+
+def _comparar(a, b):
+    ra, rb = _rank(a), _rank(b)
+    return (ra > rb) - (ra < rb)
+
+
+def _avaliar(op, valor, alvo):
+    if valor is _AUSENTE:
+        return False
+    if op == '==':
+        return _comparar(valor, alvo) == 0
+    if op == '!=':
+        return valor is not None and _comparar(valor, alvo) != 0
+    if op in ('<', '<=', '>', '>='):
+        # Desigualdade só compara valores do mesmo tipo
+        if _rank(valor)[0] != _rank(alvo)[0]:
+            return False
+        c = _comparar(valor, alvo)
+        return {'<': c < 0, '<=': c <= 0, '>': c > 0, '>=': c >= 0}[op]
+    if op == 'in':
+        return any(_comparar(valor, a) == 0 for a in alvo)
+    if op == 'not-in':
+        return valor is not None and all(_comparar(valor, a) != 0 for a in alvo)
+    if op == 'array_contains':
+        return isinstance(valor, list) and any(_comparar(v, alvo) == 0 for v in valor)
+    if op == 'array_contains_any':
+        return isinstance(valor, list) and any(_comparar(v, a) == 0 for v in valor for a in alvo)
+    raise ValueError(f'Operador não suportado pelo fake: {op}')
+
+
+# ==========================================
+# APLICAÇÃO DE ESCRITAS (transformações e merge)
+# ==========================================
+
+def _aplicar_transform(atual, valor):
+    if valor is transforms.SERVER_TIMESTAMP:
+        return _agora()
+    if isinstance(valor, transforms.Increment):
+        base = atual if isinstance(atual, (int, float)) and not isinstance(atual, bool) else 0
+        return base + valor.value
+    if isinstance(valor, transforms.Maximum):
+        if not isinstance(atual, (int, float)) or isinstance(atual, bool):
+            return valor.value
+        return max(atual, valor.value)
+    if isinstance(valor, transforms.Minimum):
+        if not isinstance(atual, (int, float)) or isinstance(atual, bool):
+            return valor.value
+        return min(atual, valor.value)
+    if isinstance(valor, transforms.ArrayUnion):
+        lista = list(atual) if isinstance(atual, list) else []
+        for item in valor.values:
+            if not any(_comparar(item, x) == 0 for x in lista):
+                lista.append(_normalizar(item))
+        return lista
+    if isinstance(valor, transforms.ArrayRemove):
+        lista = list(atual) if isinstance(atual, list) else []
+        return [x for x in lista if not any(_comparar(x, item) == 0 for item in valor.values)]
+    return _AUSENTE
+
+
+def _resolver(atual, valor):
+    """Valor final de um campo: transformação, mapa (recursivo) ou valor simples."""
+    transformado = _aplicar_transform(atual, valor)
+    if transformado is not _AUSENTE:
+        return transformado
+    if isinstance(valor, dict):
+        return {k: _resolver(_AUSENTE, v) for k, v in valor.items() if v is not transforms.DELETE_FIELD}
+    return _normalizar(valor)
+
+
+def _gravar_caminho(dados, partes, valor):
+    for parte in partes[:-1]:
+        if not isinstance(dados.get(parte), dict):
+            dados[parte] = {}
+        dados = dados[parte]
+    if valor is transforms.DELETE_FIELD:
+        dados.pop(partes[-1], None)
+    else:
+        dados[partes[-1]] = _resolver(dados.get(partes[-1], _AUSENTE), valor)
+
+
+def _merge(destino, origem):
+    """set(merge=True): mapas são mesclados, o resto substitui."""
+    for chave, valor in origem.items():
+        if valor is transforms.DELETE_FIELD:
+            destino.pop(chave, None)
+        elif isinstance(valor, dict):
+            if not isinstance(destino.get(chave), dict):
+                destino[chave] = {}
+            _merge(destino[chave], valor)
+        else:
+            destino[chave] = _resolver(destino.get(chave, _AUSENTE), valor)
+
+
+# ==========================================
+# SNAPSHOTS E REFERÊNCIAS
+# ==========================================
+
+class DocumentSnapshot:
+    def __init__(self, reference, dados, read_time=None):
+        self.reference = reference
+        self.id = reference.id
+        self._dados = dados
+        self.exists = dados is not None
+        self.read_time = read_time or _agora()
+        self.create_time = self.update_time = self.read_time if self.exists else None
+
+    def to_dict(self):
+        return copy.deepcopy(self._dados) if self._dados is not None else None
+
+    def get(self, campo):
+        if self._dados is None:
+            return None
+        valor = _ler_campo(self._dados, campo)
+        if valor is _AUSENTE:
+            raise KeyError(campo)
+        return copy.deepcopy(valor)
+
+
+def _novo_id():
+    return ''.join(random.choices(string.ascii_letters + string.digits, k=20))
+
+
+class DocumentReference:
+    def __init__(self, cliente, colecao, doc_id):
+        self._cliente = cliente
+        self._colecao = colecao
+        self.id = doc_id
+        self.path = f'{colecao}/{doc_id}'
+
+    def __eq__(self, outro):
+        return isinstance(outro, DocumentReference) and outro.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def __repr__(self):
+        return f'<DocumentReference {self.path}>'
+
+    @property
+    def parent(self):
+        return CollectionReference(self._cliente, self._colecao)
+
+    def collection(self, nome):
+        return CollectionReference(self._cliente, f'{self.path}/{nome}')
+
+    def get(self, field_paths=None, transaction=None, **kwargs):
+        snap = self._cliente._ler_doc(self)
+        self._cliente.medidor.registrar(docs=1, leituras=1, chamadas=1)
+        if field_paths and snap.exists:
+            dados = snap.to_dict()
+            snap = DocumentSnapshot(self, _projetar(dados, field_paths))
+        return snap
+
+    def set(self, dados, merge=False):
+        self._cliente._commit([('set', self, dados, merge)])
+
+    def create(self, dados):
+        self._cliente._commit([('create', self, dados, False)])
+
+    def update(self, dados):
+        self._cliente._commit([('update', self, dados, False)])
+
+    def delete(self):
+        self._cliente._commit([('delete', self, None, False)])
+
+
+def _projetar(dados, campos):
+    projetado = {}
+    for campo in campos:
+        valor = _ler_campo(dados, campo)
+        if valor is not _AUSENTE:
+            _gravar_caminho(projetado, _partes(campo), valor)
+    return projetado
+
+
+# ==========================================
+# CONSULTAS
+# ==========================================
+
+class _Agregacao:
+    def __init__(self, consulta, tipo, campo=None, alias=None):
+        self._consulta = consulta
+        self._tipo = tipo
+        self._campo = campo
+        self._alias = alias or tipo
+
+    def get(self, transaction=None, **kwargs):
+        docs = self._consulta._executar()
+        cliente = self._consulta._cliente
+        cliente.medidor.registrar(docs=0, leituras=max(1, (len(docs) + 999) // 1000), chamadas=1)
+        if self._tipo == 'count':
+            valor = len(docs)
+        else:
+            numeros = [v for v in (_ler_campo(d, self._campo) for _, d in docs)
+                       if isinstance(v, (int, float)) and not isinstance(v, bool)]
+            if self._tipo == 'sum':
+                valor = sum(numeros)
+            else:
+                valor = sum(numeros) / len(numeros) if numeros else None
+        return [[SimpleNamespace(alias=self._alias, value=valor, read_time=_agora())]]
+
+    def stream(self, transaction=None, **kwargs):
+        yield from self.get(transaction=transaction)
+
+
+class Query:
+    ASCENDING = 'ASCENDING'
+    DESCENDING = 'DESCENDING'
+
+    def __init__(self, cliente, colecao, filtros=(), ordem=(), limite=None, pular=0,
+                 campos=None, inicio=None, fim=None, ultimos=False):
+        self._cliente = cliente
+        self._colecao = colecao
+        self._filtros = tuple(filtros)
+        self._ordem = tuple(ordem)
+        self._limite = limite
+        self._pular = pular
+        self._campos = campos
+        self._inicio = inicio   # (valores, inclusivo)
+        self._fim = fim
+        self._ultimos = ultimos
+
+    def _copiar(self, **mudancas):
+        atual = dict(filtros=self._filtros, ordem=self._ordem, limite=self._limite, pular=self._pular,
+                     campos=self._campos, inicio=self._inicio, fim=self._fim, ultimos=self._ultimos)
+        atual.update(mudancas)
+        return Query(self._cliente, self._colecao, **atual)
+
+    # --- construção ---
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is None:
+            filter = FieldFilter(field_path, op_string, value)
+        return self._copiar(filtros=self._filtros + (filter,))
+
+    def order_by(self, field_path, direction=ASCENDING):
+        campo = DOCUMENT_ID if str(field_path) == DOCUMENT_ID else field_path
+        return self._copiar(ordem=self._ordem + ((campo, direction),))
+
+    def limit(self, count):
+        return self._copiar(limite=count, ultimos=False)
+
+    def limit_to_last(self, count):
+        return self._copiar(limite=count, ultimos=True)
+
+    def offset(self, num_to_skip):
+        return self._copiar(pular=num_to_skip)
+
+    def select(self, field_paths):
+        return self._copiar(campos=list(field_paths))
+
+    def start_after(self, valores):
+        return self._copiar(inicio=(valores, False))
+
+    def start_at(self, valores):
+        return self._copiar(inicio=(valores, True))
+
+    def end_before(self, valores):
+        return self._copiar(fim=(valores, False))
+
+    def end_at(self, valores):
+        return self._copiar(fim=(valores, True))
+
+    def count(self, alias=None):
+        return _Agregacao(self, 'count', alias=alias)
+
+    def sum(self, field_ref, alias=None):
+        return _Agregacao(self, 'sum', field_ref, alias)
+
+    def avg(self, field_ref, alias=None):
+        return _Agregacao(self, 'avg', field_ref, alias)
+
+    # --- execução ---
+
+    def _casa(self, filtro, doc_id, dados):
+        if isinstance(filtro, And):
+            return all(self._casa(f, doc_id, dados) for f in filtro.filters)
+        if isinstance(filtro, Or):
+            return any(self._casa(f, doc_id, dados) for f in filtro.filters)
+        campo = str(filtro.field_path)
+        if campo == DOCUMENT_ID:
+            alvo = filtro.value
+            alvo = [a.id if isinstance(a, DocumentReference) else a for a in alvo] if isinstance(alvo, list) else (
+                alvo.id if isinstance(alvo, DocumentReference) else alvo)
+            return _avaliar(filtro.op_string, doc_id, alvo)
+        return _avaliar(filtro.op_string, _ler_campo(dados, campo), filtro.value)
+
+    def _chave(self, ordem, doc_id, dados):
+        chave = []
+        for campo, direcao in ordem:
+            valor = doc_id if campo == DOCUMENT_ID else _ler_campo(dados, campo)
+            rank = _rank(valor)
+            chave.append(_Invertido(rank) if direcao == self.DESCENDING else rank)
+        return chave
+
+    def _ordem_efetiva(self):
+        ordem = list(self._ordem)
+        if not any(campo == DOCUMENT_ID for campo, _ in ordem):
+            direcao = ordem[-1][1] if ordem else self.ASCENDING
+            ordem.append((DOCUMENT_ID, direcao))
+        return ordem
+
+    def _valores_cursor(self, cursor, ordem):
+        valores, inclusivo = cursor
+        if isinstance(valores, DocumentSnapshot):
+            dados = valores._dados or {}
+            valores = [valores.id if c == DOCUMENT_ID else _ler_campo(dados, c) for c, _ in ordem]
+        elif isinstance(valores, dict):
+            lista = []
+            for campo, _ in ordem:
+                if campo == DOCUMENT_ID:
+                    valor = next((v for k, v in valores.items() if str(k) == DOCUMENT_ID), _AUSENTE)
+                    valor = valor.id if isinstance(valor, DocumentReference) else valor
+                else:
+                    valor = valores.get(campo, _AUSENTE)
+                if valor is _AUSENTE:
+                    break
+                lista.append(valor)
+            valores = lista
+        else:
+            valores = list(valores)
+        return self._chave(ordem[:len(valores)], *_documento_cursor(ordem[:len(valores)], valores)), inclusivo
+
+    def _executar(self):
+        """[(doc_id, dados)] que atendem a consulta (sem contar leituras)."""
+        docs = self._cliente._docs_colecao(self._colecao)
+        resultado = [(doc_id, dados) for doc_id, dados in docs
+                     if all(self._casa(f, doc_id, dados) for f in self._filtros)]
+        # order_by exclui documentos sem o campo
+        for campo, _ in self._ordem:
+            if campo != DOCUMENT_ID:
+                resultado = [(i, d) for i, d in resultado if _ler_campo(d, campo) is not _AUSENTE]
+        ordem = self._ordem_efetiva()
+        resultado.sort(key=lambda item: self._chave(ordem, *item))
+        if self._inicio:
+            limite, inclusivo = self._valores_cursor(self._inicio, ordem)
+            n = len(limite)
+            resultado = [item for item in resultado
+                         if (self._chave(ordem, *item)[:n] > limite) or (inclusivo and self._chave(ordem, *item)[:n] == limite)]
+        if self._fim:
+            limite, inclusivo = self._valores_cursor(self._fim, ordem)
+            n = len(limite)
+            resultado = [item for item in resultado
+                         if (self._chave(ordem, *item)[:n] < limite) or (inclusivo and self._chave(ordem, *item)[:n] == limite)]
+        if self._pular:
+            resultado = resultado[self._pular:]
+        if self._limite is not None:
+            resultado = resultado[-self._limite:] if self._ultimos else resultado[:self._limite]
+        return resultado
+
+    def stream(self, transaction=None, **kwargs):
+        resultado = self._executar()
+        # Offset também é cobrado: cada documento pulado conta como leitura
+        cobrados = len(resultado) + (self._pular or 0)
+        self._cliente.medidor.registrar(docs=len(resultado), leituras=max(1, cobrados), chamadas=1)
+        for doc_id, dados in resultado:
+            if self._campos is not None:
+                dados = _projetar(dados, self._campos)
+            yield DocumentSnapshot(DocumentReference(self._cliente, self._colecao, doc_id), copy.deepcopy(dados))
+
+    def get(self, transaction=None, **kwargs):
+        return list(self.stream(transaction=transaction))
+
+    def on_snapshot(self, callback):
+        return self._cliente._observar(self, callback)
+
+
+def _documento_cursor(ordem, valores):
+    """(doc_id, dados) sintético com os valores do cursor, para reaproveitar _chave."""
+    dados = {}
+    doc_id = ''
+    for (campo, _), valor in zip(ordem, valores):
+        if campo == DOCUMENT_ID:
+            doc_id = valor
+        else:
+            _gravar_caminho(dados, _partes(campo), valor)
+    return doc_id, dados
+
+
+class _Invertido:
+    """Inverte a comparação para ordenação DESCENDING."""
+
+    __slots__ = ('valor',)
+
+    def __init__(self, valor):
+        self.valor = valor
+
+    def __lt__(self, outro):
+        return self.valor > outro.valor
+
+    def __gt__(self, outro):
+        return self.valor < outro.valor
+
+    def __eq__(self, outro):
+        return self.valor == outro.valor
+
+    def __le__(self, outro):
+        return self.valor >= outro.valor
+
+    def __ge__(self, outro):
+        return self.valor <= outro.valor
+
+
+class CollectionReference(Query):
+    def __init__(self, cliente, caminho):
+        super().__init__(cliente, caminho)
+        self.id = caminho.rsplit('/', 1)[-1]
+
+    def document(self, document_id=None):
+        return DocumentReference(self._cliente, self._colecao, document_id or _novo_id())
+
+    def add(self, dados, document_id=None):
+        ref = self.document(document_id)
+        ref.create(dados)
+        return _agora(), ref
+
+    def list_documents(self, page_size=None):
+        ids = [doc_id for doc_id, _ in self._cliente._docs_colecao(self._colecao)]
+        self._cliente.medidor.registrar(docs=len(ids), leituras=max(1, len(ids)), chamadas=1)
+        return [self.document(doc_id) for doc_id in ids]
+
+
+# ==========================================
+# LOTES, TRANSAÇÕES E LISTENERS
+# ==========================================
+
+class WriteBatch:
+    def __init__(self, cliente):
+        self._cliente = cliente
+        self._operacoes = []
+
+    def __len__(self):
+        return len(self._operacoes)
+
+    def set(self, ref, dados, merge=False):
+        self._operacoes.append(('set', ref, dados, merge))
+        return self
+
+    def create(self, ref, dados):
+        self._operacoes.append(('create', ref, dados, False))
+        return self
+
+    def update(self, ref, dados):
+        self._operacoes.append(('update', ref, dados, False))
+        return self
+
+    def delete(self, ref):
+        self._operacoes.append(('delete', ref, None, False))
+        return self
+
+    def commit(self):
+        operacoes, self._operacoes = self._operacoes, []
+        return self._cliente._commit(operacoes)
+
+
+class Transaction(WriteBatch):
+    """Transação: leituras diretas e escritas aplicadas juntas no commit.
+
+    O fake executa a função transacional inteira sob o lock do banco, então
+    não há conflitos nem novas tentativas.
+    """
+
+    def __init__(self, cliente, **kwargs):
+        super().__init__(cliente)
+        self.in_progress = False
+
+
+def transactional(funcao):
+    """Substituto de firestore.transactional para o fake."""
+    def executar(transaction, *args, **kwargs):
+        cliente = transaction._cliente
+        with cliente._lock:
+            transaction.in_progress = True
+            try:
+                resultado = funcao(transaction, *args, **kwargs)
+                transaction.commit()
+                return resultado
+            except Exception:
+                transaction._operacoes = []
+                raise
+            finally:
+                transaction.in_progress = False
+    return executar
+
+
+class _Mudanca:
+    def __init__(self, tipo, documento):
+        self.type = SimpleNamespace(name=tipo)
+        self.document = documento
+
+
+class Watch:
+    """Listener de uma consulta: callbacks entregues numa thread própria."""
+
+    def __init__(self, cliente, consulta, callback):
+        self._cliente = cliente
+        self._consulta = consulta
+        self._callback = callback
+        self._fila = queue.Queue()
+        self._closed = False
+        self._atuais = {}
+        self._entregue = False
+        self._thread = threading.Thread(target=self._loop, name='fake-watch', daemon=True)
+        self._thread.start()
+        self._avaliar()
+
+    def _avaliar(self):
+        """Compara o resultado atual da consulta com o último entregue."""
+        novos = {doc_id: dados for doc_id, dados in self._consulta._executar()}
+        mudancas = []
+        for doc_id in set(self._atuais) | set(novos):
+            antes, depois = self._atuais.get(doc_id), novos.get(doc_id)
+            if antes == depois:
+                continue
+            tipo = 'ADDED' if antes is None else 'REMOVED' if depois is None else 'MODIFIED'
+            ref = DocumentReference(self._cliente, self._consulta._colecao, doc_id)
+            mudancas.append(_Mudanca(tipo, DocumentSnapshot(ref, copy.deepcopy(depois if depois is not None else antes))))
+        if self._entregue and not mudancas:
+            return
+        self._entregue = True
+        self._atuais = novos
+        docs = [DocumentSnapshot(DocumentReference(self._cliente, self._consulta._colecao, i), copy.deepcopy(d))
+                for i, d in novos.items()]
+        self._fila.put((docs, mudancas, _agora()))
+
+    def _loop(self):
+        while not self._closed:
+            try:
+                docs, mudancas, read_time = self._fila.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            # Listener cobra 1 leitura por documento entregue (carga inicial ou mudança)
+            self._cliente.medidor.registrar(docs=0, leituras=max(1, len(mudancas)), chamadas=0)
+            try:
+                self._callback(docs, mudancas, read_time)
+            except Exception as e:
+                print(f"[FAKE] Erro no callback do listener: {e}")
+
+    def unsubscribe(self):
+        self._closed = True
+        self._cliente._parar_observacao(self)
+
+
+# ==========================================
+# CLIENTE
+# ==========================================
+
+class FakeFirestore:
+    """Cliente Firestore em memória (substitui app.db)."""
+
+    def __init__(self, latencia_ms=0.0, latencia_doc_ms=0.0):
+        self.medidor = Medidor(latencia_ms, latencia_doc_ms)
+        self._lock = threading.RLock()
+        self._dados = {}        # colecao -> {doc_id: dados}
+        self._watches = []
+
+    # --- API do cliente ---
+
+    def collection(self, caminho):
+        return CollectionReference(self, caminho)
+
+    def document(self, caminho):
+        colecao, doc_id = caminho.rsplit('/', 1)
+        return DocumentReference(self, colecao, doc_id)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def transaction(self, **kwargs):
+        return Transaction(self, **kwargs)
+
+    def get_all(self, references, field_paths=None, transaction=None, **kwargs):
+        refs = list(references)
+        self.medidor.registrar(docs=len(refs), leituras=max(1, len(refs)), chamadas=1)
+        for ref in refs:
+            snap = self._ler_doc(ref)
+            if field_paths and snap.exists:
+                snap = DocumentSnapshot(ref, _projetar(snap._dados, field_paths))
+            yield snap
+
+    def collections(self):
+        return [CollectionReference(self, nome) for nome in sorted(self._dados)]
+
+    # --- utilidades do fake ---
+
+    def semear(self, colecao, doc_id, dados):
+        """Grava sem contar leitura/escrita nem latência (massa de dados inicial)."""
+        with self._lock:
+            self._dados.setdefault(colecao, {})[doc_id] = _resolver(_AUSENTE, dados)
+
+    def total_documentos(self, colecao=None):
+        with self._lock:
+            if colecao:
+                return len(self._dados.get(colecao, {}))
+            return sum(len(docs) for docs in self._dados.values())
+
+    def medir(self):
+        """Context manager com o Uso (leituras/escritas) feito pela thread atual."""
+        return self.medidor.medir()
+
+    def uso_total(self):
+        return self.medidor.total.como_dict()
+
+    # --- internos ---
+
+    def _docs_colecao(self, colecao):
+        with self._lock:
+            return list(self._dados.get(colecao, {}).items())
+
+    def _ler_doc(self, ref):
+        with self._lock:
+            dados = self._dados.get(ref._colecao, {}).get(ref.id)
+            return DocumentSnapshot(ref, copy.deepcopy(dados))
+
+    def _commit(self, operacoes):
+        if len(operacoes) > LOTE_MAX:
+            raise gexc.InvalidArgument(f'maximum {LOTE_MAX} writes allowed per request')
+        with self._lock:
+            # Valida antes de aplicar (commit atômico)
+            for tipo, ref, _, _ in operacoes:
+                existe = ref.id in self._dados.get(ref._colecao, {})
+                if tipo == 'update' and not existe:
+                    raise gexc.NotFound(f'No document to update: {ref.path}')
+                if tipo == 'create' and existe:
+                    raise gexc.AlreadyExists(f'Document already exists: {ref.path}')
+            colecoes = set()
+            for tipo, ref, dados, merge in operacoes:
+                docs = self._dados.setdefault(ref._colecao, {})
+                colecoes.add(ref._colecao)
+                if tipo == 'delete':
+                    docs.pop(ref.id, None)
+                elif tipo in ('set', 'create') and not merge:
+                    docs[ref.id] = _resolver(_AUSENTE, dados)
+                elif tipo == 'set':
+                    _merge(docs.setdefault(ref.id, {}), dados)
+                else:
+                    atual = docs[ref.id]
+                    for campo, valor in dados.items():
+                        _gravar_caminho(atual, _partes(campo), valor)
+            watches = [w for w in self._watches if w._consulta._colecao in colecoes]
+            for watch in watches:
+                watch._avaliar()
+        exclusoes = sum(1 for op in operacoes if op[0] == 'delete')
+        if operacoes:
+            self.medidor.registrar(docs=len(operacoes), escritas=len(operacoes) - exclusoes,
+                                   exclusoes=exclusoes, chamadas=1)
+        return [SimpleNamespace(update_time=_agora()) for _ in operacoes]
+
+    def _observar(self, consulta, callback):
+        with self._lock:
+            watch = Watch(self, consulta, callback)
+            self._watches.append(watch)
+            return watch
+
+    def _parar_observacao(self, watch):
+        with self._lock:
+            if watch in self._watches:
+                self._watches.remove(watch)
+
+
+# ==========================================
+# STORAGE
+# ==========================================
+
+class FakeBlob:
+    def __init__(self, bucket, nome):
+        self.bucket = bucket
+        self.name = nome
+        self.content_type = None
+
+    @property
+    def public_url(self):
+        return f'https://storage.googleapis.com/{self.bucket.name}/{self.name}'
+
+    def exists(self, **kwargs):
+        self.bucket._registrar()
+        return self.name in self.bucket._blobs
+
+    def upload_from_string(self, dados, content_type=None, **kwargs):
+        if isinstance(dados, str):
+            dados = dados.encode('utf-8')
+        self.bucket._registrar(len(dados))
+        self.bucket._blobs[self.name] = (bytes(dados), content_type)
+        self.content_type = content_type
+
+    def upload_from_file(self, arquivo, content_type=None, **kwargs):
+        self.upload_from_string(arquivo.read(), content_type=content_type)
+
+    def download_as_bytes(self, **kwargs):
+        if self.name not in self.bucket._blobs:
+            raise gexc.NotFound(f'No such object: {self.bucket.name}/{self.name}')
+        dados = self.bucket._blobs[self.name][0]
+        self.bucket._registrar(len(dados))
+        return dados
+
+    download_as_string = download_as_bytes
+
+    def delete(self, **kwargs):
+        self.bucket._registrar()
+        if self.bucket._blobs.pop(self.name, None) is None:
+            raise gexc.NotFound(f'No such object: {self.bucket.name}/{self.name}')
+
+    def make_public(self, **kwargs):
+        self.bucket._registrar()
+
+    def rewrite(self, origem, **kwargs):
+        self.bucket._registrar()
+        self.bucket._blobs[self.name] = origem.bucket._blobs[origem.name]
+        return None, 0, 0
+
+
+class FakeBucket:
+    """Bucket do Storage em memória (substitui app.bucket e firebase_storage.bucket())."""
+
+    def __init__(self, medidor, nome='frota-fake.appspot.com', latencia_mb_ms=20.0):
+        self.name = nome
+        self._medidor = medidor
+        self._latencia_mb = latencia_mb_ms
+        self._blobs = {}
+
+    def _registrar(self, tamanho=0):
+        self._medidor.registrar(docs=0, storage=1, chamadas=1)
+        if tamanho and self._latencia_mb:
+            time.sleep(tamanho / (1024 * 1024) * self._latencia_mb / 1000)
+
+    def blob(self, nome):
+        return FakeBlob(self, nome)
+
+    def get_blob(self, nome):
+        return FakeBlob(self, nome) if nome in self._blobs else None
+
+    def list_blobs(self, prefix=''):
+        self._registrar()
+        return [FakeBlob(self, nome) for nome in sorted(self._blobs) if nome.startswith(prefix or '')]
+
+    def copy_blob(self, blob, destino_bucket, novo_nome=None):
+        self._registrar()
+        novo = FakeBlob(destino_bucket, novo_nome or blob.name)
+        destino_bucket._blobs[novo.name] = self._blobs[blob.name]
+        return novo
+
+
+# ==========================================
+# INSTALAÇÃO NO APP
+# ==========================================
+
+class _ModuloComSubstituicoes:
+    """Proxy de um módulo trocando só alguns atributos (ex: firestore.transactional)."""
+
+    def __init__(self, modulo, **substituicoes):
+        self._modulo = modulo
+        self.__dict__.update(substituicoes)
+
+    def __getattr__(self, nome):
+        return getattr(self._modulo, nome)
+
+
+def instalar(app_module, latencia_ms=0.0, latencia_doc_ms=0.0):
+    """Troca db/bucket do app.py pelo fake e devolve o FakeFirestore.
+
+    Se o app tiver a contabilidade de leituras/escritas (ClienteContabilizado),
+    o fake é envolvido por ela e pelo circuit breaker, como o cliente real.
+    """
+    fake = FakeFirestore(latencia_ms=latencia_ms, latencia_doc_ms=latencia_doc_ms)
+    bucket = FakeBucket(fake.medidor)
+    fake.bucket = bucket
+    contabilizar = getattr(app_module, 'ClienteContabilizado', None)
+    app_module.db = (contabilizar(fake, app_module.uso_firestore, getattr(app_module, 'circuito_firestore', None))
+                     if contabilizar else fake)
+    app_module.bucket = bucket
+    app_module.firestore = _ModuloComSubstituicoes(app_module.firestore, transactional=transactional)
+    app_module.firebase_storage = _ModuloComSubstituicoes(app_module.firebase_storage, bucket=lambda *a, **k: bucket)
+    return fake
+
+
+__all__ = ['FakeFirestore', 'FakeBucket', 'instalar', 'transactional', 'Uso']
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Gera o firestore.indexes.json (raiz do projeto) com os índices compostos
+usados pelas consultas do app.py.
+
+Deploy dos índices:
+    firebase deploy --only firestore:indexes
+
+Logs de auditoria: qualquer combinação dos filtros de igualdade
+(user, action, collection, document_id) + intervalo/ordem por timestamp DESC.
+"""
+
+import json
+import os
+from itertools import combinations
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ARQUIVO = os.path.join(RAIZ, 'firestore.indexes.json')
+
+# Filtros de igualdade aceitos por /api/audit-logs e /api/audit-logs/export
+AUDIT_FILTROS_IGUALDADE = ('user', 'action', 'collection', 'document_id')
+
+# Consultas fixas do app.py: (coleção, [(campo, ordem), ...])
+INDICES_FIXOS = [
+    # Detalhes do motorista / veículo (viagens mais recentes)
+    ('saidas', [('motorista', 'ASCENDING'), ('timestampSaida', 'DESCENDING')]),
+    ('saidas', [('veiculo', 'ASCENDING'), ('timestampSaida', 'DESCENDING')]),
+    # Chegada (fallback quando a réplica em memória está indisponível)
+    ('saidas', [('veiculo', 'ASCENDING'), ('status', 'ASCENDING'), ('timestampSaida', 'DESCENDING')]),
+    # Abastecimentos do veículo (paginação por cursor e métricas)
+    ('refuels', [('veiculo', 'ASCENDING'), ('timestamp', 'DESCENDING')]),
+    ('refuels', [('veiculo', 'ASCENDING'), ('timestamp', 'ASCENDING')]),
+    # KM mensal por placa
+    ('km_mensal', [('placa', 'ASCENDING'), ('mes_ano', 'DESCENDING')]),
+    # Multas por placa/status ordenadas pelo vencimento
+    ('multas', [('placa', 'ASCENDING'), ('data_vencimento', 'ASCENDING')]),
+    ('multas', [('status', 'ASCENDING'), ('data_vencimento', 'ASCENDING')]),
+    ('multas', [('placa', 'ASCENDING'), ('status', 'ASCENDING'), ('data_vencimento', 'ASCENDING')]),
+]
+
+
+def indice(colecao, campos):
+    return {
+        'collectionGroup': colecao,
+        'queryScope': 'COLLECTION',
+        'fields': [{'fieldPath': campo, 'order': ordem} for campo, ordem in campos],
+    }
+
+
+def indices_auditoria():
+    """Um índice por combinação não vazia dos filtros de igualdade (timestamp DESC no fim)."""
+    indices = []
+    for tamanho in range(1, len(AUDIT_FILTROS_IGUALDADE) + 1):
+        for filtros in combinations(AUDIT_FILTROS_IGUALDADE, tamanho):
+            campos = [(campo, 'ASCENDING') for campo in filtros] + [('timestamp', 'DESCENDING')]
+            indices.append(indice('audit_log', campos))
+    return indices
+
+
+def gerar():
+    indices = [indice(colecao, campos) for colecao, campos in INDICES_FIXOS]
+    indices += indices_auditoria()
+    conteudo = {'indexes': indices, 'fieldOverrides': []}
+    with open(ARQUIVO, 'w', encoding='utf-8') as f:
+        json.dump(conteudo, f, indent=2, ensure_ascii=False)
+        f.write('\n')
+    return len(indices)
+
+
+if __name__ == '__main__':
+    total = gerar()
+    print(f"✅ {total} índices compostos gravados em {ARQUIVO}")
@@ -7,6 +7,30 @@
 // FUNCIONALIDADES BÁSICAS (substituem app.js)
 // ============================================================================
 
+// Chave de idempotência por registro (header Idempotency-Key): reaproveitada em
+// toque duplo e nova tentativa do MESMO conteúdo, descartada quando o servidor
+// responde. O servidor repete a resposta original para a mesma chave.
+const _chavesIdempotencia = {};
+
+function chaveIdempotencia(acao, corpo) {
+    const atual = _chavesIdempotencia[acao];
+    if (atual && atual.corpo === corpo) {
+        return atual.chave;
+    }
+    const chave = (window.crypto && crypto.randomUUID)
+        ? crypto.randomUUID()
+        : `${Date.now()}-${Math.random().toString(16).slice(2)}`;
+    _chavesIdempotencia[acao] = { corpo, chave };
+    return chave;
+}
+
+function liberarChaveIdempotencia(acao) {
+    delete _chavesIdempotencia[acao];
+}
+
+window.chaveIdempotencia = chaveIdempotencia;
+window.liberarChaveIdempotencia = liberarChaveIdempotencia;
+
 // Botão "Usar Hora Atual"
 document.addEventListener('DOMContentLoaded', () => {
     const btnAgora = document.getElementById('btn-agora');
@@ -357,11 +381,16 @@ function adicionarValidacoesDuplicidade() {
                 motorista_secao
             };
             
+            const corpo = JSON.stringify(data);
             const response = await fetch('/api/saida', {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify(data)
+                headers: {
+                    'Content-Type': 'application/json',
+                    'Idempotency-Key': chaveIdempotencia('saida', corpo)
+                },
+                body: corpo
             });
+            liberarChaveIdempotencia('saida');
             
             const result = await response.json();
             
@@ -483,7 +512,31 @@ function adicionarContadorVisuais() {
         }, event === 'focus' || event === 'input' ? true : { passive: true });
     });
     
+    // 📡 Preferência: stream SSE do servidor (só recebe algo quando uma saída muda)
+    // ↩️ Enquanto o stream não estiver conectado, o polling abaixo assume
+    let streamAtivo = false;
+    if (window.EventSource) {
+        const stream = new EventSource('/api/stream/saidas');
+        const atualizarTotal = (e) => {
+            const dados = JSON.parse(e.data);
+            const total = document.getElementById('total-em-curso');
+            if (total) {
+                total.textContent = dados.resumo.viagens_em_curso;
+            }
+        };
+        stream.addEventListener('open', () => { streamAtivo = true; });
+        ['snapshot', 'added', 'modified', 'removed'].forEach(tipo => stream.addEventListener(tipo, atualizarTotal));
+        stream.onerror = () => {
+            streamAtivo = false;
+            if (stream.readyState === EventSource.CLOSED) {
+                console.warn('⚠️ Stream SSE indisponível - usando polling');
+            }
+        };
+    }
+    
     setInterval(async () => {
+        if (streamAtivo) return;
+        
         // Para polling após 5min de inatividade
         if (Date.now() - lastUserActivity > 5 * 60 * 1000) {
             if (pollingActive) {
@@ -2,28 +2,92 @@
 // 🔍 GERENCIAMENTO DE LOGS DE AUDITORIA
 // ==========================================
 
+// Cursor da próxima página (null = não há mais logs)
+let auditNextCursor = null;
+
+/**
+ * Monta os filtros da aba (usados na listagem e na exportação)
+ */
+function getAuditFilterParams() {
+    const params = new URLSearchParams();
+    const filtros = {
+        user: document.getElementById('audit-filter-user')?.value.trim() || '',
+        action: document.getElementById('audit-filter-action')?.value || '',
+        collection: document.getElementById('audit-filter-collection')?.value || '',
+        document_id: document.getElementById('audit-filter-document')?.value.trim() || '',
+        from: document.getElementById('audit-filter-from')?.value || '',
+        to: document.getElementById('audit-filter-to')?.value || ''
+    };
+    Object.entries(filtros).forEach(([chave, valor]) => {
+        if (valor) params.append(chave, valor);
+    });
+    return params;
+}
+
+/**
+ * Renderiza uma linha da tabela de logs
+ */
+function renderAuditLogRow(log) {
+    const timestamp = log.timestamp ? formatTimestamp(log.timestamp) : 'N/A';
+    const user = log.user || 'Sistema';
+    const action = getActionBadge(log.action);
+    const collection = log.collection || 'N/A';
+    const docId = log.document_id || 'N/A';
+
+    return `
+        <tr class="border-b border-gray-100 hover:bg-blue-50 transition-all">
+            <td class="p-4 text-sm text-gray-700">
+                ${timestamp}
+            </td>
+            <td class="p-4">
+                <span class="px-3 py-1 bg-gray-100 text-gray-700 rounded-full text-sm font-semibold">
+                    👤 ${user}
+                </span>
+            </td>
+            <td class="p-4">
+                ${action}
+            </td>
+            <td class="p-4">
+                <span class="px-3 py-1 bg-indigo-100 text-indigo-700 rounded-full text-sm font-semibold">
+                    📂 ${collection}
+                </span>
+            </td>
+            <td class="p-4 text-sm text-gray-600 font-mono">
+                ${docId.substring(0, 12)}...
+            </td>
+            <td class="p-4">
+                <button onclick='showLogDetails(${JSON.stringify(log).replace(/'/g, "&apos;")})' 
+                        class="text-blue-600 hover:text-blue-800 font-semibold text-sm">
+                    Ver Detalhes →
+                </button>
+            </td>
+        </tr>
+    `;
+}
+
 /**
- * Carrega logs de auditoria com filtros aplicados
+ * Carrega logs de auditoria com filtros aplicados.
+ * append=true busca a próxima página (cursor) e acrescenta na tabela.
  */
-async function loadAuditLogs() {
+async function loadAuditLogs(append = false) {
     const tabelaBody = document.getElementById('tabela-audit-logs');
     if (!tabelaBody) return;
+    const loadMore = document.getElementById('audit-load-more');
+
+    if (append && !auditNextCursor) return;
 
     // Mostra carregando
-    tabelaBody.innerHTML = '<tr><td colspan="6" class="p-4 text-center text-gray-500">🔄 Carregando logs...</td></tr>';
+    if (!append) {
+        auditNextCursor = null;
+        tabelaBody.innerHTML = '<tr><td colspan="6" class="p-4 text-center text-gray-500">🔄 Carregando logs...</td></tr>';
+    }
+    if (loadMore) loadMore.disabled = true;
 
     try {
-        // Pega filtros
-        const userFilter = document.getElementById('audit-filter-user')?.value.trim() || '';
-        const actionFilter = document.getElementById('audit-filter-action')?.value || '';
-        const collectionFilter = document.getElementById('audit-filter-collection')?.value || '';
-
         // Monta query string
-        const params = new URLSearchParams();
-        if (userFilter) params.append('user', userFilter);
-        if (actionFilter) params.append('action', actionFilter);
-        if (collectionFilter) params.append('collection', collectionFilter);
-        params.append('limit', '50'); // Últimos 50 logs para economizar quota
+        const params = getAuditFilterParams();
+        params.append('limit', '50'); // Páginas de 50 logs
+        if (append) params.append('cursor', auditNextCursor);
 
         const response = await fetch(`/api/audit-logs?${params.toString()}`);
         
@@ -32,59 +96,48 @@ async function loadAuditLogs() {
             throw new Error(error.error || 'Erro ao carregar logs');
         }
 
-        const logs = await response.json();
+        const data = await response.json();
+        const logs = data.logs || [];
+        auditNextCursor = data.next_cursor || null;
+
+        if (loadMore) {
+            loadMore.classList.toggle('hidden', !auditNextCursor);
+            loadMore.disabled = false;
+        }
 
-        if (logs.length === 0) {
+        if (!append && logs.length === 0) {
             tabelaBody.innerHTML = '<tr><td colspan="6" class="p-4 text-center text-gray-500">Nenhum log encontrado com os filtros aplicados.</td></tr>';
             return;
         }
 
         // Renderiza logs
-        tabelaBody.innerHTML = logs.map(log => {
-            const timestamp = log.timestamp ? formatTimestamp(log.timestamp) : 'N/A';
-            const user = log.user || 'Sistema';
-            const action = getActionBadge(log.action);
-            const collection = log.collection || 'N/A';
-            const docId = log.document_id || 'N/A';
-            const details = formatLogDetails(log);
-
-            return `
-                <tr class="border-b border-gray-100 hover:bg-blue-50 transition-all">
-                    <td class="p-4 text-sm text-gray-700">
-                        ${timestamp}
-                    </td>
-                    <td class="p-4">
-                        <span class="px-3 py-1 bg-gray-100 text-gray-700 rounded-full text-sm font-semibold">
-                            👤 ${user}
-                        </span>
-                    </td>
-                    <td class="p-4">
-                        ${action}
-                    </td>
-                    <td class="p-4">
-                        <span class="px-3 py-1 bg-indigo-100 text-indigo-700 rounded-full text-sm font-semibold">
-                            📂 ${collection}
-                        </span>
-                    </td>
-                    <td class="p-4 text-sm text-gray-600 font-mono">
-                        ${docId.substring(0, 12)}...
-                    </td>
-                    <td class="p-4">
-                        <button onclick='showLogDetails(${JSON.stringify(log).replace(/'/g, "&apos;")})' 
-                                class="text-blue-600 hover:text-blue-800 font-semibold text-sm">
-                            Ver Detalhes →
-                        </button>
-                    </td>
-                </tr>
-            `;
-        }).join('');
+        const html = logs.map(renderAuditLogRow).join('');
+        if (append) {
+            tabelaBody.insertAdjacentHTML('beforeend', html);
+        } else {
+            tabelaBody.innerHTML = html;
+        }
 
     } catch (error) {
         console.error('Erro ao carregar logs:', error);
-        tabelaBody.innerHTML = `<tr><td colspan="6" class="p-4 text-center text-red-600">❌ ${error.message}</td></tr>`;
+        if (loadMore) loadMore.disabled = false;
+        if (!append) {
+            tabelaBody.innerHTML = `<tr><td colspan="6" class="p-4 text-center text-red-600">❌ ${error.message}</td></tr>`;
+        } else {
+            alert(`❌ ${error.message}`);
+        }
     }
 }
 
+/**
+ * Exporta todos os logs dos filtros atuais (CSV ou NDJSON, gerado em streaming)
+ */
+function exportAuditLogs(formato) {
+    const params = getAuditFilterParams();
+    params.append('format', formato);
+    window.location.href = `/api/audit-logs/export?${params.toString()}`;
+}
+
 /**
  * Retorna badge HTML para cada tipo de ação
  */
@@ -5,7 +5,7 @@
  * ✅ REATIVA AUTOMATICAMENTE quando você volta para a aba ou interage
  */
 
-console.log('📡 dashboard-realtime.js CARREGADO! v14.7');
+console.log('📡 dashboard-realtime.js CARREGADO! v14.8');
 
 // Controle de inatividade - ECONOMIA DE QUOTA
 let lastActivityTime = Date.now();
@@ -64,6 +64,7 @@ function checkInactivity() {
 
 // Para todos os listeners
 function stopRealtimeListeners() {
+    pararStreamSaidas();
     if (unsubscribeSaidas) {
         unsubscribeSaidas();
         unsubscribeSaidas = null;
@@ -170,32 +171,72 @@ let unsubscribeHistorico = null;
 let unsubscribeMotoristas = null;
 let unsubscribeVeiculos = null;
 
-/**
- * Inicia os listeners em tempo real
- */
-async function initRealtimeListeners() {
-    console.log('🚀 initRealtimeListeners() chamado...');
-    
-    await waitForFirebase();
-    console.log('✅ Firebase está pronto');
-    
-    const db = window.firestoreDb;
-    const { collection, onSnapshot, query, orderBy, limit, where } = window.firestoreModules;
-
-    // Se já estão ativos, não recria
-    if (listenersActive) {
-        console.log('➡️ Listeners já estão ativos');
-        return;
+// ✅ Atualiza o contador de veículos EM CURSO
+function atualizarContadorEmCurso(total) {
+    const statEmCurso = document.getElementById('stat-viagens-em-curso');
+    if (statEmCurso) {
+        statEmCurso.textContent = total;
+        console.log(`✅ Contador EM CURSO atualizado: ${total}`);
+    } else {
+        console.error('❌ Elemento stat-viagens-em-curso não encontrado!');
     }
+}
 
-    console.log('🔴 Iniciando listeners em tempo real...');
-    listenersActive = true;
+// ✅ Recarrega dashboard e histórico após nova saída/chegada
+async function atualizarDashboardAposMudanca() {
+    console.log('🔄 Atualizando dashboard automaticamente...');
     
-    // ✅ Mostra indicador visual de que os listeners estão ativos
-    showListenerStatus('🟢 Atualização em tempo real ATIVA');
+    try {
+        // ✅ O servidor já corrige/invalida as seções de cache afetadas ao gravar a
+        // saída/chegada — não limpa o cache inteiro aqui (cada painel aberto faria
+        // todos os outros recalcularem o dashboard a partir do Firestore).
+        // Pequena espera para a requisição que gravou terminar essa correção.
+        console.log('⏳ Aguardando 1.5s para o servidor atualizar o cache...');
+        await new Promise(resolve => setTimeout(resolve, 1500));
+        
+        // Recarrega os dados do dashboard (gráficos e cards)
+        if (window.viagensChartsInitialized && typeof loadDashboardData === 'function') {
+            console.log('📈 Atualizando gráficos...');
+            await loadDashboardData(
+                window.viagensPorVeiculoChartInstance,
+                window.viagensPorMotoristaChartInstance,
+                window.viagensPorVeiculoChartTotalInstance,
+                window.viagensPorMotoristaChartTotalInstance
+            );
+            console.log('✅ Gráficos atualizados');
+        }
+        
+        // ✅ ATUALIZA O HISTÓRICO RECENTE TAMBÉM
+        console.log('📋 Atualizando histórico recente...');
+        
+        if (typeof window.loadHistoricoData === 'function') {
+            console.log('✅ Chamando window.loadHistoricoData(1)');
+            await window.loadHistoricoData(1);
+            console.log('✅ Histórico atualizado via window.loadHistoricoData');
+        } else {
+            console.error('❌ window.loadHistoricoData não está disponível!');
+            console.log('🔍 Tentando buscar diretamente da API...');
+            
+            const data = await window.safeFetchJSON('/api/historico?page=1&per_page=20&_=' + Date.now());
+            console.log('✅ Dados recebidos da API:', data.items?.length, 'registros');
+            
+            if (typeof window.populateHistoryTable === 'function') {
+                window.populateHistoryTable(data.items || []);
+                console.log('✅ Tabela atualizada via window.populateHistoryTable');
+            } else {
+                console.error('❌ window.populateHistoryTable também não está disponível!');
+            }
+        }
+        
+        console.log('✅ Dashboard e histórico atualizados automaticamente!');
+        
+    } catch (error) {
+        console.error('❌ Erro ao atualizar dashboard:', error);
+    }
+}
 
-    // 1. Listener APENAS para Veículos EM CURSO (otimizado - 5-10 docs)
-    // ✅ AGORA TAMBÉM ATUALIZA O DASHBOARD automaticamente quando há mudanças
+// ↩️ Fallback: listener Firebase direto no navegador para veículos EM CURSO
+function iniciarListenerEmCursoFirebase(db, { collection, onSnapshot, query, where }) {
     try {
         const saidasQuery = query(
             collection(db, 'saidas'),
@@ -207,28 +248,22 @@ async function initRealtimeListeners() {
         unsubscribeSaidas = onSnapshot(saidasQuery, async (snapshot) => {
             const timestamp = new Date().toLocaleTimeString();
             console.log(`📊 [${timestamp}] Atualização em veículos EM CURSO: ${snapshot.docChanges().length} mudanças, ${snapshot.size} total`);
-            
+        
             // Log detalhado das mudanças
             snapshot.docChanges().forEach((change) => {
                 const veiculo = change.doc.data().veiculo;
                 console.log(`  - ${change.type.toUpperCase()}: ${veiculo}`);
             });
-            
+        
             // ✅ SEMPRE atualiza o contador (mesmo no primeiro snapshot)
-            const statEmCurso = document.getElementById('stat-viagens-em-curso');
-            if (statEmCurso) {
-                statEmCurso.textContent = snapshot.size;
-                console.log(`✅ Contador EM CURSO atualizado: ${snapshot.size}`);
-            } else {
-                console.error('❌ Elemento stat-viagens-em-curso não encontrado!');
-            }
+            atualizarContadorEmCurso(snapshot.size);
 
             // Verifica se houve MUDANÇAS (não apenas leitura inicial)
             let houveNovaOuChegada = false;
 
             snapshot.docChanges().forEach((change) => {
                 const data = change.doc.data();
-                
+            
                 if (change.type === 'added' && !isFirstSnapshot) {
                     // Nova saída registrada
                     houveNovaOuChegada = true;
@@ -251,56 +286,7 @@ async function initRealtimeListeners() {
 
             // ✅ ATUALIZA O DASHBOARD automaticamente se houve nova saída/chegada
             if (houveNovaOuChegada) {
-                console.log('🔄 Atualizando dashboard automaticamente...');
-                
-                try {
-                    // ✅ LIMPA O CACHE IMEDIATAMENTE (força atualização)
-                    await fetch('/api/dashboard_cache/clear', { method: 'POST' });
-                    console.log('✅ Cache limpo');
-                    
-                    // ✅ DELAY MAIOR - 3.5 segundos para dar tempo do Firestore propagar
-                    console.log('⏳ Aguardando 3.5s para Firestore propagar mudanças...');
-                    await new Promise(resolve => setTimeout(resolve, 3500));
-                    
-                    // Recarrega os dados do dashboard (gráficos e cards)
-                    if (window.viagensChartsInitialized && typeof loadDashboardData === 'function') {
-                        console.log('📈 Atualizando gráficos...');
-                        await loadDashboardData(
-                            window.viagensPorVeiculoChartInstance,
-                            window.viagensPorMotoristaChartInstance,
-                            window.viagensPorVeiculoChartTotalInstance,
-                            window.viagensPorMotoristaChartTotalInstance
-                        );
-                        console.log('✅ Gráficos atualizados');
-                    }
-                    
-                    // ✅ ATUALIZA O HISTÓRICO RECENTE TAMBÉM
-                    console.log('📋 Atualizando histórico recente...');
-                    
-                    if (typeof window.loadHistoricoData === 'function') {
-                        console.log('✅ Chamando window.loadHistoricoData(1)');
-                        await window.loadHistoricoData(1);
-                        console.log('✅ Histórico atualizado via window.loadHistoricoData');
-                    } else {
-                        console.error('❌ window.loadHistoricoData não está disponível!');
-                        console.log('🔍 Tentando buscar diretamente da API...');
-                        
-                        const data = await window.safeFetchJSON('/api/historico?page=1&per_page=20&_=' + Date.now());
-                        console.log('✅ Dados recebidos da API:', data.items?.length, 'registros');
-                        
-                        if (typeof window.populateHistoryTable === 'function') {
-                            window.populateHistoryTable(data.items || []);
-                            console.log('✅ Tabela atualizada via window.populateHistoryTable');
-                        } else {
-                            console.error('❌ window.populateHistoryTable também não está disponível!');
-                        }
-                    }
-                    
-                    console.log('✅ Dashboard e histórico atualizados automaticamente!');
-                    
-                } catch (error) {
-                    console.error('❌ Erro ao atualizar dashboard:', error);
-                }
+                await atualizarDashboardAposMudanca();
             }
 
             isFirstSnapshot = false; // Marca que o primeiro snapshot já passou
@@ -312,6 +298,101 @@ async function initRealtimeListeners() {
     } catch (error) {
         console.error('❌ Erro ao criar listener de saidas:', error);
     }
+}
+
+// 📡 Stream SSE do servidor (/api/stream/saidas): snapshot inicial + mudanças
+let streamSaidas = null;
+
+function iniciarStreamSaidas() {
+    if (!window.EventSource) {
+        console.warn('⚠️ EventSource não suportado - usando listener Firebase');
+        return false;
+    }
+    if (streamSaidas) return true;
+
+    let falhasSeguidas = 0;
+    streamSaidas = new EventSource('/api/stream/saidas');
+
+    streamSaidas.addEventListener('open', () => {
+        falhasSeguidas = 0;
+        console.log('✅ Stream de saídas conectado (SSE)');
+    });
+
+    streamSaidas.addEventListener('snapshot', (e) => {
+        const dados = JSON.parse(e.data);
+        atualizarContadorEmCurso(dados.resumo.viagens_em_curso);
+    });
+
+    ['added', 'modified', 'removed'].forEach(tipo => {
+        streamSaidas.addEventListener(tipo, async (e) => {
+            const evento = JSON.parse(e.data);
+            const saida = evento.saida || {};
+            console.log(`📊 [SSE] ${tipo.toUpperCase()}: ${saida.veiculo || evento.id}`);
+            atualizarContadorEmCurso(evento.resumo.viagens_em_curso);
+
+            const novaSaida = tipo === 'added' && saida.status === 'em_curso';
+            const chegada = evento.status_anterior === 'em_curso' && saida.status !== 'em_curso';
+            if (novaSaida && window.showToast) {
+                showToast('info', `🚗 Nova saída: ${saida.veiculo} - ${saida.motorista}`);
+            } else if (chegada && tipo === 'modified' && window.showToast) {
+                showToast('success', `✅ Chegada registrada: ${saida.veiculo}`);
+            }
+            if (novaSaida || chegada) {
+                await atualizarDashboardAposMudanca();
+            }
+        });
+    });
+
+    streamSaidas.onerror = () => {
+        falhasSeguidas++;
+        // CLOSED = servidor recusou (ex: 503 por limite de conexões); o EventSource não tenta de novo
+        if (streamSaidas.readyState === EventSource.CLOSED || falhasSeguidas >= 3) {
+            console.warn('⚠️ Stream SSE indisponível - usando listener Firebase');
+            pararStreamSaidas();
+            if (listenersActive && !unsubscribeSaidas && window.firestoreDb && window.firestoreModules) {
+                iniciarListenerEmCursoFirebase(window.firestoreDb, window.firestoreModules);
+            }
+        }
+    };
+    return true;
+}
+
+function pararStreamSaidas() {
+    if (streamSaidas) {
+        streamSaidas.close();
+        streamSaidas = null;
+    }
+}
+
+/**
+ * Inicia os listeners em tempo real
+ */
+async function initRealtimeListeners() {
+    console.log('🚀 initRealtimeListeners() chamado...');
+    
+    await waitForFirebase();
+    console.log('✅ Firebase está pronto');
+    
+    const db = window.firestoreDb;
+    const { collection, onSnapshot, query, orderBy, limit, where } = window.firestoreModules;
+
+    // Se já estão ativos, não recria
+    if (listenersActive) {
+        console.log('➡️ Listeners já estão ativos');
+        return;
+    }
+
+    console.log('🔴 Iniciando listeners em tempo real...');
+    listenersActive = true;
+    
+    // ✅ Mostra indicador visual de que os listeners estão ativos
+    showListenerStatus('🟢 Atualização em tempo real ATIVA');
+
+    // 1. Veículos EM CURSO: stream SSE do servidor (1 listener no servidor para todos os dashboards)
+    // ↩️ Se o servidor recusar (limite de conexões) ou o navegador não suportar, usa o listener Firebase
+    if (!iniciarStreamSaidas()) {
+        iniciarListenerEmCursoFirebase(db, { collection, onSnapshot, query, where });
+    }
 
     // 2. Listener para HISTÓRICO (APENAS do mês visível na tela)
     try {
@@ -437,6 +518,7 @@ async function initRealtimeListeners() {
  * Para todos os listeners (útil para cleanup)
  */
 function stopRealtimeListeners() {
+    pararStreamSaidas();
     if (unsubscribeSaidas) {
         unsubscribeSaidas();
         unsubscribeSaidas = null;
@@ -9,6 +9,7 @@ console.log('📊 Dashboard.js carregado - aguardando DOM...');
 window.historicoCurrentPage = 1;
 window.historicoItemsPerPage = 500;
 window.historicoTotalItems = 0;
+window.historicoCursors = { 1: null }; // cursor (next_cursor) de cada página já visitada
 
 document.addEventListener('DOMContentLoaded', () => {
     // Inicializa os gráficos com um estado vazio
@@ -281,16 +282,12 @@ async function loadDashboardData(viagensPorVeiculoChart, viagensPorMotoristaChar
 
         // Atualiza os gráficos de abastecimento (pie charts) a partir de /api/refuels/summary
         try {
-            // Litros Total: SEM filtro de mês
-            const respTotal = await fetch('/api/refuels/summary');
-            if (respTotal.ok) {
-                const summaryTotal = await respTotal.json();
-                const total = summaryTotal.per_vehicle_total || { labels: [], data: [] };
-                
-                // Litros Mês: COM filtro de mês
-                const respMes = await fetch(`/api/refuels/summary?month=${mesFiltro}`);
-                const summaryMes = await respMes.json();
-                const month = summaryMes.per_vehicle_month || { labels: [], data: [] };
+            // Uma chamada traz o total geral (sem filtro) e o total do mês filtrado
+            const respSummary = await fetch(`/api/refuels/summary?month=${mesFiltro}`);
+            if (respSummary.ok) {
+                const summary = await respSummary.json();
+                const total = summary.per_vehicle_total || { labels: [], data: [] };
+                const month = summary.per_vehicle_month || { labels: [], data: [] };
 
                 // Colors: reuse a palette
                 const palette = ['#4F46E5','#10B981','#F59E0B','#EF4444','#6366F1','#3B82F6','#8B5CF6','#06B6D4','#F97316','#10B981'];
@@ -435,9 +432,18 @@ async function loadHistoricoData(page = 1) {
         console.log(`📅 Enviando filtro de mês: ${mes}/${ano}`);
     }
     
-    // ✅ PAGINAÇÃO SERVER-SIDE para economizar quota
+    // ✅ PAGINAÇÃO POR CURSOR: página N usa o next_cursor devolvido pela página N-1
+    if (page === 1) {
+        window.historicoCursors = { 1: null };
+    } else if (!window.historicoCursors[page]) {
+        console.warn(`⚠️ Página ${page} ainda não alcançada - navegue pelas páginas anteriores`);
+        return;
+    }
     params.append('page', page);
     params.append('limit', window.historicoItemsPerPage);
+    if (window.historicoCursors[page]) {
+        params.append('cursor', window.historicoCursors[page]);
+    }
     
     // ✅ Adiciona timestamp para evitar cache do navegador
     params.append('_t', Date.now());
@@ -468,6 +474,11 @@ async function loadHistoricoData(page = 1) {
             console.log(`  📋 [${i}] ${item.veiculo} → Categoria: "${item.categoria || 'VAZIO'}"`);
         });
         
+        // Guarda o cursor da próxima página (null = última página)
+        if (data.next_cursor) {
+            window.historicoCursors[page + 1] = data.next_cursor;
+        }
+
         // Guarda dados da página atual
         window.historicoCache = historico;
         window.historicoTotalItems = total;
@@ -1185,7 +1196,10 @@ function updateChartData(chart, chartData) {
 function renderHistoricoPagination(items) {
     // ✅ USA TOTAL GLOBAL do servidor para paginação correta
     const totalItems = window.historicoTotalItems || items.length;
-    const totalPages = Math.ceil(totalItems / window.historicoItemsPerPage);
+    // Com filtros locais o total é só da página: o next_cursor indica se há mais
+    const temProxima = Boolean(window.historicoCursors[window.historicoCurrentPage + 1]);
+    const totalPages = Math.max(Math.ceil(totalItems / window.historicoItemsPerPage),
+                                temProxima ? window.historicoCurrentPage + 1 : 0);
     
     console.log('🔢 Renderizando paginação:', { totalItems, totalPages, currentPage: window.historicoCurrentPage });
     
@@ -1249,9 +1263,14 @@ function renderHistoricoPagination(items) {
 function createPaginationButton(text, page, active = false) {
     const btn = document.createElement('button');
     btn.textContent = text;
+    // Só dá para abrir páginas cujo cursor já é conhecido (keyset pagination)
+    const alcancavel = page === 1 || Boolean(window.historicoCursors[page]);
     btn.className = active 
         ? 'px-4 py-2 bg-indigo-600 text-white rounded-lg font-semibold'
-        : 'px-4 py-2 bg-white text-gray-700 border border-gray-300 rounded-lg hover:bg-gray-50';
+        : alcancavel
+            ? 'px-4 py-2 bg-white text-gray-700 border border-gray-300 rounded-lg hover:bg-gray-50'
+            : 'px-4 py-2 bg-gray-100 text-gray-400 border border-gray-200 rounded-lg cursor-not-allowed';
+    btn.disabled = !alcancavel;
     btn.onclick = () => goToHistoricoPage(page);
     return btn;
 }
@@ -1266,10 +1285,9 @@ function createPaginationDots() {
 async function goToHistoricoPage(page) {
     if (page < 1) return;
     
-    const totalPages = Math.ceil(window.historicoTotalItems / window.historicoItemsPerPage);
-    if (page > totalPages) return;
+    if (page > 1 && !window.historicoCursors[page]) return;
     
-    // 🚀 Sempre busca do servidor (economiza quota - só 50 leituras por vez)
+    // 🚀 Sempre busca do servidor (cada página lê só os seus documentos)
     await loadHistoricoData(page);
 }
 
@@ -1299,16 +1317,13 @@ function gerarPDFHistorico() {
     params.append('mes', mes);
     params.append('ano', ano);
     
-    const queryString = params.toString();
-    const url = `/pdf/saidas${queryString ? '?' + queryString : ''}`;
-    
     const meses = ['Janeiro', 'Fevereiro', 'Março', 'Abril', 'Maio', 'Junho', 
                    'Julho', 'Agosto', 'Setembro', 'Outubro', 'Novembro', 'Dezembro'];
     
     console.log(`📝 Gerando PDF do histórico: ${meses[mes-1]}/${ano}`);
     
-    // Abre o PDF em nova aba
-    window.open(url, '_blank');
+    // Gera em segundo plano e baixa quando ficar pronto
+    baixarRelatorioPdf('saidas', Object.fromEntries(params));
 }
 
 // ==========================================
@@ -0,0 +1,85 @@
+// 📄 Geração de PDF em segundo plano
+// POST /api/relatorios cria o job; o status é consultado em status_url até
+// ficar pronto e o arquivo é baixado de download_url. Nenhuma thread do
+// servidor fica presa enquanto o PDF é gerado (ao contrário de abrir /pdf/*).
+//
+// Uso:
+//   baixarRelatorioPdf('saidas', { data_inicio: '...', data_fim: '...' });
+//   baixarRelatorioPdf('revisoes', {}, { chamados: [...] });   // corpo POST
+//   <a href="/pdf/veiculos?status=ativos" data-relatorio="veiculos">  (links)
+
+const RELATORIO_INTERVALO_MS = 1000;
+const RELATORIO_INTERVALO_MAX_MS = 4000;
+const RELATORIO_ESPERA_MAX_MS = 5 * 60 * 1000;
+
+function avisarRelatorio(tipo, mensagem) {
+    if (typeof window.showToast === 'function') {
+        window.showToast(tipo, mensagem, tipo === 'error' ? 8000 : 4000);
+    } else if (tipo === 'error') {
+        alert(mensagem);
+    }
+}
+
+async function lerJsonRelatorio(response) {
+    const data = await response.json().catch(() => ({}));
+    if (!response.ok) {
+        throw new Error(data.error || `HTTP ${response.status}`);
+    }
+    return data;
+}
+
+async function baixarRelatorioPdf(tipo, params = {}, dados = null) {
+    const corpo = { tipo, params };
+    if (dados !== null && dados !== undefined) corpo.dados = dados;
+
+    try {
+        let job = await lerJsonRelatorio(await fetch('/api/relatorios', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(corpo)
+        }));
+
+        if (job.status !== 'concluido') {
+            avisarRelatorio('info', '⏳ Gerando PDF... o download começa assim que ficar pronto.');
+        }
+
+        const inicio = Date.now();
+        let intervalo = RELATORIO_INTERVALO_MS;
+        while (job.status !== 'concluido') {
+            if (job.status === 'erro') {
+                throw new Error(job.erro || 'Falha ao gerar o relatório');
+            }
+            if (Date.now() - inicio > RELATORIO_ESPERA_MAX_MS) {
+                throw new Error('Tempo esgotado aguardando o relatório');
+            }
+            await new Promise(resolve => setTimeout(resolve, intervalo));
+            intervalo = Math.min(intervalo * 1.5, RELATORIO_INTERVALO_MAX_MS);
+            job = await lerJsonRelatorio(await fetch(job.status_url, { cache: 'no-store' }));
+        }
+
+        // O download responde com Content-Disposition: attachment (não sai da página)
+        const a = document.createElement('a');
+        a.href = job.download_url;
+        document.body.appendChild(a);
+        a.click();
+        document.body.removeChild(a);
+        console.log(`[PDF] Relatório ${tipo} pronto${job.cache ? ' (cache)' : ''}`);
+        return job;
+    } catch (error) {
+        console.error('[PDF] Erro ao gerar relatório:', error);
+        avisarRelatorio('error', 'Erro ao gerar PDF: ' + error.message);
+        return null;
+    }
+}
+
+// Links <a href="/pdf/..." data-relatorio="tipo">: os parâmetros vêm da query
+// string do href (que continua funcionando sem JavaScript).
+document.addEventListener('click', (e) => {
+    const link = e.target.closest('a[data-relatorio]');
+    if (!link) return;
+    e.preventDefault();
+    const url = new URL(link.getAttribute('href'), window.location.origin);
+    baixarRelatorioPdf(link.dataset.relatorio, Object.fromEntries(url.searchParams));
+});
+
+window.baixarRelatorioPdf = baixarRelatorioPdf;
@@ -10,15 +10,13 @@ function initRelatoriosTab() {
             const dataInicio = document.getElementById('abast-data-inicio').value;
             const dataFim = document.getElementById('abast-data-fim').value;
             
-            let url = '/pdf/abastecimentos?';
-            const params = [];
+            const params = {};
             
-            if (veiculo) params.push(`veiculo=${encodeURIComponent(veiculo)}`);
-            if (dataInicio) params.push(`data_inicio=${dataInicio}T00:00:00`);
-            if (dataFim) params.push(`data_fim=${dataFim}T23:59:59`);
+            if (veiculo) params.veiculo = veiculo;
+            if (dataInicio) params.data_inicio = `${dataInicio}T00:00:00`;
+            if (dataFim) params.data_fim = `${dataFim}T23:59:59`;
             
-            url += params.join('&');
-            window.open(url, '_blank');
+            baixarRelatorioPdf('abastecimentos', params);
         });
     }
 
@@ -33,17 +31,15 @@ function initRelatoriosTab() {
             const dataInicio = document.getElementById('saidas-data-inicio').value;
             const dataFim = document.getElementById('saidas-data-fim').value;
             
-            let url = '/pdf/saidas?';
-            const params = [];
+            const params = {};
             
-            if (veiculo) params.push(`veiculo=${encodeURIComponent(veiculo)}`);
-            if (motorista) params.push(`motorista=${encodeURIComponent(motorista)}`);
-            if (status) params.push(`status=${status}`);
-            if (dataInicio) params.push(`data_inicio=${dataInicio}T00:00:00`);
-            if (dataFim) params.push(`data_fim=${dataFim}T23:59:59`);
+            if (veiculo) params.veiculo = veiculo;
+            if (motorista) params.motorista = motorista;
+            if (status) params.status = status;
+            if (dataInicio) params.data_inicio = `${dataInicio}T00:00:00`;
+            if (dataFim) params.data_fim = `${dataFim}T23:59:59`;
             
-            url += params.join('&');
-            window.open(url, '_blank');
+            baixarRelatorioPdf('saidas', params);
         });
     }
 
@@ -53,8 +49,7 @@ function initRelatoriosTab() {
         formPdfVeiculos.addEventListener('submit', (e) => {
             e.preventDefault();
             const status = document.getElementById('select-pdf-veiculos-status').value;
-            let url = `/pdf/veiculos?status=${status}`;
-            window.open(url, '_blank');
+            baixarRelatorioPdf('veiculos', { status });
         });
     }
 
@@ -68,16 +63,14 @@ function initRelatoriosTab() {
             const dataInicio = document.getElementById('multas-data-inicio').value;
             const dataFim = document.getElementById('multas-data-fim').value;
             
-            let url = '/pdf/multas?';
-            const params = [];
+            const params = {};
             
-            if (veiculo) params.push(`veiculo=${encodeURIComponent(veiculo)}`);
-            if (status) params.push(`status=${status}`);
-            if (dataInicio) params.push(`data_inicio=${dataInicio}T00:00:00`);
-            if (dataFim) params.push(`data_fim=${dataFim}T23:59:59`);
+            if (veiculo) params.veiculo = veiculo;
+            if (status) params.status = status;
+            if (dataInicio) params.data_inicio = `${dataInicio}T00:00:00`;
+            if (dataFim) params.data_fim = `${dataFim}T23:59:59`;
             
-            url += params.join('&');
-            window.open(url, '_blank');
+            baixarRelatorioPdf('multas', params);
         });
     }
 
@@ -144,35 +137,8 @@ function initRelatoriosTab() {
                 chamadosFiltrados = chamadosFiltrados.filter(c => c.direcionamento === direcionamento);
             }
             
-            // Envia via POST para gerar PDF
-            try {
-                const response = await fetch('/pdf/revisoes', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
-                    body: JSON.stringify({ chamados: chamadosFiltrados })
-                });
-                
-                if (response.ok) {
-                    // Baixa o PDF
-                    const blob = await response.blob();
-                    const url = window.URL.createObjectURL(blob);
-                    const a = document.createElement('a');
-                    a.href = url;
-                    a.download = `chamados_manutencao_${new Date().toISOString().slice(0,10)}.pdf`;
-                    document.body.appendChild(a);
-                    a.click();
-                    window.URL.revokeObjectURL(url);
-                    document.body.removeChild(a);
-                } else {
-                    const error = await response.json();
-                    alert('Erro ao gerar PDF: ' + (error.error || 'Erro desconhecido'));
-                }
-            } catch (error) {
-                console.error('Erro ao gerar PDF:', error);
-                alert('Erro ao gerar PDF: ' + error.message);
-            }
+            // Envia os chamados filtrados como corpo do job (POST /pdf/revisoes)
+            await baixarRelatorioPdf('revisoes', {}, { chamados: chamadosFiltrados });
         });
     }
 }
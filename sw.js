@@ -1,5 +1,5 @@
 // ⚠️ AUMENTE ESTE NÚMERO SEMPRE QUE FIZER MUDANÇAS NO CÓDIGO
-const APP_VERSION = 'v15.0'; // PWA Auto-update + Correções JSON - 28/01/2026
+const APP_VERSION = 'v15.4'; // Botões de PDF usam a fila /api/relatorios
 const CACHE_NAME = `frota-sanemar-cache-${APP_VERSION}`;
 const OLD_CACHES = [
   'frota-sanemar-cache-v3',
@@ -23,6 +23,7 @@ const urlsToCache = [
   '/static/veiculos-tab.js',
   '/static/km-multas.js',
   '/static/relatorios-tab.js',
+  '/static/relatorios-pdf.js',
   '/static/revisoes-tab.js',
   '/static/connection-monitor.js',
   '/static/manifest.json'